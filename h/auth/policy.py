@@ -97,7 +97,7 @@ class TokenAuthenticationPolicy(CallbackAuthenticationPolicy):
 
 def _is_api_request(request):
     return (request.path.startswith('/api') and
-            request.path not in ['/api/token', '/api/badge'])
+            request.path not in ['/api/token', '/api/badge', '/api/badges'])
 
 
 def _is_ws_request(request):
@@ -16,8 +16,10 @@ import os
 
 from celery import Celery
 from celery import signals
+from celery.exceptions import ImproperlyConfigured
 from celery.utils.log import get_task_logger
 from kombu import Exchange, Queue
+from pyramid.settings import asbool
 from raven.contrib.celery import register_signal, register_logger_signal
 
 __all__ = (
@@ -46,6 +48,10 @@ celery.conf.update(
             'task': 'h.tasks.cleanup.purge_expired_tokens',
             'schedule': timedelta(hours=1)
         },
+        'purge-scheduled-thread-roots': {
+            'task': 'h.tasks.cleanup.purge_scheduled_thread_roots',
+            'schedule': timedelta(hours=1)
+        },
         'purge-removed-features': {
             'task': 'h.tasks.cleanup.purge_removed_features',
             'schedule': timedelta(hours=6)
@@ -68,6 +74,7 @@ celery.conf.update(
         'h.tasks.indexer.add_annotation': 'indexer',
         'h.tasks.indexer.delete_annotation': 'indexer',
         'h.tasks.indexer.reindex_user_annotations': 'indexer',
+        'h.tasks.indexer.sync_annotation': 'indexer',
     },
     CELERY_TASK_SERIALIZER='json',
     CELERY_QUEUES=[
@@ -82,8 +89,11 @@ celery.conf.update(
     ],
     # Only accept one task at a time. This also probably isn't what we want
     # (especially not for, say, a search indexer task) but it makes the
-    # behaviour consistent with the previous NSQ-based worker:
-    CELERYD_PREFETCH_MULTIPLIER=1,
+    # behaviour consistent with the previous NSQ-based worker. Workers which
+    # process indexer tasks in batches need to prefetch at least a batch's
+    # worth of messages, so they can override this (and won't start if they
+    # don't, see check_indexer_prefetch below):
+    CELERYD_PREFETCH_MULTIPLIER=int(os.environ.get('CELERYD_PREFETCH_MULTIPLIER', 1)),
 )
 
 
@@ -96,6 +106,36 @@ def bootstrap_worker(sender, **kwargs):
     register_signal(request.sentry)
     register_logger_signal(request.sentry, loglevel=logging.ERROR)
 
+    check_indexer_prefetch(sender, request.registry.settings)
+
+
+def check_indexer_prefetch(worker, settings):
+    """
+    Check that a worker can prefetch a whole batch of indexer messages.
+
+    The batching indexer task only acknowledges its messages once a batch has
+    been processed, so a worker which prefetches fewer messages than the batch
+    size never fills a batch, and waits for the batch interval every time.
+    """
+    if not asbool(settings.get('h.indexer.batch')):
+        return
+    if 'indexer' not in worker.app.amqp.queues.consume_from:
+        return
+
+    # Imported here because the tasks module imports the Celery app from this
+    # module.
+    from h.tasks.indexer import BATCH_SIZE
+
+    prefetch = worker.concurrency * worker.prefetch_multiplier
+    # A prefetch multiplier of 0 means the worker's prefetch is unlimited.
+    if 0 < prefetch < BATCH_SIZE:
+        raise ImproperlyConfigured(
+            'worker prefetches {} messages (concurrency {} x '
+            'CELERYD_PREFETCH_MULTIPLIER {}), which is less than the indexer '
+            'batch size of {} (INDEXER_BATCH_SIZE)'.format(
+                prefetch, worker.concurrency, worker.prefetch_multiplier,
+                BATCH_SIZE))
+
 
 @signals.task_prerun.connect
 def reset_nipsa_cache(sender, **kwargs):
@@ -1,16 +1,12 @@
 # -*- coding: utf-8 -*-
 
-from collections import namedtuple
 import click
 
 from h import models
 from h.models.document import merge_documents
 from h.search import index
 from h.util import uri
-
-
-class Window(namedtuple('Window', ['start', 'end'])):
-    pass
+from h.util.query import keyset_windows
 
 
 @click.command('normalize-uris')
@@ -28,30 +24,21 @@ def normalize_uris(ctx):
 
 
 def normalize_document_uris(request):
-    windows = _fetch_windows(request.db, models.DocumentURI.updated)
-    request.tm.commit()
-
-    for window in windows:
+    for window in _windows(request.db, models.DocumentURI):
         request.tm.begin()
         _normalize_document_uris_window(request.db, window)
         request.tm.commit()
 
 
 def normalize_document_meta(request):
-    windows = _fetch_windows(request.db, models.DocumentMeta.updated)
-    request.tm.commit()
-
-    for window in windows:
+    for window in _windows(request.db, models.DocumentMeta):
         request.tm.begin()
         _normalize_document_meta_window(request.db, window)
         request.tm.commit()
 
 
 def normalize_annotations(request):
-    windows = _fetch_windows(request.db, models.Annotation.updated)
-    request.tm.commit()
-
-    for window in windows:
+    for window in _windows(request.db, models.Annotation):
         request.tm.begin()
         ids = _normalize_annotations_window(request.db, window)
         request.tm.commit()
@@ -63,8 +50,8 @@ def normalize_annotations(request):
 
 def _normalize_document_uris_window(session, window):
     query = session.query(models.DocumentURI) \
-        .filter(models.DocumentURI.updated.between(window.start, window.end)) \
-        .order_by(models.DocumentURI.updated.asc())
+        .filter(window) \
+        .order_by(models.DocumentURI.updated.asc(), models.DocumentURI.id.asc())
 
     for docuri in query:
         documents = models.Document.find_by_uris(session, [docuri.uri])
@@ -90,8 +77,8 @@ def _normalize_document_uris_window(session, window):
 
 def _normalize_document_meta_window(session, window):
     query = session.query(models.DocumentMeta) \
-        .filter(models.DocumentMeta.updated.between(window.start, window.end)) \
-        .order_by(models.DocumentMeta.updated.asc())
+        .filter(window) \
+        .order_by(models.DocumentMeta.updated.asc(), models.DocumentMeta.id.asc())
 
     for docmeta in query:
         existing = session.query(models.DocumentMeta).filter(
@@ -109,8 +96,8 @@ def _normalize_document_meta_window(session, window):
 
 def _normalize_annotations_window(session, window):
     query = session.query(models.Annotation) \
-        .filter(models.Annotation.updated.between(window.start, window.end)) \
-        .order_by(models.Annotation.updated.asc())
+        .filter(window) \
+        .order_by(models.Annotation.updated.asc(), models.Annotation.id.asc())
 
     ids = set()
     for a in query:
@@ -131,14 +118,8 @@ def _reindex_annotations(request, ids):
             break
 
 
-def _fetch_windows(session, column, chunksize=100):
-    updated = session.query(column). \
-        execution_options(stream_results=True). \
-        order_by(column.desc()).all()
-
-    count = len(updated)
-    windows = [Window(start=updated[min(x+chunksize, count)-1].updated,
-                      end=updated[x].updated)
-               for x in xrange(0, count, chunksize)]
-
-    return windows
+def _windows(session, model, windowsize=100):
+    # Each window is found after the previous one has been committed, so
+    # rows which were changed by normalizing them are visited again in a
+    # later window. They are normalized by then, and so are left alone.
+    return keyset_windows(session, [model.updated, model.id], windowsize=windowsize)
@@ -14,21 +14,33 @@ def search():
 
 
 @search.command()
+@click.option('--parallel', type=click.IntRange(min=1), default=1,
+              help='Number of worker processes to index with.')
+@click.option('--resume', is_flag=True,
+              help='Continue an interrupted reindex into its index.')
 @click.pass_context
-def reindex(ctx):
+def reindex(ctx, parallel, resume):
     """
     Reindex all annotations.
 
     Creates a new search index from the data in PostgreSQL and atomically
     updates the index alias. This requires that the index is aliased already,
     and will raise an error if it is not.
+
+    If a reindex is interrupted, it can be continued from where it got to
+    with --resume.
     """
 
     os.environ['ELASTICSEARCH_CLIENT_TIMEOUT'] = '30'
 
-    request = ctx.obj['bootstrap']()
+    bootstrap = ctx.obj['bootstrap']
+    request = bootstrap()
 
-    indexer.reindex(request.db, request.es, request)
+    try:
+        indexer.reindex(request.db, request.es, request,
+                        parallel=parallel, bootstrap=bootstrap, resume=resume)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
 
 
 @search.command('update-settings')
@@ -47,4 +59,4 @@ def update_settings(ctx):
     try:
         config.update_index_settings(request.es)
     except RuntimeError as e:
-        raise click.ClickException(e.message)
+        raise click.ClickException(str(e))
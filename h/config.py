@@ -79,11 +79,58 @@ SETTINGS = [
     EnvSetting('h.env', 'ENV'),
     # Where should logged-out users visiting the homepage be redirected?
     EnvSetting('h.homepage_redirect_url', 'HOMEPAGE_REDIRECT_URL'),
+    # Enqueue search index updates for the batching indexer task
+    # (h.tasks.indexer.sync_annotation) rather than one task per update.
+    #
+    # The task itself is configured by environment variables which are read
+    # when h.tasks.indexer is imported, because the batch size and interval
+    # are arguments of the task's definition, which exists before these
+    # settings are loaded:
+    #
+    # - INDEXER_BATCH_SIZE: the maximum number of messages per batch (100).
+    # - INDEXER_BATCH_WAIT: how long, in seconds, to wait for a batch to fill
+    #   before processing it anyway (1).
+    # - INDEXER_THREAD_ROOT_DELAY: how long, in seconds, to delay reindexing a
+    #   thread root after one of its replies has been indexed (10).
+    #
+    # Workers consuming the indexer queue must also prefetch at least a batch
+    # of messages: their concurrency multiplied by the
+    # CELERYD_PREFETCH_MULTIPLIER environment variable (1, see h.celery) must
+    # be at least INDEXER_BATCH_SIZE, or the worker refuses to start.
+    EnvSetting('h.indexer.batch', 'INDEXER_BATCH', type=asbool),
     EnvSetting('h.proxy_auth', 'PROXY_AUTH', type=asbool),
+    # Include presented annotations in realtime messages, so that the
+    # streamer doesn't need to fetch them from the database.
+    EnvSetting('h.realtime.embed_annotations', 'REALTIME_EMBED_ANNOTATIONS',
+               type=asbool),
+    # Route annotation events through a topic exchange, so that each
+    # streamer only receives the events its sockets are subscribed to.
+    EnvSetting('h.realtime.topic_exchange', 'REALTIME_TOPIC_EXCHANGE',
+               type=asbool),
+    # Present search API results from the annotations' documents in the search
+    # index, rather than loading the annotations from the database. This also
+    # stores the annotations' extra fields in the index, so the index's
+    # mapping must be updated first, with `hypothesis search update-settings`
+    # or a reindex. Annotations indexed without their extra fields are still
+    # loaded from the database until they are reindexed.
+    EnvSetting('h.search.present_from_source', 'SEARCH_PRESENT_FROM_SOURCE',
+               type=asbool),
     # Sentry DSNs for frontend code should be of the public kind, lacking the
     # password component in the DSN URI.
     EnvSetting('h.sentry_dsn_client', 'SENTRY_DSN_CLIENT'),
     EnvSetting('h.sentry_dsn_frontend', 'SENTRY_DSN_FRONTEND'),
+    # Number (and maximum total size in bytes) of recent annotation events to
+    # keep for reconnecting websocket clients to resume from.
+    EnvSetting('h.streamer.history_size', 'STREAMER_HISTORY_SIZE', type=int),
+    EnvSetting('h.streamer.history_max_bytes', 'STREAMER_HISTORY_MAX_BYTES',
+               type=int),
+    # Maximum number of messages queued for each websocket client, and what
+    # to do when it's reached ("drop" or "disconnect").
+    EnvSetting('h.streamer.outbox_size', 'STREAMER_OUTBOX_SIZE', type=int),
+    EnvSetting('h.streamer.slow_client_policy', 'STREAMER_SLOW_CLIENT_POLICY'),
+    # Number of greenlets processing streamer messages in each websocket
+    # worker process.
+    EnvSetting('h.streamer.workers', 'STREAMER_WORKERS', type=int),
     EnvSetting('h.websocket_url', 'WEBSOCKET_URL'),
 
     # Debug/development settings
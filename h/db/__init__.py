@@ -65,9 +65,14 @@ def init(engine, base=Base, should_create=False, should_drop=False, authority=No
     _maybe_create_world_group(engine, authority)
 
 
-def make_engine(settings):
-    """Construct a sqlalchemy engine from the passed ``settings``."""
-    return sqlalchemy.create_engine(settings['sqlalchemy.url'])
+def make_engine(settings, **kwargs):
+    """
+    Construct a sqlalchemy engine from the passed ``settings``.
+
+    Any additional keyword arguments are passed to
+    :py:func:`sqlalchemy.create_engine`.
+    """
+    return sqlalchemy.create_engine(settings['sqlalchemy.url'], **kwargs)
 
 
 def _session(request):
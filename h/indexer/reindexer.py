@@ -1,47 +1,204 @@
 # -*- coding: utf-8 -*-
 
+from __future__ import division
+
+import datetime
+import json
 import logging
+import multiprocessing
+import time
 
 from h.search.config import (
     configure_index,
     get_aliased_index,
     update_aliased_index,
 )
-from h.search.index import BatchIndexer
+from h.search.index import BatchIndexer, Window, partition
+from h.util.datetime import parse_utc_iso8601, utc_iso8601
 
 log = logging.getLogger(__name__)
 
 SETTING_NEW_INDEX = u'reindex.new_index'
+SETTING_CHECKPOINT = u'reindex.checkpoint'
+
+#: The number of windows which a reindex is split into. The windows which have
+#: been indexed are recorded, so that an interrupted reindex can be resumed,
+#: and the windows are shared out between the worker processes of a parallel
+#: reindex.
+WINDOW_COUNT = 100
+
+# The bootstrapped request of a parallel reindex worker process.
+_worker_request = None
+
+
+def reindex(session, es, request, parallel=1, bootstrap=None, resume=False):
+    """
+    Reindex all annotations into a new index, and update the alias.
 
+    The annotations are split into windows by their last updated times. With
+    `parallel` greater than 1, the windows are indexed by a pool of `parallel`
+    worker processes. Each process bootstraps its own request, and so has its
+    own database connection and Elasticsearch client, by calling `bootstrap`.
 
-def reindex(session, es, request):
-    """Reindex all annotations into a new index, and update the alias."""
+    Each indexed window is recorded in the settings. With `resume`, a reindex
+    which was interrupted is continued into its index: the windows which it
+    didn't index are indexed, and then the annotations which changed since it
+    started are reindexed, as it can't have kept them up to date while it
+    wasn't running. See :py:meth:`h.search.index.BatchIndexer.catch_up` for
+    the changes which this doesn't catch up on.
+    """
 
     if get_aliased_index(es) is None:
         raise RuntimeError('cannot reindex if current index is not aliased')
 
     settings = request.find_service(name='settings')
 
-    new_index = configure_index(es)
+    if resume:
+        checkpoint = _load_checkpoint(settings)
+        if not es.conn.indices.exists(index=checkpoint['index']):
+            raise RuntimeError('cannot resume reindex as index {} does not exist'
+                               .format(checkpoint['index']))
+        log.info('resuming reindex into {} with {:d}/{:d} windows indexed'
+                 .format(checkpoint['index'],
+                         len(checkpoint['done']),
+                         len(checkpoint['windows'])))
+    else:
+        started = datetime.datetime.utcnow()
+        windows, total = partition(session, WINDOW_COUNT)
+        checkpoint = {'index': configure_index(es),
+                      'started': started,
+                      'total': total,
+                      'windows': windows,
+                      'done': []}
+    new_index = checkpoint['index']
 
     try:
         settings.put(SETTING_NEW_INDEX, new_index)
+        _save_checkpoint(settings, checkpoint)
         request.tm.commit()
 
         indexer = BatchIndexer(session, es, request, target_index=new_index, op_type='create')
 
-        errored = indexer.index()
-        if errored:
-            log.debug('failed to index {} annotations, retrying...'.format(
-                len(errored)))
-            errored = indexer.index(errored)
-            if errored:
-                log.warn('failed to index {} annotations: {!r}'.format(
-                    len(errored),
-                    errored))
+        jobs = [(new_index, i, window)
+                for i, window in enumerate(checkpoint['windows'])
+                if i not in checkpoint['done']]
+        if parallel > 1:
+            window_size = checkpoint['total'] / len(checkpoint['windows'])
+            results = _parallel_index(bootstrap, jobs, parallel, window_size)
+        else:
+            results = (_index(session, es, request, job) for job in jobs)
+
+        errored = set()
+        for i, window_errored in results:
+            # Windows with errors are left to be indexed again if this
+            # reindex is interrupted before they are retried.
+            if window_errored:
+                errored.update(window_errored)
+                continue
+            checkpoint['done'].append(i)
+            _save_checkpoint(settings, checkpoint)
+            request.tm.commit()
+
+        _retry(indexer, errored)
+
+        if resume:
+            # Annotations which were updated since the reindex started need
+            # reindexing, as they may be stale, or missing from the index.
+            indexer = BatchIndexer(session, es, request, target_index=new_index)
+            _retry(indexer, indexer.catch_up(checkpoint['started']))
 
         update_aliased_index(es, new_index)
 
+        settings.delete(SETTING_CHECKPOINT)
+
     finally:
         settings.delete(SETTING_NEW_INDEX)
         request.tm.commit()
+
+
+def _retry(indexer, errored):
+    if errored:
+        log.debug('failed to index {} annotations, retrying...'.format(
+            len(errored)))
+        errored = indexer.index(errored)
+        if errored:
+            log.warn('failed to index {} annotations: {!r}'.format(
+                len(errored),
+                errored))
+
+
+def _parallel_index(bootstrap, jobs, parallel, window_size):
+    """Index the windows of `jobs` using a process pool."""
+    log.info('indexing {:d} windows with {:d} processes'
+             .format(len(jobs), parallel))
+
+    pool = multiprocessing.Pool(processes=parallel,
+                                initializer=_init_worker,
+                                initargs=(bootstrap,))
+    try:
+        then = time.time()
+        for done, result in enumerate(pool.imap_unordered(_index_window, jobs), 1):
+            yield result
+
+            # The windows are of about equal size, so the number of indexed
+            # annotations is estimated from the number of indexed windows.
+            indexed = int(done * window_size)
+            rate = indexed / (time.time() - then)
+            log.info('indexed {:d}/{:d} windows (~{:d}k annotations), rate={:.0f}/s'
+                     .format(done, len(jobs), indexed // 1000, rate))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _init_worker(bootstrap):
+    global _worker_request
+    _worker_request = bootstrap()
+
+
+def _index_window(job):
+    request = _worker_request
+    try:
+        return _index(request.db, request.es, request, job)
+    finally:
+        request.tm.abort()
+
+
+def _index(session, es, request, job):
+    target_index, i, window = job
+    indexer = BatchIndexer(session, es, request,
+                           target_index=target_index, op_type='create')
+    return i, indexer.index(window=window)
+
+
+def _load_checkpoint(settings):
+    value = settings.get(SETTING_CHECKPOINT)
+    if value is None:
+        raise RuntimeError('cannot resume reindex as there is none to resume')
+
+    data = json.loads(value)
+    return {'index': data['index'],
+            'started': parse_utc_iso8601(data['started']),
+            'total': data['total'],
+            'windows': [Window(*[_parse_bound(b) for b in bounds])
+                        for bounds in data['windows']],
+            'done': data['done']}
+
+
+def _save_checkpoint(settings, checkpoint):
+    data = {'index': checkpoint['index'],
+            'started': utc_iso8601(checkpoint['started']),
+            'total': checkpoint['total'],
+            'windows': [[_format_bound(b) for b in window]
+                        for window in checkpoint['windows']],
+            'done': checkpoint['done']}
+    settings.put(SETTING_CHECKPOINT, json.dumps(data))
+
+
+def _format_bound(bound):
+    return None if bound is None else utc_iso8601(bound)
+
+
+def _parse_bound(bound):
+    return None if bound is None else parse_utc_iso8601(bound)
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from h.tasks.indexer import add_annotation, delete_annotation
+from pyramid.settings import asbool
+
+from h.tasks.indexer import add_annotation, delete_annotation, sync_annotation
 
 
 def subscribe_annotation_event(event):
-    if event.action in ['create', 'update']:
+    if asbool(event.request.registry.settings.get('h.indexer.batch')):
+        sync_annotation.delay(event.annotation_id, event.action)
+    elif event.action in ['create', 'update']:
         add_annotation.delay(event.annotation_id)
     elif event.action == 'delete':
         delete_annotation.delay(event.annotation_id)
@@ -0,0 +1,31 @@
+"""
+Add scheduled_thread_root table
+
+Revision ID: b4e2a1c9d3f7
+Revises: ce7d8fb3159d
+Create Date: 2026-10-18 20:12:41.208614
+"""
+
+from __future__ import unicode_literals
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = 'b4e2a1c9d3f7'
+down_revision = 'ce7d8fb3159d'
+
+
+def upgrade():
+    op.create_table('scheduled_thread_root',
+                    sa.Column('annotation_id',
+                              postgresql.UUID(),
+                              primary_key=True),
+                    sa.Column('scheduled',
+                              sa.DateTime,
+                              nullable=False))
+
+
+def downgrade():
+    op.drop_table('scheduled_thread_root')
@@ -0,0 +1,37 @@
+"""
+Add (updated, id) indexes for keyset pagination
+
+Replace the indexes on annotation.updated, document_uri.updated and
+document_meta.updated with ones on (updated, id), which keyset pagination
+over these tables in updated order can use.
+
+Revision ID: ce7d8fb3159d
+Revises: 1c995723a271
+Create Date: 2026-10-18 12:00:00.000000
+"""
+
+from __future__ import unicode_literals
+
+from alembic import op
+
+revision = 'ce7d8fb3159d'
+down_revision = '1c995723a271'
+
+TABLES = ['annotation', 'document_uri', 'document_meta']
+
+
+def upgrade():
+    # Creating an index concurrently must happen outside a transaction.
+    op.execute('COMMIT')
+    for table in TABLES:
+        op.create_index(op.f('ix__{}_updated_id'.format(table)), table, ['updated', 'id'],
+                        postgresql_concurrently=True)
+        op.drop_index(op.f('ix__{}_updated'.format(table)), table)
+
+
+def downgrade():
+    op.execute('COMMIT')
+    for table in TABLES:
+        op.create_index(op.f('ix__{}_updated'.format(table)), table, ['updated'],
+                        postgresql_concurrently=True)
+        op.drop_index(op.f('ix__{}_updated_id'.format(table)), table)
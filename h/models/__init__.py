@@ -29,6 +29,7 @@ from h.models.feature import Feature
 from h.models.feature_cohort import FeatureCohort
 from h.models.flag import Flag
 from h.models.group import Group
+from h.models.scheduled_thread_root import ScheduledThreadRoot
 from h.models.setting import Setting
 from h.models.subscriptions import Subscriptions
 from h.models.token import Token
@@ -48,6 +49,7 @@ __all__ = (
     'FeatureCohort',
     'Flag',
     'Group',
+    'ScheduledThreadRoot',
     'Setting',
     'Subscriptions',
     'Token',
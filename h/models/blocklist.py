@@ -1,9 +1,29 @@
 # -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import logging
+import re
+import time
+
 import sqlalchemy as sa
 from sqlalchemy.sql import expression
 
 from h.db import Base
 
+log = logging.getLogger(__name__)
+
+#: How often the compiled blocklist is reloaded from the database (in
+#: seconds), to pick up changes made by other processes.
+REFRESH_INTERVAL = 60
+
+#: The escape character in SQL ``LIKE`` patterns (PostgreSQL's default).
+LIKE_ESCAPE = '\\'
+
+_ANY_SEQUENCE = object()
+_ANY_CHARACTER = object()
+_WILDCARDS = {'%': _ANY_SEQUENCE, '_': _ANY_CHARACTER}
+
 
 class Blocklist(Base):
 
@@ -12,6 +32,9 @@ class Blocklist(Base):
     This means that the Chrome extension will never show a number of
     annotations on its badge for these URIs.
 
+    The URIs are SQL ``LIKE`` patterns, so ``%`` matches any sequence of
+    characters and ``_`` matches any single character.
+
     """
 
     __tablename__ = 'blocklist'
@@ -25,5 +48,151 @@ class Blocklist(Base):
     @classmethod
     def is_blocked(cls, session, uri):
         """Return True if the given URI is blocked."""
+        return COMPILED_BLOCKLIST.matcher(session).matches(uri)
+
+    @classmethod
+    def is_blocked_in_db(cls, session, uri):
+        """
+        Return True if the given URI is blocked, checking in the database.
+
+        This is equivalent to :py:meth:`is_blocked`, but has every pattern
+        evaluated by the database.
+        """
         uri_matches = expression.literal(uri).like(cls.uri)
         return session.query(cls).filter(uri_matches).count() > 0
+
+
+class BlocklistMatcher(object):
+
+    """
+    A set of blocklist patterns compiled for matching in Python.
+
+    URIs are matched with the same semantics as the SQL ``LIKE`` operator in
+    PostgreSQL. Patterns without wildcards are looked up in a set, patterns
+    whose only wildcards are at the end are matched by looking up the URI's
+    prefixes in a set, and all other patterns are combined into one regular
+    expression.
+
+    Patterns which end with an escape character are ignored, as they are
+    invalid in PostgreSQL.
+    """
+
+    def __init__(self, patterns):
+        self._exact = set()
+        self._prefixes = set()
+        self._prefix_lengths = set()
+        regexes = []
+
+        for pattern in patterns:
+            try:
+                tokens = _parse_like_pattern(pattern)
+            except ValueError:
+                log.warn('ignoring invalid blocklist pattern: %r', pattern)
+                continue
+
+            # The index of the first wildcard, if there is one, which is after
+            # the leading literal, if there is one.
+            start = 1 if tokens and not _is_wildcard(tokens[0]) else 0
+
+            if start == len(tokens):
+                self._exact.add(''.join(tokens))
+            elif all(t is _ANY_SEQUENCE for t in tokens[start:]):
+                prefix = tokens[0] if start else ''
+                self._prefixes.add(prefix)
+                self._prefix_lengths.add(len(prefix))
+            else:
+                regexes.append(_like_tokens_to_regex(tokens))
+
+        self._regex = None
+        if regexes:
+            self._regex = re.compile('(?:{})\\Z'.format('|'.join(regexes)),
+                                     re.DOTALL | re.UNICODE)
+
+    def matches(self, uri):
+        """Return True if `uri` matches any of the patterns."""
+        if uri in self._exact:
+            return True
+        for length in self._prefix_lengths:
+            if len(uri) >= length and uri[:length] in self._prefixes:
+                return True
+        if self._regex is not None and self._regex.match(uri):
+            return True
+        return False
+
+
+class CompiledBlocklist(object):
+
+    """
+    The process-wide compiled blocklist.
+
+    The blocklist is loaded on first use, reloaded every `refresh_interval`
+    seconds, and can be reloaded sooner by calling :py:meth:`invalidate`
+    after changing it.
+    """
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL, clock=time.time):
+        self.refresh_interval = refresh_interval
+        self._clock = clock
+        self._matcher = None
+        self._expires = 0
+
+    def matcher(self, session):
+        """Return the compiled blocklist, (re)loading it using `session` if needed."""
+        if self._matcher is None or self._clock() >= self._expires:
+            patterns = [uri for (uri,) in session.query(Blocklist.uri)]
+            self._matcher = BlocklistMatcher(patterns)
+            self._expires = self._clock() + self.refresh_interval
+        return self._matcher
+
+    def invalidate(self):
+        """Reload the blocklist the next time it is used."""
+        self._matcher = None
+
+
+COMPILED_BLOCKLIST = CompiledBlocklist()
+
+
+def _parse_like_pattern(pattern):
+    """
+    Split a ``LIKE`` pattern into literal strings and wildcards.
+
+    Returns a list in which each item is either :py:data:`_ANY_SEQUENCE`,
+    :py:data:`_ANY_CHARACTER` or a non-empty literal string, with adjacent
+    literals merged. Raises ValueError if the pattern ends with an escape
+    character.
+    """
+    tokens = []
+    literal = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == LIKE_ESCAPE:
+            try:
+                literal.append(next(chars))
+            except StopIteration:
+                raise ValueError('LIKE pattern must not end with escape character')
+        elif char in _WILDCARDS:
+            if literal:
+                tokens.append(''.join(literal))
+                literal = []
+            tokens.append(_WILDCARDS[char])
+        else:
+            literal.append(char)
+    if literal:
+        tokens.append(''.join(literal))
+    return tokens
+
+
+def _is_wildcard(token):
+    return token is _ANY_SEQUENCE or token is _ANY_CHARACTER
+
+
+def _like_tokens_to_regex(tokens):
+    parts = []
+    for token in tokens:
+        if token is _ANY_SEQUENCE:
+            parts.append('.*')
+        elif token is _ANY_CHARACTER:
+            parts.append('.')
+        else:
+            parts.append(re.escape(token))
+    return '(?:{})'.format(''.join(parts))
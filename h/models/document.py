@@ -13,10 +13,21 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from h._compat import urlparse
 from h.db import Base, mixins
 from h.models.annotation import Annotation
+from h.util.cache import ExpiringLRUCache
 from h.util.uri import normalize as uri_normalize
 
 log = logging.getLogger(__name__)
 
+#: A process-wide cache of the URIs of the document matching a normalized URI,
+#: used by :py:func:`h.storage.expand_uri`. Each value is a tuple of
+#: ``(uri, type)`` pairs, which is empty if no document matches.
+#:
+#: Entries are invalidated when documents are updated or merged in this
+#: process, both at the time and once the change is committed, and expire
+#: after a few minutes to bound how long changes made by other processes go
+#: unnoticed.
+DOCUMENT_URIS_CACHE = ExpiringLRUCache(maxsize=10000, ttl=300)
+
 
 class ConcurrentUpdateError(transaction.interfaces.TransientError):
     """Raised when concurrent updates to document data conflict."""
@@ -134,7 +145,7 @@ class DocumentURI(Base, mixins.Timestamps):
                             'type',
                             'content_type'),
         sa.Index('ix__document_uri_document_id', 'document_id'),
-        sa.Index('ix__document_uri_updated', 'updated'),
+        sa.Index('ix__document_uri_updated_id', 'updated', 'id'),
     )
 
     id = sa.Column(sa.Integer, autoincrement=True, primary_key=True)
@@ -202,7 +213,7 @@ class DocumentMeta(Base, mixins.Timestamps):
     __table_args__ = (
         sa.UniqueConstraint('claimant_normalized', 'type'),
         sa.Index('ix__document_meta_document_id', 'document_id'),
-        sa.Index('ix__document_meta_updated', 'updated'),
+        sa.Index('ix__document_meta_updated_id', 'updated', 'id'),
     )
 
     id = sa.Column(sa.Integer, autoincrement=True, primary_key=True)
@@ -431,6 +442,8 @@ def merge_documents(session, documents, updated=None):
     except sa.exc.IntegrityError:
         raise ConcurrentUpdateError('concurrent document merges')
 
+    _invalidate_cached_uris(session, master)
+
     return master
 
 
@@ -506,4 +519,25 @@ def update_document_metadata(session,
             updated=updated,
             **document_meta_dict)
 
+    _invalidate_cached_uris(session, document)
+
     return document
+
+
+def _invalidate_cached_uris(session, document):
+    """
+    Remove the cached expansions of all of `document`'s URIs.
+
+    This must be called once all of the document's URIs, including any which
+    have been added or moved to it from merged documents, are in its
+    `document_uris`.
+
+    Until `session` commits, other requests still see the document as it was,
+    and may cache its old URIs again. So they're invalidated again once the
+    session next commits.
+    """
+    uris = [docuri.uri_normalized for docuri in document.document_uris]
+    DOCUMENT_URIS_CACHE.invalidate(uris)
+    sa.event.listen(session, 'after_commit',
+                    lambda _: DOCUMENT_URIS_CACHE.invalidate(uris),
+                    once=True)
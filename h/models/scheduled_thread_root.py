@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import datetime
+
+import sqlalchemy as sa
+
+from h.db import Base
+from h.db import types
+
+
+class ScheduledThreadRoot(Base):
+
+    """
+    A thread root which has been scheduled to be reindexed.
+
+    This is shared by all the processes which index annotations, so that each
+    thread root is scheduled to be reindexed at most once in a given interval,
+    however many of its replies are indexed and by whichever processes.
+    """
+
+    __tablename__ = 'scheduled_thread_root'
+
+    #: The id of the thread root annotation
+    annotation_id = sa.Column(types.URLSafeUUID, primary_key=True)
+
+    #: When the thread root was last scheduled to be reindexed
+    scheduled = sa.Column(sa.DateTime, nullable=False)
+
+    @classmethod
+    def claim(cls, engine, annotation_id, interval):
+        """
+        Claim the scheduling of a reindex of thread root `annotation_id`.
+
+        Returns True if the root hasn't been scheduled in the last `interval`
+        seconds, in which case it's now recorded as scheduled and the caller
+        should schedule it, and False otherwise.
+
+        The claim is made in its own transactions on `engine`, which are
+        committed at once, so that it's seen by other processes straight away
+        and isn't undone if the caller's transaction is rolled back.
+        """
+        table = cls.__table__
+        now = datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(seconds=interval)
+
+        with engine.begin() as conn:
+            result = conn.execute(table.update()
+                                  .where(table.c.annotation_id == annotation_id)
+                                  .where(table.c.scheduled <= cutoff)
+                                  .values(scheduled=now))
+            if result.rowcount:
+                return True
+
+        # Either the root has been scheduled recently or it has never been
+        # scheduled. The unique annotation_id means only one process can
+        # insert it, even if others are trying to at the same time.
+        try:
+            with engine.begin() as conn:
+                conn.execute(table.insert().values(annotation_id=annotation_id,
+                                                   scheduled=now))
+        except sa.exc.IntegrityError:
+            return False
+        return True
+
+    def __repr__(self):
+        return '<ScheduledThreadRoot annotation_id=%s>' % self.annotation_id
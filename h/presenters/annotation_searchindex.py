@@ -2,8 +2,11 @@
 
 from __future__ import unicode_literals
 
+from collections import namedtuple
+
 from h.presenters.annotation_base import AnnotationBasePresenter
 from h.presenters.document_searchindex import DocumentSearchIndexPresenter
+from h.util.datetime import parse_utc_iso8601
 
 
 class AnnotationSearchIndexPresenter(AnnotationBasePresenter):
@@ -44,3 +47,98 @@ class AnnotationSearchIndexPresenter(AnnotationBasePresenter):
         # The search index presenter has no need to generate links, and so the
         # `links_service` parameter has been removed from the constructor.
         raise NotImplementedError("search index presenter doesn't have links")
+
+
+class IndexedAnnotation(object):
+
+    """
+    An annotation loaded from the search index rather than the database.
+
+    This has the attributes of :py:class:`h.models.Annotation` needed to
+    present the annotation in the API, read from the annotation's document in
+    the search index (its ``_source``), as presented by
+    :py:class:`AnnotationSearchIndexPresenter` and
+    :py:func:`h.search.subscribers.add_extra`.
+    """
+
+    #: Deleted annotations aren't removed from the search index, but their
+    #: documents are replaced with one which only has a ``deleted`` field.
+    #: Searches filter them out (see :py:class:`h.search.query.DeletedFilter`),
+    #: and such a document isn't complete enough to be presented anyway, so an
+    #: annotation loaded from the index is never deleted.
+    deleted = False
+
+    def __init__(self, id_, source):
+        target = source['target'][0]
+
+        self.id = id_
+        self.created = _parse_timestamp(source.get('created'))
+        self.updated = _parse_timestamp(source.get('updated'))
+        self.userid = source['user']
+        self.groupid = source['group']
+        self.shared = source['shared']
+        self.target_uri = target['source']
+        self.target_uri_normalized = target['scope'][0]
+        self.target_selectors = target.get('selector', [])
+        self.text = source.get('text')
+        self.tags = source.get('tags')
+        self.references = source.get('references', [])
+        self.extra = source['extra']
+        self.document = IndexedDocument.from_source(source.get('document'))
+
+    @staticmethod
+    def is_complete(source):
+        """
+        Return True if `source` has everything needed to present the annotation.
+
+        Annotations indexed before the search index had everything needed
+        (and not reindexed since) have to be loaded from the database instead.
+        """
+        return 'extra' in source
+
+    @property
+    def is_reply(self):
+        return bool(self.references)
+
+    @property
+    def parent_id(self):
+        if self.references:
+            return self.references[-1]
+
+    @property
+    def thread_root_id(self):
+        if self.references:
+            return self.references[0]
+        return self.id
+
+
+IndexedDocumentURI = namedtuple('IndexedDocumentURI', ['uri'])
+
+
+class IndexedDocument(object):
+
+    """
+    A document loaded from an annotation's document in the search index.
+
+    Only the document's title and web URI are indexed, so the web URI is its
+    only document URI.
+    """
+
+    def __init__(self, title, web_uri):
+        self.title = title
+        self.web_uri = web_uri
+        self.document_uris = [IndexedDocumentURI(web_uri)] if web_uri else []
+
+    @classmethod
+    def from_source(cls, source):
+        """Return the document for `source`, or None if there isn't one."""
+        if not source:
+            return None
+        titles = source.get('title')
+        return cls(title=titles[0] if titles else None,
+                   web_uri=source.get('web_uri'))
+
+
+def _parse_timestamp(timestamp):
+    if timestamp:
+        return parse_utc_iso8601(timestamp)
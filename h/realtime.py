@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import base64
+import hashlib
 import random
+import re
 import struct
 from datetime import datetime
 
 import kombu
 from kombu.mixins import ConsumerMixin
 from kombu.pools import producers as producer_pool
+from pyramid.settings import asbool
+
+from h.util.text import uni_fold
+
+# Characters which may appear unmodified in a segment of a topic routing key.
+# Any other value is replaced by its hash.
+ROUTING_SEGMENT_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
 
 
 class Consumer(ConsumerMixin):
@@ -21,6 +30,11 @@ class Consumer(ConsumerMixin):
     :param routing_key: listen to messages with this routing key
     :param handler: the function which gets called when a messages arrives
     :param sentry_client: an optional Sentry client for error reporting
+    :param exchange: the exchange to consume from, if not the default
+    :param binding_keys: an optional callable returning the set of routing
+        keys to bind the queue to. If given, the bindings are kept up to date
+        with its return value while the consumer runs, and `routing_key` is
+        used only to name the queue.
     """
 
     def __init__(self,
@@ -28,21 +42,55 @@ class Consumer(ConsumerMixin):
                  routing_key,
                  handler,
                  sentry_client=None,
-                 statsd_client=None):
+                 statsd_client=None,
+                 exchange=None,
+                 binding_keys=None):
         self.connection = connection
         self.routing_key = routing_key
         self.handler = handler
-        self.exchange = get_exchange()
+        self.exchange = exchange or get_exchange()
         self.sentry_client = sentry_client
         self.statsd_client = statsd_client
+        self.binding_keys = binding_keys
+        self._queue = None
+        self._bound_keys = frozenset()
 
     def get_consumers(self, consumer_factory, channel):
         name = self.generate_queue_name()
-        queue = kombu.Queue(name, self.exchange,
-                            durable=False,
-                            routing_key=self.routing_key,
-                            auto_delete=True)
-        return [consumer_factory(queues=[queue], callbacks=[self.handle_message])]
+        if self.binding_keys is None:
+            queue = kombu.Queue(name, self.exchange,
+                                durable=False,
+                                routing_key=self.routing_key,
+                                auto_delete=True)
+            return [consumer_factory(queues=[queue], callbacks=[self.handle_message])]
+
+        # The queue is declared with the bindings we want now, and these are
+        # updated on each iteration of the consumer's event loop.
+        self.exchange(channel).declare()
+        self._bound_keys = frozenset(self.binding_keys())
+        bindings = [kombu.binding(self.exchange, routing_key=key)
+                    for key in self._bound_keys]
+        self._queue = kombu.Queue(name,
+                                  bindings=bindings,
+                                  durable=False,
+                                  auto_delete=True,
+                                  channel=channel)
+        return [consumer_factory(queues=[self._queue], callbacks=[self.handle_message])]
+
+    def on_iteration(self):
+        """Update the queue's bindings if the binding keys have changed."""
+        if self._queue is None:
+            return
+
+        keys = self.binding_keys()
+        if keys is self._bound_keys or keys == self._bound_keys:
+            return
+
+        for key in keys - self._bound_keys:
+            self._queue.bind_to(self.exchange, key)
+        for key in self._bound_keys - keys:
+            self._queue.unbind_from(self.exchange, key)
+        self._bound_keys = frozenset(keys)
 
     def generate_queue_name(self):
         return 'realtime-{}-{}'.format(self.routing_key, self._random_id())
@@ -104,12 +152,24 @@ class Publisher(object):
     :param request: a `pyramid.request.Request`
     """
     def __init__(self, request):
-        self.connection = get_connection(request.registry.settings)
-        self.exchange = get_exchange()
+        settings = request.registry.settings
+        self.connection = get_connection(settings)
+        self.topic = use_topic_exchange(settings)
+        self.exchange = get_topic_exchange() if self.topic else get_exchange()
 
-    def publish_annotation(self, payload):
-        """Publish an annotation message with the routing key 'annotation'."""
-        self._publish('annotation', payload)
+    def publish_annotation(self, payload, groupid=None, uri=None):
+        """
+        Publish an annotation message.
+
+        The message is published with the routing key 'annotation'. If the
+        topic exchange is in use and the annotation's group and target URI are
+        given, it is instead published with a routing key derived from them
+        (see :py:func:`annotation_routing_key`).
+        """
+        routing_key = 'annotation'
+        if self.topic and groupid is not None and uri is not None:
+            routing_key = annotation_routing_key(groupid, uri)
+        self._publish(routing_key, payload)
 
     def publish_user(self, payload):
         """Publish a user message with the routing key 'user'."""
@@ -135,6 +195,69 @@ def get_exchange():
                           delivery_mode='transient')
 
 
+def get_topic_exchange():
+    """
+    Returns a configured `kombu.Exchange` to use for topic-routed realtime
+    messages.
+
+    This is a separate exchange from the one returned by
+    :py:func:`get_exchange`, as an existing exchange can't change its type.
+    """
+
+    return kombu.Exchange('realtime-topic',
+                          type='topic',
+                          durable=False,
+                          delivery_mode='transient')
+
+
+def use_topic_exchange(settings):
+    """Return whether realtime messages should use the topic exchange."""
+    return asbool(settings.get('h.realtime.topic_exchange', False))
+
+
+def annotation_routing_key(groupid, uri):
+    """
+    Return the topic routing key for an event about an annotation.
+
+    Keys are of the form ``annotation.<group>.<uri hash>``, so that consumers
+    can bind to the events for a particular group or URI (or both).
+    """
+    return 'annotation.{}.{}'.format(_group_segment(groupid), uri_hash(uri))
+
+
+def annotation_binding_key(groupid=None, uri=None):
+    """
+    Return a binding key matching events for the given group and/or URI.
+
+    If neither is given, the key matches all annotation events.
+    """
+    if groupid is None and uri is None:
+        return 'annotation.#'
+    group = '*' if groupid is None else _group_segment(groupid)
+    hash_ = '*' if uri is None else uri_hash(uri)
+    return 'annotation.{}.{}'.format(group, hash_)
+
+
+def uri_hash(uri):
+    """
+    Return a short hash of `uri` for use in routing keys.
+
+    URIs are case- and accent-folded first, as they are by streamer filters.
+    """
+    return _hash(uri)
+
+
+def _group_segment(groupid):
+    groupid = uni_fold(groupid)
+    if ROUTING_SEGMENT_PATTERN.match(groupid):
+        return groupid
+    return _hash(groupid)
+
+
+def _hash(value):
+    return hashlib.sha1(uni_fold(value).encode('utf-8')).hexdigest()[:16]
+
+
 def get_connection(settings):
     """Returns a `kombu.Connection` based on the application's settings."""
 
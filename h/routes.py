@@ -90,6 +90,7 @@ def includeme(config):
     config.add_route('api.search', '/api/search')
     config.add_route('api.users', '/api/users')
     config.add_route('badge', '/api/badge')
+    config.add_route('badges', '/api/badges')
     config.add_route('token', '/api/token')
 
     # Client
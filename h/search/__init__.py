@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from pyramid.settings import asbool
+
 from h.search.client import get_client
 from h.search.config import init
 from h.search.core import Search
@@ -31,6 +33,12 @@ def includeme(config):
     config.add_directive('get_search_matchers',
                          lambda c: c.registry[MATCHERS_KEY])
 
+    # Store the annotations' extra fields in the search index, so that search
+    # results can be presented from it.
+    if asbool(settings.get('h.search.present_from_source')):
+        config.add_subscriber('h.search.subscribers.add_extra',
+                              'h.events.AnnotationTransformEvent')
+
     # Add a property to all requests for easy access to the elasticsearch
     # client. This can be used for direct or bulk access without having to
     # reread the settings.
@@ -1,22 +1,47 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 from collections import namedtuple
 from contextlib import contextmanager
 
-from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
 
 from h.search import query
+from h.util.cache import ExpiringLRUCache
 
 FILTERS_KEY = 'h.search.filters'
 MATCHERS_KEY = 'h.search.matchers'
 
+# How long Elasticsearch should keep a scroll's search context alive between
+# fetching pages of results.
+SCROLL_TIMEOUT = '1m'
+
 log = logging.getLogger(__name__)
 
 SearchResult = namedtuple('SearchResult', [
     'total',
     'annotation_ids',
     'reply_ids',
-    'aggregations'])
+    'aggregations',
+    'cursor',
+    'sources'])
+# The cursor for the next page of results and the annotations' sources are
+# optional.
+SearchResult.__new__.__defaults__ = (None, None)
+
+
+#: Recent search results, for the searches which use the cache. These are
+#: keyed by the search query and the principals of the user searching.
+#:
+#: The cache is per process, and annotations are indexed by other processes,
+#: so results are never invalidated when annotations change. Instead they are
+#: only cached very briefly, which bounds how stale they can be.
+#:
+#: Results which include the annotations' sources can be large, so the cache
+#: is also limited by the total size of the results, taken to be the size of
+#: their keys and the results encoded as JSON. This underestimates the memory
+#: they take up, but grows with it.
+RESULTS_CACHE = ExpiringLRUCache(maxsize=10000, ttl=10, maxbytes=32 * 1024 * 1024)
 
 
 class Search(object):
@@ -34,12 +59,35 @@ class Search(object):
     :param stats: An optional statsd client to which some metrics will be
         published.
     :type stats: statsd.client.StatsClient
+
+    :param all_replies: Whether or not to return all of the replies when
+        `separate_replies` is True. By default only the first 200 replies are
+        returned, but with this set all of them are paged through using an
+        Elasticsearch scroll.
+    :type all_replies: bool
+
+    :param use_cache: Whether or not to return recent results of identical
+        searches by users with the same principals from :py:data:`RESULTS_CACHE`,
+        rather than searching again.
+    :type use_cache: bool
+
+    :param include_sources: Whether or not to return the annotations' documents
+        in the search index (their ``_source``) along with their ids, so that
+        they can be presented without loading them from the database. Replies
+        which are paged through when `all_replies` is True are returned
+        without their sources.
+    :type include_sources: bool
     """
-    def __init__(self, request, separate_replies=False, stats=None):
+    def __init__(self, request, separate_replies=False, stats=None, all_replies=False,
+                 use_cache=False, include_sources=False):
         self.request = request
         self.es = request.es
         self.separate_replies = separate_replies
         self.stats = stats
+        self.all_replies = all_replies
+        self.use_cache = use_cache
+        self.include_sources = include_sources
+        self._sources = {}
 
         self.builder = default_querybuilder(request)
         self.reply_builder = default_querybuilder(request)
@@ -54,10 +102,59 @@ class Search(object):
         :returns: The search results
         :rtype: SearchResult
         """
-        total, annotation_ids, aggregations = self.search_annotations(params)
-        reply_ids = self.search_replies(annotation_ids)
+        if not self.use_cache:
+            return self._run(params)
+
+        key = self._cache_key(params)
+        result = RESULTS_CACHE.get(key)
+        if result is None:
+            if self.stats:
+                self.stats.incr('search.cache.miss')
+            result = self._run(params)
+            RESULTS_CACHE.set(key, result, size=_result_size(key, result))
+        elif self.stats:
+            self.stats.incr('search.cache.hit')
+        return result
+
+    def _run(self, params):
+        if self.separate_replies:
+            total, annotation_ids, aggregations, reply_ids, cursor = \
+                self.search_annotations_and_replies(params)
+        else:
+            total, annotation_ids, aggregations, cursor = self.search_annotations(params)
+            reply_ids = self.search_replies(annotation_ids)
+
+        sources = None
+        if self.include_sources:
+            sources = {id_: self._sources[id_]
+                       for id_ in annotation_ids + reply_ids
+                       if id_ in self._sources}
+
+        return SearchResult(total, annotation_ids, reply_ids, aggregations, cursor,
+                            sources)
+
+    def count(self, params_list):
+        """
+        Count the annotations matching each of several sets of search params.
+
+        All the counts are done in a single Elasticsearch multi-search request,
+        which doesn't fetch any of the matching annotations.
+
+        :param params_list: the search parameters for each count
+        :type params_list: list of dict-like
+
+        :returns: the number of matching annotations for each set of params
+        :rtype: list of int
+        """
+        bodies = []
+        for params in params_list:
+            body = self.builder.build(params)
+            bodies.append({'query': body['query'], 'size': 0})
+
+        with self._instrument():
+            responses = self._msearch(bodies)
 
-        return SearchResult(total, annotation_ids, reply_ids, aggregations)
+        return [response['hits']['total'] for response in responses]
 
     def append_filter(self, filter_):
         """Append a search filter to the annotation and reply query."""
@@ -80,12 +177,58 @@ class Search(object):
         with self._instrument():
             response = self.es.conn.search(index=self.es.index,
                                            doc_type=self.es.t.annotation,
-                                           _source=False,
+                                           _source=self.include_sources,
                                            body=self.builder.build(params))
+        self._add_sources(response['hits']['hits'])
         total = response['hits']['total']
         annotation_ids = [hit['_id'] for hit in response['hits']['hits']]
         aggregations = self._parse_aggregation_results(response.get('aggregations', None))
-        return (total, annotation_ids, aggregations)
+        cursor = query.next_cursor(params, response['hits']['hits'])
+        return (total, annotation_ids, aggregations, cursor)
+
+    def search_annotations_and_replies(self, params):
+        """
+        Search for top-level annotations and their replies.
+
+        The top-level annotations are searched for together with the replies
+        matching the same search parameters, in one multi-search request.
+        This finds all the replies to the annotations in the usual case of a
+        page's annotations, whose replies are on the same page. Each
+        top-level annotation's `thread_ids` are checked against the replies
+        found, and if any of them may be missing the replies are searched for
+        again with :py:meth:`search_replies`.
+
+        :returns: the total, annotation ids, aggregations, reply ids and the
+            cursor for the next page
+        :rtype: tuple
+        """
+        self.builder.append_filter(query.TopLevelAnnotationsFilter())
+
+        annotations_body = self.builder.build(params)
+        if not self.include_sources:
+            annotations_body['_source'] = ['thread_ids']
+
+        with self._instrument():
+            annotations_response, replies_response = self._msearch(
+                [annotations_body, self._page_replies_query(params)])
+        self._add_sources(annotations_response['hits']['hits'])
+        self._add_sources(replies_response['hits']['hits'])
+
+        total = annotations_response['hits']['total']
+        annotation_ids = [hit['_id'] for hit in annotations_response['hits']['hits']]
+        aggregations = self._parse_aggregation_results(
+            annotations_response.get('aggregations', None))
+        cursor = query.next_cursor(params, annotations_response['hits']['hits'])
+
+        reply_ids = _replies_to(annotation_ids,
+                                annotations_response['hits'],
+                                replies_response['hits'])
+        if reply_ids is None:
+            if self.stats:
+                self.stats.incr('search.replies.fallback')
+            reply_ids = self.search_replies(annotation_ids)
+
+        return (total, annotation_ids, aggregations, reply_ids, cursor)
 
     def search_replies(self, annotation_ids):
         if not self.separate_replies:
@@ -93,12 +236,16 @@ class Search(object):
 
         self.reply_builder.append_matcher(query.RepliesMatcher(annotation_ids))
 
+        if self.all_replies:
+            return list(self._scroll(self.reply_builder.build({'limit': query.LIMIT_MAX})))
+
         response = None
         with self._instrument():
             response = self.es.conn.search(index=self.es.index,
                                            doc_type=self.es.t.annotation,
-                                           _source=False,
-                                           body=self.reply_builder.build({'limit': 200}))
+                                           _source=self.include_sources,
+                                           body=self.reply_builder.build({'limit': query.LIMIT_MAX}))
+        self._add_sources(response['hits']['hits'])
 
         if len(response['hits']['hits']) < response['hits']['total']:
             log.warn("The number of reply annotations exceeded the page size "
@@ -108,6 +255,81 @@ class Search(object):
 
         return [hit['_id'] for hit in response['hits']['hits']]
 
+    def _page_replies_query(self, params):
+        """Return a query for the replies matching the search `params`."""
+        params = params.copy()
+        for key in ('offset', 'limit', 'sort', 'order', 'cursor'):
+            if key in params:
+                del params[key]
+        params['limit'] = query.LIMIT_MAX
+
+        body = self.reply_builder.build(params)
+        body['query'] = {
+            'filtered': {
+                'filter': {'exists': {'field': 'references'}},
+                'query': body['query'],
+            }
+        }
+        if not self.include_sources:
+            body['_source'] = ['references']
+        return body
+
+    def _add_sources(self, hits):
+        if self.include_sources:
+            for hit in hits:
+                if '_source' in hit:
+                    self._sources[hit['_id']] = hit['_source']
+
+    def _cache_key(self, params):
+        # The query depends on the params and on the user searching, through
+        # filters such as the AuthFilter, and the results also depend on which
+        # annotations the user is allowed to read.
+        body = self.builder.build(params)
+        principals = tuple(sorted(self.request.effective_principals))
+        return (json.dumps(body, sort_keys=True),
+                principals,
+                bool(self.separate_replies),
+                bool(self.all_replies),
+                bool(self.include_sources))
+
+    def _scroll(self, body):
+        """Yield the ids of all the hits for `body`, a page at a time."""
+        with self._instrument():
+            response = self.es.conn.search(index=self.es.index,
+                                           doc_type=self.es.t.annotation,
+                                           _source=False,
+                                           scroll=SCROLL_TIMEOUT,
+                                           body=body)
+        scroll_id = response.get('_scroll_id')
+
+        try:
+            while response['hits']['hits']:
+                for hit in response['hits']['hits']:
+                    yield hit['_id']
+                with self._instrument():
+                    response = self.es.conn.scroll(scroll_id=scroll_id,
+                                                   scroll=SCROLL_TIMEOUT)
+                scroll_id = response.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id is not None:
+                try:
+                    self.es.conn.clear_scroll(scroll_id=scroll_id)
+                except TransportError:
+                    log.warn('failed to clear search scroll', exc_info=True)
+
+    def _msearch(self, bodies):
+        """Run a search for each of `bodies` in one request, and return the responses."""
+        body = []
+        for b in bodies:
+            body.append({'index': self.es.index, 'type': self.es.t.annotation})
+            body.append(b)
+
+        responses = self.es.conn.msearch(body=body)['responses']
+        for response in responses:
+            if 'error' in response:
+                raise TransportError(response.get('status', 'N/A'), response['error'])
+        return responses
+
     def _parse_aggregation_results(self, aggregations):
         if not aggregations:
             return {}
@@ -145,6 +367,33 @@ class Search(object):
             s.send()
 
 
+def _replies_to(annotation_ids, annotation_hits, reply_hits):
+    """
+    Return the ids of the replies in `reply_hits` to `annotation_ids`.
+
+    Returns None if `reply_hits` may not include all of the replies, because
+    there were too many replies to return or because some of the replies in
+    the annotations' `thread_ids` weren't found.
+    """
+    if reply_hits['total'] > len(reply_hits['hits']):
+        return None
+
+    annotation_ids = set(annotation_ids)
+    found_ids = set()
+    reply_ids = []
+    for hit in reply_hits['hits']:
+        found_ids.add(hit['_id'])
+        references = hit.get('_source', {}).get('references', [])
+        if annotation_ids.intersection(references):
+            reply_ids.append(hit['_id'])
+
+    for hit in annotation_hits['hits']:
+        if not found_ids.issuperset(hit.get('_source', {}).get('thread_ids', [])):
+            return None
+
+    return reply_ids
+
+
 def default_querybuilder(request):
     builder = query.Builder()
     builder.append_filter(query.DeletedFilter())
@@ -159,3 +408,8 @@ def default_querybuilder(request):
     for factory in request.registry.get(MATCHERS_KEY, []):
         builder.append_matcher(factory(request))
     return builder
+
+
+def _result_size(key, result):
+    body, principals = key[:2]
+    return len(body) + sum(len(p) for p in principals) + len(json.dumps(result))
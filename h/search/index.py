@@ -3,18 +3,20 @@
 
 from __future__ import division, unicode_literals
 
+import itertools
 import logging
 import time
 from collections import namedtuple
 
 import sqlalchemy as sa
 from elasticsearch import helpers as es_helpers
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import subqueryload
 
 from h import models
 from h import presenters
 from h.events import AnnotationTransformEvent
-from h.util.query import column_windows
+from h.util.query import keyset_windows
 
 log = logging.getLogger(__name__)
 
@@ -26,6 +28,10 @@ class Window(namedtuple('Window', ['start', 'end'])):
     pass
 
 
+class _Deletion(namedtuple('_Deletion', ['id'])):
+    pass
+
+
 def index(es, annotation, request, target_index=None):
     """
     Index an annotation into the search index.
@@ -95,11 +101,13 @@ class BatchIndexer(object):
     the search index.
     """
 
-    def __init__(self, session, es_client, request, target_index=None, op_type='index'):
+    def __init__(self, session, es_client, request, target_index=None, op_type='index',
+                 chunk_size=ES_CHUNK_SIZE):
         self.session = session
         self.es_client = es_client
         self.request = request
         self.op_type = op_type
+        self.chunk_size = chunk_size
 
         # By default, index into the open index
         if target_index is None:
@@ -107,19 +115,24 @@ class BatchIndexer(object):
         else:
             self._target_index = target_index
 
-    def index(self, annotation_ids=None):
+    def index(self, annotation_ids=None, window=None):
         """
         Reindex annotations.
 
         :param annotation_ids: a list of ids to reindex, reindexes all when `None`.
         :type annotation_ids: collection
 
+        :param window: when reindexing all annotations, only reindex those
+            last updated in this window
+        :type window: h.search.index.Window
+
         :returns: a set of errored ids
         :rtype: set
         """
         if not annotation_ids:
             annotations = _all_annotations(session=self.session,
-                                           windowsize=PG_WINDOW_SIZE)
+                                           windowsize=PG_WINDOW_SIZE,
+                                           window=window)
         else:
             annotations = _filtered_annotations(session=self.session,
                                                 ids=annotation_ids)
@@ -127,8 +140,84 @@ class BatchIndexer(object):
         # Report indexing status as we go
         annotations = _log_status(annotations, log_every=PG_WINDOW_SIZE)
 
-        indexing = es_helpers.streaming_bulk(self.es_client.conn, annotations,
-                                             chunk_size=ES_CHUNK_SIZE,
+        return self._bulk(annotations)
+
+    def sync(self, annotations, deleted_ids=()):
+        """
+        Index already loaded annotations and mark others as deleted.
+
+        The documents for both are sent in the same stream of bulk requests.
+
+        :param annotations: the annotations to index
+        :type annotations: iterable of h.models.Annotation
+
+        :param deleted_ids: the ids of the annotations to mark as deleted
+        :type deleted_ids: iterable
+
+        :returns: a set of errored ids
+        :rtype: set
+        """
+        deletions = (_Deletion(id_) for id_ in deleted_ids)
+        return self._bulk(itertools.chain(annotations, deletions))
+
+    def catch_up(self, since):
+        """
+        Reindex the annotations which have changed since the given time.
+
+        These are the annotations which have been updated since then, the
+        thread roots of those which are replies, whose thread ids may have
+        changed, and the annotations which have been hidden by moderators since
+        then. Unlike :py:meth:`index`, this includes annotations which have
+        been deleted, which are marked as deleted in the index.
+
+        Changes which leave nothing in the database to find them by aren't
+        caught up on. These are annotations which have been unhidden, and the
+        annotations of users who have been flagged or unflagged as NIPSA. They
+        need reindexing separately, for example with the
+        ``reindex_user_annotations`` task for each user.
+
+        :param since: the time from which to reindex changed annotations
+        :type since: datetime.datetime
+
+        :returns: a set of errored ids
+        :rtype: set
+        """
+        log.info('catching up on annotations changed since {}'.format(since))
+
+        where = models.Annotation.updated >= since
+        windows = keyset_windows(session=self.session,
+                                 columns=[models.Annotation.updated, models.Annotation.id],
+                                 windowsize=PG_WINDOW_SIZE,
+                                 where=where)
+        query = _eager_loaded_annotations(self.session).filter(where)
+
+        errored = set()
+        caught_up = set()
+        related = set()
+        for window in windows:
+            annotations = query.filter(window).all()
+            errored.update(self._sync_all(annotations))
+            caught_up.update(a.id for a in annotations)
+            related.update(a.thread_root_id for a in annotations if a.is_reply)
+
+        hidden = self.session.query(models.AnnotationModeration.annotation_id) \
+            .filter(models.AnnotationModeration.created >= since)
+        related.update(id_ for id_, in hidden)
+
+        related = sorted(related - caught_up)
+        for i in range(0, len(related), PG_WINDOW_SIZE):
+            annotations = fetch_annotations(self.session, related[i:i + PG_WINDOW_SIZE])
+            errored.update(self._sync_all(annotations))
+
+        return errored
+
+    def _sync_all(self, annotations):
+        return self.sync([a for a in annotations if not a.deleted],
+                         [a.id for a in annotations if a.deleted])
+
+    def _bulk(self, items):
+        indexing = es_helpers.streaming_bulk(self.es_client.conn, items,
+                                             chunk_size=self.chunk_size,
                                              raise_on_error=False,
                                              expand_action_callback=self._prepare)
         errored = set()
@@ -147,6 +236,10 @@ class BatchIndexer(object):
         action = {self.op_type: {'_index': self._target_index,
                                  '_type': self.es_client.t.annotation,
                                  '_id': annotation.id}}
+        if isinstance(annotation, _Deletion):
+            # See :py:func:`delete`.
+            return (action, {'deleted': True})
+
         data = presenters.AnnotationSearchIndexPresenter(annotation).asdict()
 
         event = AnnotationTransformEvent(self.request, annotation, data)
@@ -155,22 +248,80 @@ class BatchIndexer(object):
         return (action, data)
 
 
-def _all_annotations(session, windowsize=2000):
+def partition(session, count):
+    """
+    Split the annotations to be indexed into windows of about equal size.
+
+    The windows are ranges of the annotations' last updated times, ordered by
+    time, and together they cover all annotations. There may be fewer than
+    `count` windows when there are few annotations.
+
+    :param count: the number of windows
+    :type count: int
+
+    :returns: the windows, and the total number of annotations in them
+    :rtype: tuple of (list of h.search.index.Window, int)
+    """
+    columns = [sa.func.count()]
+    if count > 1:
+        fractions = [i / count for i in range(1, count)]
+        columns.append(sa.func.percentile_disc(postgresql.array(fractions))
+                       .within_group(models.Annotation.updated))
+    query = sa.select(columns).where(_annotation_filter())
+    row = session.execute(query).first()
+    total = row[0]
+    bounds = row[1] if count > 1 else None
+
+    # Bounds are missing without annotations, and repeated when many
+    # annotations have the same last updated time.
+    bounds = sorted(set(b for b in bounds or [] if b is not None))
+
+    starts = [None] + bounds
+    ends = bounds + [None]
+    return [Window(start, end) for start, end in zip(starts, ends)], total
+
+
+def _all_annotations(session, windowsize=2000, window=None):
+    where = _annotation_filter()
+    if window is not None:
+        where = sa.and_(where, _window_filter(window))
+
     # This is using a windowed query for loading all annotations in batches.
     # It is the most performant way of loading a big set of records from
     # the database while still supporting eagerloading of associated
     # document data.
-    windows = column_windows(session=session,
-                             column=models.Annotation.updated,  # implicit ASC
+    windows = keyset_windows(session=session,
+                             columns=[models.Annotation.updated, models.Annotation.id],
                              windowsize=windowsize,
-                             where=_annotation_filter())
-    query = _eager_loaded_annotations(session).filter(_annotation_filter())
+                             where=where)
+    query = _eager_loaded_annotations(session).filter(where)
 
     for window in windows:
         for a in query.filter(window):
             yield a
 
 
+def fetch_annotations(session, ids):
+    """
+    Fetch the annotations with the given ids, ready for indexing.
+
+    The annotations are loaded in one query, together with the associated data
+    which is needed to index them. Unlike the other indexing operations, this
+    includes deleted annotations.
+
+    :param ids: the annotation ids
+    :type ids: list
+
+    :rtype: list of h.models.Annotation
+    """
+    if not ids:
+        return []
+
+    return (_eager_loaded_annotations(session)
+            .filter(models.Annotation.id.in_(ids))
+            .all())
+
+
 def _filtered_annotations(session, ids):
     annotations = (_eager_loaded_annotations(session)
                    .execution_options(stream_results=True)
@@ -186,6 +337,16 @@ def _annotation_filter():
     return sa.not_(models.Annotation.deleted)
 
 
+def _window_filter(window):
+    """Filter for annotations last updated in the given window."""
+    clauses = []
+    if window.start is not None:
+        clauses.append(models.Annotation.updated >= window.start)
+    if window.end is not None:
+        clauses.append(models.Annotation.updated < window.end)
+    return sa.and_(*clauses)
+
+
 def _eager_loaded_annotations(session):
     return session.query(models.Annotation).options(
         subqueryload(models.Annotation.document).subqueryload(models.Document.document_uris),
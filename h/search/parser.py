@@ -9,12 +9,21 @@ from __future__ import unicode_literals
 
 from collections import namedtuple
 
+try:
+    from functools import lru_cache
+except ImportError:
+    from backports.functools_lru_cache import lru_cache
+
 import pyparsing as pp
 from webob.multidict import MultiDict
 
 # Enable memoizing of the parsing logic
 pp.ParserElement.enablePackrat()
 
+# The number of recently parsed queries whose results are cached. Most
+# queries are repeated often (the empty query, `tag:foo`, `user:bar`, ...).
+PARSE_CACHE_SIZE = 1024
+
 # Named fields we support when querying (e.g. `user:luke`)
 named_fields = ['user', 'tag', 'group', 'uri', 'url']
 
@@ -66,14 +75,23 @@ def parse(q):
 
     Supported keys for fields are ``user``, ``group``, ``tag``, ``uri``.
     Any other search terms will get the key ``any``.
+
+    The results of recently parsed queries are cached, and a new MultiDict is
+    returned every time, so the returned MultiDict can be modified freely.
     """
+    return MultiDict(_parse(q))
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(q):
+    """Parse a query string into an (immutable) tuple of Matches."""
     parser = _get_parser()
     parse_results = parser.parseString(q)
 
     # The parser returns all matched strings, even the field names, we use a
     # parse action to turn matches into a key/value pair (Match), but we need
     # to filter out any other matches that the parser returns.
-    return MultiDict([m for m in parse_results if isinstance(m, Match)])
+    return tuple(m for m in parse_results if isinstance(m, Match))
 
 
 def unparse(q):
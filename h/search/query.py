@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import binascii
+import json
+
 from h import storage
+from h.schemas import ValidationError
 from h.util import uri
 
 LIMIT_DEFAULT = 20
 LIMIT_MAX = 200
+SORT_DEFAULT = 'updated'
+ORDER_DEFAULT = 'desc'
+# Elasticsearch's internal id field, which unlike `_id` is indexed, and so
+# can be sorted and filtered on.
+TIEBREAKER = '_uid'
 
 
 class Builder(object):
@@ -31,11 +41,17 @@ class Builder(object):
         """Get the resulting query object from this query builder."""
         params = params.copy()
 
+        paginate_by_cursor = uses_cursor(params)
         p_from = extract_offset(params)
         p_size = extract_limit(params)
-        p_sort = extract_sort(params)
+        p_sort = extract_sort(params, tiebreaker=paginate_by_cursor)
+        p_cursor = extract_cursor(params)
 
         filters = [f(params) for f in self.filters]
+        if p_cursor is not None:
+            # A cursor replaces the offset.
+            p_from = 0
+            filters.append(cursor_filter(p_sort, p_cursor))
         matchers = [m(params) for m in self.matchers]
         aggregations = {a.key: a(params) for a in self.aggregations}
         filters = [f for f in filters if f is not None]
@@ -90,13 +106,126 @@ def extract_limit(params):
         return val
 
 
-def extract_sort(params):
-    return [{
-        params.pop("sort", "updated"): {
-            "ignore_unmapped": True,
-            "order": params.pop("order", "desc"),
-        }
-    }]
+def extract_sort(params, tiebreaker=False):
+    """
+    Remove the "sort" and "order" params and return the sort for them.
+
+    If `tiebreaker` is true, annotations with the same value of the sort field
+    are sorted by their ids, so that the results are in a well-defined order
+    which cursors can resume from. This is only done when it's needed, as
+    sorting on ids loads them all into Elasticsearch's memory.
+    """
+    order = params.pop("order", ORDER_DEFAULT)
+    sort = [
+        {
+            params.pop("sort", SORT_DEFAULT): {
+                "ignore_unmapped": True,
+                "order": order,
+            }
+        },
+    ]
+    if tiebreaker:
+        sort.append({
+            TIEBREAKER: {
+                "order": order,
+            }
+        })
+    return sort
+
+
+def uses_cursor(params):
+    """
+    Return whether the search `params` ask for cursor pagination.
+
+    That is, whether they have a "cursor" param, which is empty for the first
+    page of results.
+    """
+    return "cursor" in params
+
+
+def extract_cursor(params):
+    """
+    Remove and decode the "cursor" param, if there is one.
+
+    :raises ValidationError: if the cursor is invalid
+    """
+    cursor = params.pop("cursor", None)
+    if not cursor:
+        return None
+    return decode_cursor(cursor)
+
+
+def cursor_filter(sort, cursor):
+    """
+    Return a filter for the results after `cursor` in the order of `sort`.
+
+    That is, those whose value of the sort field is after the cursor's value,
+    and those with the same value which are after the cursor's annotation.
+    """
+    [(field, options)] = sort[0].items()
+    if cursor['sort'] != field or cursor['order'] != options['order']:
+        raise ValidationError("cursor doesn't match the sort order")
+
+    after = 'gt' if options['order'] == 'asc' else 'lt'
+    value = cursor['value']
+    return {"or": [
+        {"range": {field: {after: value}}},
+        {"and": [
+            {"range": {field: {"gte": value, "lte": value}}},
+            {"range": {TIEBREAKER: {after: cursor['uid']}}},
+        ]},
+    ]}
+
+
+def next_cursor(params, hits):
+    """
+    Return the cursor for the page of results after `hits`.
+
+    The cursor records the sort values of the last hit, so that a search with
+    the cursor finds the results after `hits` no matter how deep into the
+    results they are.
+
+    Returns None if the search didn't ask for cursor pagination, if there are
+    fewer hits than were asked for, as there are no more results, or if the
+    hits have no sort values.
+    """
+    if not uses_cursor(params):
+        return None
+    if not hits or len(hits) < extract_limit(params.copy()):
+        return None
+
+    sort = hits[-1].get('sort')
+    if not sort or sort[0] is None:
+        return None
+
+    return encode_cursor({
+        'sort': params.get('sort', SORT_DEFAULT),
+        'order': params.get('order', ORDER_DEFAULT),
+        'value': sort[0],
+        'uid': sort[1],
+    })
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')))
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor encoded by :py:func:`encode_cursor`.
+
+    :raises ValidationError: if the cursor is invalid
+    """
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (binascii.Error, TypeError, ValueError, UnicodeError):
+        raise ValidationError('invalid cursor')
+
+    if (not isinstance(decoded, dict) or
+            not all(key in decoded for key in ('sort', 'order', 'value', 'uid'))):
+        raise ValidationError('invalid cursor')
+
+    return decoded
 
 
 class TopLevelAnnotationsFilter(object):
@@ -174,14 +303,14 @@ class UriFilter(object):
         if 'url' in params:
             del params['url']
 
-        uris = set()
-        for query_uri in query_uris:
-            expanded = storage.expand_uri(self.request.db, query_uri)
+        expanded = storage.expand_uris(self.request.db, query_uris,
+                                       stats=self.request.stats)
 
-            us = [uri.normalize(u) for u in expanded]
-            uris.update(us)
+        uris = set()
+        for us in expanded.values():
+            uris.update(uri.normalize(u) for u in us)
 
-        return {"terms": {"target.scope": list(uris)}}
+        return {"terms": {"target.scope": sorted(uris)}}
 
 
 class UserFilter(object):
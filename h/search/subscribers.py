@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+
+def add_extra(event):
+    """Add the annotation's extra fields to its document in the search index."""
+    event.annotation_dict['extra'] = event.annotation.extra or {}
@@ -10,6 +10,11 @@ from h import presenters
 from h import resources
 from h import storage
 from h.interfaces import IGroupService
+from h.presenters.annotation_searchindex import IndexedAnnotation
+
+# The default number of annotations to present at a time when presenting
+# annotations in chunks.
+CHUNK_SIZE = 200
 
 
 class AnnotationJSONPresentationService(object):
@@ -31,13 +36,32 @@ class AnnotationJSONPresentationService(object):
         presenter = self._get_presenter(annotation_resource)
         return presenter.asdict()
 
-    def present_all(self, annotation_ids):
+    def present_all(self, annotation_ids, sources=None):
+        """
+        Present the annotations with the given ids.
+
+        If the annotations' documents in the search index are given in
+        `sources` (a dict keyed by annotation id), the annotations are
+        presented from those rather than being loaded from the database. Any
+        annotations whose sources are missing or incomplete are still loaded
+        from the database.
+        """
         def eager_load_documents(query):
             return query.options(
                 subqueryload(models.Annotation.document))
 
+        indexed = _indexed_annotations(annotation_ids, sources or {})
+
         annotations = storage.fetch_ordered_annotations(
-            self.session, annotation_ids, query_processor=eager_load_documents)
+            self.session,
+            [id_ for id_ in annotation_ids if id_ not in indexed],
+            query_processor=eager_load_documents)
+
+        if indexed:
+            annotations_by_id = dict(indexed)
+            annotations_by_id.update((ann.id, ann) for ann in annotations)
+            annotations = [annotations_by_id[id_] for id_ in annotation_ids
+                           if id_ in annotations_by_id]
 
         # preload formatters, so they can optimize database access
         for formatter in self.formatters:
@@ -47,11 +71,33 @@ class AnnotationJSONPresentationService(object):
                     resources.AnnotationResource(ann, self.group_svc, self.links_svc))
                 for ann in annotations]
 
+    def present_all_in_chunks(self, annotation_ids, chunk_size=CHUNK_SIZE):
+        """
+        Present annotations `chunk_size` at a time.
+
+        This is a generator of lists of presented annotations, which loads
+        only one chunk of annotations from the database at a time, so that
+        presenting a very large number of annotations doesn't need them all
+        to be in memory at once.
+        """
+        for i in range(0, len(annotation_ids), chunk_size):
+            yield self.present_all(annotation_ids[i:i + chunk_size])
+
     def _get_presenter(self, annotation_resource):
         return presenters.AnnotationJSONPresenter(annotation_resource,
                                                   self.formatters)
 
 
+def _indexed_annotations(annotation_ids, sources):
+    """Return the annotations which can be loaded from `sources`, by id."""
+    annotations = {}
+    for id_ in annotation_ids:
+        source = sources.get(id_)
+        if source is not None and IndexedAnnotation.is_complete(source):
+            annotations[id_] = IndexedAnnotation(id_, source)
+    return annotations
+
+
 def annotation_json_presentation_service_factory(context, request):
     group_svc = request.find_service(IGroupService)
     links_svc = request.find_service(name='links')
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from functools import partial
+
 from h.models import User
 from h.tasks.indexer import reindex_user_annotations
 
@@ -11,8 +13,16 @@ class NipsaService(object):
     (NIPSA) flags on userids.
     """
 
-    def __init__(self, session):
+    def __init__(self, session, publish=None):
+        """
+        Create a new NipsaService.
+
+        :param session: the SQLAlchemy session object
+        :param publish: a callable for publishing user events when a user's
+                        NIPSA flag changes
+        """
         self.session = session
+        self.publish = publish
         self._flagged_userids = None
 
     @property
@@ -41,6 +51,8 @@ class NipsaService(object):
         """
         user.nipsa = True
         reindex_user_annotations.delay(user.userid)
+        if self.publish:
+            self.publish(user.userid, True)
 
     def unflag(self, user):
         """
@@ -52,6 +64,8 @@ class NipsaService(object):
         """
         user.nipsa = False
         reindex_user_annotations.delay(user.userid)
+        if self.publish:
+            self.publish(user.userid, False)
 
     def clear(self):
         self._flagged_userids = None
@@ -59,4 +73,12 @@ class NipsaService(object):
 
 def nipsa_factory(context, request):
     """Return a NipsaService instance for the passed context and request."""
-    return NipsaService(request.db)
+    return NipsaService(request.db, publish=partial(_publish, request))
+
+
+def _publish(request, userid, nipsa):
+    request.realtime.publish_user({
+        'type': 'nipsa-change',
+        'userid': userid,
+        'nipsa': nipsa,
+    })
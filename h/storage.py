@@ -23,7 +23,8 @@ from pyramid import i18n
 
 from h import models, schemas
 from h.db import types
-from h.models.document import update_document_metadata
+from h.models.document import DOCUMENT_URIS_CACHE, update_document_metadata
+from h.util.uri import normalize as uri_normalize
 
 _ = i18n.TranslationStringFactory(__package__)
 
@@ -211,7 +212,7 @@ def delete_annotation(session, id_):
     annotation.deleted = True
 
 
-def expand_uri(session, uri):
+def expand_uri(session, uri, stats=None):
     """
     Return all URIs which refer to the same underlying document as `uri`.
 
@@ -219,26 +220,111 @@ def expand_uri(session, uri):
     passed URI, and if so returns the set of all URIs which we currently
     believe refer to the same document.
 
+    The document URIs are cached by normalized URI (see
+    :py:data:`h.models.document.DOCUMENT_URIS_CACHE`), so repeated expansions
+    of the same page don't query the database.
+
     :param session: the database session
     :type session: sqlalchemy.orm.session.Session
 
     :param uri: a URI associated with the document
     :type uri: str
 
+    :param stats: an optional statsd client with which to count cache hits
+        and misses
+    :type stats: statsd.StatsClient
+
     :returns: a list of equivalent URIs
     :rtype: list
     """
-    doc = models.Document.find_by_uris(session, [uri]).one_or_none()
+    return expand_uris(session, [uri], stats=stats)[uri]
+
+
+def expand_uris(session, uris, stats=None):
+    """
+    Return all URIs which refer to the same underlying documents as `uris`.
+
+    This is the bulk form of :py:func:`expand_uri`. The document URIs of all
+    the `uris` which aren't cached are loaded in a single query.
+
+    :param session: the database session
+    :type session: sqlalchemy.orm.session.Session
+
+    :param uris: URIs associated with documents
+    :type uris: list of str
+
+    :param stats: an optional statsd client with which to count cache hits
+        and misses
+    :type stats: statsd.StatsClient
 
-    if doc is None:
+    :returns: a dict mapping each of `uris` to a list of its equivalent URIs
+    :rtype: dict
+    """
+    keys = {uri: uri_normalize(uri) for uri in uris}
+
+    docuris_by_key = {}
+    for key in set(keys.values()):
+        docuris = DOCUMENT_URIS_CACHE.get(key)
+        if docuris is None:
+            if stats is not None:
+                stats.incr('storage.expand_uri.cache.miss')
+        else:
+            if stats is not None:
+                stats.incr('storage.expand_uri.cache.hit')
+            docuris_by_key[key] = docuris
+
+    missing_keys = [key for key in set(keys.values()) if key not in docuris_by_key]
+    if missing_keys:
+        loaded = _load_document_uris(session, missing_keys)
+        for key in missing_keys:
+            docuris = loaded.get(key, ())
+            DOCUMENT_URIS_CACHE.set(key, docuris)
+            docuris_by_key[key] = docuris
+
+    return {uri: _expand(uri, docuris_by_key[key]) for uri, key in keys.items()}
+
+
+def _load_document_uris(session, keys):
+    """
+    Load the document URIs of the documents of the given normalized URIs.
+
+    Returns a dict mapping each of `keys` which has a document to a tuple of
+    its document's (uri, type) pairs, most recently updated first.
+    """
+    DocumentURI = models.DocumentURI
+
+    matching_claims = (
+        session.query(DocumentURI.uri_normalized.label('key'),
+                      DocumentURI.document_id)
+               .filter(DocumentURI.uri_normalized.in_(keys))
+               .distinct()
+               .subquery()
+    )
+    rows = (
+        session.query(matching_claims.c.key, DocumentURI.uri, DocumentURI.type)
+               .select_from(DocumentURI)
+               .join(matching_claims,
+                     matching_claims.c.document_id == DocumentURI.document_id)
+               .order_by(DocumentURI.updated.desc(), DocumentURI.id)
+    )
+
+    docuris = {}
+    for key, uri, type_ in rows:
+        docuris.setdefault(key, [])
+        if (uri, type_) not in docuris[key]:
+            docuris[key].append((uri, type_))
+    return {key: tuple(pairs) for key, pairs in docuris.items()}
+
+
+def _expand(uri, docuris):
+    if not docuris:
         return [uri]
 
     # We check if the match was a "canonical" link. If so, all annotations
     # created on that page are guaranteed to have that as their target.source
     # field, so we don't need to expand to other URIs and risk false positives.
-    docuris = doc.document_uris
-    for docuri in docuris:
-        if docuri.uri == uri and docuri.type == 'rel-canonical':
+    for docuri, type_ in docuris:
+        if docuri == uri and type_ == 'rel-canonical':
             return [uri]
 
-    return [docuri.uri for docuri in docuris]
+    return [docuri for docuri, _ in docuris]
@@ -1,11 +1,9 @@
 # -*- coding: utf-8 -*-
 
-import copy
 import operator
-import unicodedata
 
 from jsonpointer import resolve_pointer
-from h._compat import text_type
+from h.util.text import uni_fold
 
 SCHEMA = {
     "type": "object",
@@ -41,127 +39,172 @@ SCHEMA = {
 
 
 class FilterHandler(object):
-    def __init__(self, filter_json):
-        self.filter = filter_json
 
-    # operators
-    operators = {
-        'equals': 'eq',
-        'matches': 'contains',
-        'lt': 'lt',
-        'le': 'le',
-        'gt': 'gt',
-        'ge': 'ge',
-        'one_of': 'contains',
-        'first_of': 'first_of',
-        'match_of': 'match_of',
-        'lene': 'lene',
-        'leng': 'leng',
-        'lenge': 'lenge',
-        'lenl': 'lenl',
-        'lenle': 'lenle',
-    }
-
-    def evaluate_clause(self, clause, target):
-        if isinstance(clause['field'], list):
-            for field in clause['field']:
-                copied = copy.deepcopy(clause)
-                copied['field'] = field
-                result = self.evaluate_clause(copied, target)
-                if result:
-                    return True
-            return False
-        else:
-            field_value = resolve_pointer(target, clause['field'], None)
-            if field_value is None:
-                return False
+    """
+    Match events against a client-supplied streamer filter.
+
+    The filter is compiled when the handler is created: clause values are
+    case- and accent-folded once, and each clause is turned into a specialized
+    matching function, so that matching an event does as little work as
+    possible. Targets may be passed as plain dicts, or as a
+    :py:class:`FoldedTarget` shared between many filters so that the target's
+    field values are only resolved and folded once.
+    """
 
-            cval = clause['value']
-            fval = field_value
-
-            if isinstance(cval, list):
-                tval = []
-                for cv in cval:
-                    tval.append(uni_fold(cv))
-                cval = tval
-            else:
-                cval = uni_fold(cval)
-
-            if isinstance(fval, list):
-                tval = []
-                for fv in fval:
-                    tval.append(uni_fold(fv))
-                fval = tval
-            else:
-                fval = uni_fold(fval)
-
-            reversed_order = False
-            # Determining operator order
-            # Normal order: field_value, clause['value']
-            # i.e. condition created > 2000.01.01
-            # Here clause['value'] = '2001.01.01'.
-            # The field_value is target['created']
-            # So the natural order is: ge(field_value, clause['value']
-
-            # But!
-            # Reversed operator order for contains (b in a)
-            if isinstance(cval, list) or isinstance(fval, list):
-                if clause['operator'] in ['one_of', 'matches']:
-                    reversed_order = True
-                    # But not in every case. (i.e. tags matches 'b')
-                    # Here field_value is a list, because an annotation can
-                    # have many tags.
-                    if isinstance(field_value, list):
-                        reversed_order = False
-
-            if reversed_order:
-                lval = cval
-                rval = fval
-            else:
-                lval = fval
-                rval = cval
-
-            op = getattr(operator, self.operators[clause['operator']])
-            return op(lval, rval)
+    def __init__(self, filter_json):
+        self.filter = filter_json
+        self._actions = filter_json['actions']
+        self._clauses = [_compile_clause(c) for c in filter_json['clauses']]
+        self._policy = getattr(self, filter_json['match_policy'])
 
     # match_policies
     def include_any(self, target):
-        for clause in self.filter['clauses']:
-            if self.evaluate_clause(clause, target):
+        for clause in self._clauses:
+            if clause(target):
                 return True
         return False
 
     def include_all(self, target):
-        for clause in self.filter['clauses']:
-            if not self.evaluate_clause(clause, target):
+        for clause in self._clauses:
+            if not clause(target):
                 return False
         return True
 
     def exclude_all(self, target):
-        for clause in self.filter['clauses']:
-            if not self.evaluate_clause(clause, target):
+        for clause in self._clauses:
+            if not clause(target):
                 return True
         return False
 
     def exclude_any(self, target):
-        for clause in self.filter['clauses']:
-            if self.evaluate_clause(clause, target):
+        for clause in self._clauses:
+            if clause(target):
                 return False
         return True
 
     def match(self, target, action=None):
-        if not action or action == 'past' or action in self.filter['actions']:
-            if len(self.filter['clauses']) > 0:
-                return getattr(self, self.filter['match_policy'])(target)
-            else:
+        if action and action != 'past' and action not in self._actions:
+            return False
+        if not self._clauses:
+            return True
+        if not isinstance(target, FoldedTarget):
+            target = FoldedTarget(target)
+        return self._policy(target)
+
+
+class FoldedTarget(object):
+
+    """
+    A filter target whose field values are resolved and folded on demand.
+
+    Each field is resolved and folded at most once, however many filters are
+    matched against the target.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self._values = {}
+
+    def get(self, field):
+        """Return the folded value of `field`, or None if it is missing."""
+        try:
+            return self._values[field]
+        except KeyError:
+            pass
+        value = resolve_pointer(self.target, field, None)
+        if value is not None:
+            value = _fold(value)
+        self._values[field] = value
+        return value
+
+
+def _compile_clause(clause):
+    """Return a function which tests a :py:class:`FoldedTarget` against `clause`."""
+    fields = clause['field']
+    if not isinstance(fields, list):
+        fields = [fields]
+    test = _compile_test(clause['operator'], _fold(clause['value']))
+
+    def match(target):
+        for field in fields:
+            value = target.get(field)
+            if value is not None and test(value):
                 return True
-        else:
+        return False
+
+    return match
+
+
+def _compile_test(operator_, cval):
+    """
+    Return a function which tests a folded field value against `cval`.
+
+    Operators are applied with the field value on the left and the clause
+    value on the right (i.e. created > 2000.01.01 is `gt(field, value)`). The
+    exception is `one_of` and `matches` with a list of clause values, which
+    test for membership of the field value in the clause values, unless the
+    field is itself a list (i.e. tags matches 'b').
+    """
+    if operator_ in ('one_of', 'matches'):
+        if isinstance(cval, list):
+            members = _members(cval)
+
+            def contains(fval):
+                if isinstance(fval, list):
+                    return cval in fval
+                return _is_member(fval, members, cval)
+            return contains
+
+        return lambda fval: cval in fval
+
+    if operator_ == 'match_of':
+        try:
+            members = frozenset(cval)
+        except TypeError:
+            # Either an unhashable or a non-iterable clause value: fall back to
+            # the unoptimized operator.
+            return lambda fval: match_of(fval, cval)
+
+        def any_member(fval):
+            if not isinstance(fval, list):
+                return match_of(fval, cval)
+            for item in fval:
+                if _is_member(item, members, cval):
+                    return True
             return False
+        return any_member
+
+    op = OPERATORS[operator_]
+
+    def test(fval):
+        return op(fval, cval)
+    return test
+
+
+def _members(values):
+    """Return a collection for fast membership tests of folded `values`."""
+    try:
+        return frozenset(values)
+    except TypeError:
+        return tuple(values)
+
+
+def _is_member(value, members, values):
+    try:
+        return value in members
+    except TypeError:
+        # Unhashable values can't be looked up in a set
+        return value in values
+
+
+def _fold(value):
+    if isinstance(value, list):
+        return [uni_fold(v) for v in value]
+    return uni_fold(value)
 
 
 def first_of(a, b):
     return a[0] == b
-setattr(operator, 'first_of', first_of)
 
 
 def match_of(a, b):
@@ -169,43 +212,39 @@ def match_of(a, b):
         if subb in a:
             return True
     return False
-setattr(operator, 'match_of', match_of)
 
 
 def lene(a, b):
     return len(a) == b
-setattr(operator, 'lene', lene)
 
 
 def leng(a, b):
     return len(a) > b
-setattr(operator, 'leng', leng)
 
 
 def lenge(a, b):
     return len(a) >= b
-setattr(operator, 'lenge', lenge)
 
 
 def lenl(a, b):
     return len(a) < b
-setattr(operator, 'lenl', lenl)
 
 
 def lenle(a, b):
     return len(a) <= b
-setattr(operator, 'lenle', lenle)
 
 
-def uni_fold(text):
-    # Convert bytes to text
-    if isinstance(text, bytes):
-        text = text_type(text, "utf-8")
-
-    # Do not touch other types
-    if not isinstance(text, text_type):
-        return text
-
-    text = text.lower()
-    text = unicodedata.normalize('NFKD', text)
-    return u"".join([c for c in text if not unicodedata.combining(c)])
+# Binary operators for clauses, called as `op(field_value, clause_value)`.
+OPERATORS = {
+    'equals': operator.eq,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'first_of': first_of,
+    'lene': lene,
+    'leng': leng,
+    'lenge': lenge,
+    'lenl': lenl,
+    'lenle': lenle,
+}
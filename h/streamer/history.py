@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+A buffer of recent annotation events, so that reconnecting clients can resume.
+
+Each annotation event processed by the streamer is given a sequence number,
+which is included in the notifications sent to clients. A client which
+reconnects can send a "resume" message with the last sequence number it saw,
+and the events it missed are replayed to it through its filter, rather than it
+having to search for them.
+
+Sequence numbers are only meaningful within a single streamer process, so each
+buffer has a random "epoch" identifier which is sent along with them. A resume
+request for a different epoch, or for events which have since been evicted
+from the buffer, can't be satisfied and the client must fall back to
+searching.
+"""
+
+from __future__ import unicode_literals
+
+import base64
+import collections
+import os
+
+# The default maximum number of events to keep. The buffer is disabled unless
+# this is overridden by the `h.streamer.history_size` setting.
+DEFAULT_MAX_EVENTS = 0
+
+# The default limit on the (approximate) total size of the buffered events,
+# in bytes. This can be overridden by the `h.streamer.history_max_bytes`
+# setting.
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class EventHistory(object):
+
+    """
+    A bounded buffer of recent annotation events.
+
+    Events are evicted oldest first once either the number of events or their
+    total size exceeds its limit. The size of each event is given when it is
+    added, and should account for everything the event keeps in memory.
+    """
+
+    def __init__(self, max_events=DEFAULT_MAX_EVENTS, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.epoch = base64.urlsafe_b64encode(os.urandom(6)).decode('ascii')
+        self.last_seq = 0
+
+        self._events = collections.deque()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    @property
+    def enabled(self):
+        return self.max_events > 0
+
+    def next_seq(self):
+        """Allocate and return the sequence number for a new event."""
+        self.last_seq += 1
+        return self.last_seq
+
+    def add(self, seq, event, size):
+        """
+        Add `event`, which has sequence number `seq`, to the buffer.
+
+        Events must be added in sequence number order. An event of None
+        records that the event with sequence number `seq` couldn't be
+        buffered, and means that replays which would include it can't be done.
+        """
+        if not self.enabled:
+            return
+
+        self._events.append((seq, event, size))
+        self._bytes += size
+
+        while self._events and (len(self._events) > self.max_events or
+                                self._bytes > self.max_bytes):
+            _, _, evicted_size = self._events.popleft()
+            self._bytes -= evicted_size
+
+    def since(self, epoch, seq, until=None):
+        """
+        Return the events after sequence number `seq`, up to `until`.
+
+        Returns None if the events can't be replayed, either because `epoch`
+        isn't this buffer's epoch or because some of the events have already
+        been evicted or couldn't be buffered.
+
+        :rtype: list of events, or None
+        """
+        if not self.enabled or epoch != self.epoch or seq > self.last_seq:
+            return None
+        if until is None:
+            until = self.last_seq
+
+        if seq == self.last_seq:
+            return []
+
+        # Every sequence number after the oldest buffered event's is in the
+        # buffer, so the events we want are all or part of the buffer.
+        if not self._events or self._events[0][0] > seq + 1:
+            return None
+
+        events = [event for s, event, _ in self._events if seq < s <= until]
+        if any(event is None for event in events):
+            return None
+        return events
+
+
+RECENT_EVENTS = EventHistory()
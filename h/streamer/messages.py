@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from collections import namedtuple
+import json
 import logging
 
 from gevent.queue import Full
@@ -12,9 +13,11 @@ from h.realtime import Consumer
 from h.resources import AnnotationResource
 from h.auth.util import translate_annotation_principals
 from h.services.links import LinksService
-from h.services.nipsa import NipsaService
 from h.services.groupfinder import GroupfinderService
+from h.streamer import history
+from h.streamer import nipsa
 from h.streamer import websocket
+from h.streamer.filter import FoldedTarget
 import h.sentry
 import h.stats
 
@@ -26,6 +29,35 @@ log = logging.getLogger(__name__)
 # An incoming message from a subscribed realtime consumer
 Message = namedtuple('Message', ['topic', 'payload'])
 
+# An annotation event which has been rendered once and can be checked against,
+# and sent to, any number of sockets. The target is the serialized annotation
+# wrapped so that filters share its folded field values, and the notification
+# is a pre-encoded :py:class:`h.streamer.websocket.JSONMessage`.
+AnnotationEvent = namedtuple('AnnotationEvent', [
+    'action',
+    'src_client_id',
+    'userid',
+    'user_nipsad',
+    'target',
+    'read_principals',
+    'notification',
+])
+
+# An annotation event as kept in the history of recent events, for replaying
+# to clients which resume. Rather than the serialized annotation and the
+# notification message, only the encoded notification is kept, along with the
+# encoded annotation if the notification doesn't include it. The filter target
+# is decoded again when the event is replayed.
+BufferedEvent = namedtuple('BufferedEvent', [
+    'action',
+    'src_client_id',
+    'userid',
+    'user_nipsad',
+    'read_principals',
+    'target',
+    'notification',
+])
+
 
 def process_messages(settings, routing_key, work_queue, raise_error=True):
     """
@@ -35,6 +67,10 @@ def process_messages(settings, routing_key, work_queue, raise_error=True):
     This sets up a :py:class:`h.realtime.Consumer` to route messages from
     `routing_key` to the passed `work_queue`, and starts it. The consumer
     should never return. If it does, this function will raise an exception.
+
+    If the topic exchange is in use, the consumer for annotation messages only
+    binds the routing keys for the events which sockets in this process are
+    subscribed to, and updates its bindings as their filters change.
     """
 
     def _handler(payload):
@@ -48,11 +84,17 @@ def process_messages(settings, routing_key, work_queue, raise_error=True):
     conn = realtime.get_connection(settings)
     sentry_client = h.sentry.get_client(settings)
     statsd_client = h.stats.get_client(settings)
+    kwargs = {}
+    if realtime.use_topic_exchange(settings):
+        kwargs['exchange'] = realtime.get_topic_exchange()
+        if routing_key == 'annotation':
+            kwargs['binding_keys'] = websocket.WebSocket.subscriptions.routing_keys
     consumer = Consumer(connection=conn,
                         routing_key=routing_key,
                         handler=_handler,
                         sentry_client=sentry_client,
-                        statsd_client=statsd_client)
+                        statsd_client=statsd_client,
+                        **kwargs)
     consumer.run()
 
     if raise_error:
@@ -63,12 +105,10 @@ def handle_message(message, settings, session, topic_handlers):
     """
     Deserialize and process a message from the reader.
 
-    For each message, `handler` is called with the deserialized message and a
-    single :py:class:`h.streamer.WebSocket` instance, and should return the
-    message to be sent to the client on that socket. The handler can return
-    `None`, to signify that no message should be sent, or a JSON-serializable
-    object. It is assumed that there is a 1:1 request-reply mapping between
-    incoming messages and messages to be sent out over the websockets.
+    For each message, `handler` is called with the deserialized message, the
+    application settings and the database session. The handler is responsible
+    for finding the :py:class:`h.streamer.WebSocket` instances which should be
+    notified of the message, and for sending any messages to them.
     """
     try:
         handler = topic_handlers[message.topic]
@@ -76,35 +116,111 @@ def handle_message(message, settings, session, topic_handlers):
         raise RuntimeError("Don't know how to handle message from topic: "
                            "{}".format(message.topic))
 
-    # N.B. We iterate over a non-weak list of instances because there's nothing
-    # to stop connections being added or dropped during iteration, and if that
-    # happens Python will throw a "Set changed size during iteration" error.
-    sockets = list(websocket.WebSocket.instances)
-    handler(message.payload, sockets, settings, session)
+    handler(message.payload, settings, session)
 
 
-def handle_annotation_event(message, sockets, settings, session):
-    id_ = message['annotation_id']
-    annotation = storage.fetch_annotation(session, id_)
+def handle_annotation_event(message, settings, session, subscriptions=None,
+                            flagged_users=None, recent_events=None):
+    if subscriptions is None:
+        subscriptions = websocket.WebSocket.subscriptions
+    if flagged_users is None:
+        flagged_users = nipsa.FLAGGED_USERS
+    if recent_events is None:
+        recent_events = history.RECENT_EVENTS
 
-    if annotation is None:
-        log.warn('received annotation event for missing annotation: %s', id_)
+    if message['action'] == 'read':
         return
 
-    nipsa_service = NipsaService(session)
-    user_nipsad = nipsa_service.is_flagged(annotation.userid)
+    # The web process may have included the presented annotation in the
+    # message, in which case we don't need to fetch it from the database.
+    serialized = message.get('annotation')
+    if serialized is None:
+        id_ = message['annotation_id']
+        annotation = storage.fetch_annotation(session, id_)
+
+        if annotation is None:
+            log.warn('received annotation event for missing annotation: %s', id_)
+            return
+
+        annotation_id = annotation.id
+        userid = annotation.userid
+        target = {'uri': annotation.target_uri,
+                  'group': annotation.groupid,
+                  'user': userid}
+    else:
+        annotation_id = serialized['id']
+        userid = serialized['user']
+        target = serialized
+
+    # Only the sockets whose filters could match this annotation need to be
+    # considered. Their filters are still evaluated in full below. If we're
+    # keeping a history of recent events for clients to resume from, every
+    # event is needed regardless.
+    candidates = subscriptions.sockets_for(target)
+    if not candidates and not recent_events.enabled:
+        return
 
-    authority = text_type(settings.get('h.authority', 'localhost'))
-    group_service = GroupfinderService(session, authority)
+    user_nipsad = flagged_users.is_flagged(userid, session)
+
+    if serialized is None:
+        # All the sockets in this process share the application registry, so
+        # we can present the annotation once using any of them.
+        registry = _get_registry(candidates)
+        if registry is None:
+            # With no clients connected we can't present the annotation, so
+            # record that the history is incomplete.
+            recent_events.add(recent_events.next_seq(), None, 0)
+            return
+
+        authority = text_type(settings.get('h.authority', 'localhost'))
+        group_service = GroupfinderService(session, authority)
+        serialized = _present_annotation(annotation, group_service, registry)
+
+    # Other greenlets may have changed sockets' filters while we were waiting
+    # on the database above. A socket which sets its filter records the last
+    # sequence number at that point, and is only replayed the events up to it
+    # when it resumes, so the sockets to send this event to must be picked
+    # when its sequence number is allocated, with nothing in between that
+    # could yield to another greenlet.
+    sockets = subscriptions.sockets_for(target)
+    seq = None
+    if recent_events.enabled:
+        seq = recent_events.next_seq()
+
+    event = _render_annotation_event(message,
+                                     serialized,
+                                     annotation_id,
+                                     userid,
+                                     user_nipsad,
+                                     seq=seq,
+                                     epoch=recent_events.epoch)
+    if seq is not None:
+        buffered = _buffer_event(event, serialized)
+        recent_events.add(seq, buffered, _buffered_size(buffered))
 
     for socket in sockets:
-        reply = _generate_annotation_event(message, socket, annotation, user_nipsad, group_service)
+        reply = _generate_annotation_event(event, socket)
         if reply is None:
             continue
         socket.send_json(reply)
 
 
-def handle_user_event(message, sockets, settings, session):
+def handle_user_event(message, settings, session, sockets=None,
+                      flagged_users=None):
+    # Changes to a user's NIPSA flag are only of interest to the streamer
+    # itself, and aren't forwarded to any sockets.
+    if message['type'] == 'nipsa-change':
+        if flagged_users is None:
+            flagged_users = nipsa.FLAGGED_USERS
+        flagged_users.update(message['userid'], message['nipsa'])
+        return
+
+    # N.B. We iterate over a non-weak list of instances because there's nothing
+    # to stop connections being added or dropped during iteration, and if that
+    # happens Python will throw a "Set changed size during iteration" error.
+    if sockets is None:
+        sockets = list(websocket.WebSocket.instances)
+
     for socket in sockets:
         reply = _generate_user_event(message, socket)
         if reply is None:
@@ -112,22 +228,164 @@ def handle_user_event(message, sockets, settings, session):
         socket.send_json(reply)
 
 
-def _generate_annotation_event(message, socket, annotation, user_nipsad, group_service):
+def handle_resume_message(message, session=None, recent_events=None):
     """
-    Get message about annotation event `message` to be sent to `socket`.
+    A reconnecting client asking for the annotation events it missed.
 
-    Inspects the embedded annotation event and decides whether or not the
-    passed socket should receive notification of the event.
+    The client sends the epoch and sequence number of the last annotation
+    notification it received, and is sent the events since then which match
+    its filter, up to the point at which it set its filter (after which it
+    will have been sent them as they happened).
+    """
+    if recent_events is None:
+        recent_events = history.RECENT_EVENTS
+
+    socket = message.socket
+    epoch = message.payload.get('epoch')
+    seq = message.payload.get('seq')
+
+    if not isinstance(seq, int) or socket.filter is None:
+        message.reply({'type': 'error',
+                       'error': {'type': 'invalid_data',
+                                 'description': 'a filter, "epoch" and "seq" '
+                                                'are required'}},
+                      ok=False)
+        return
 
-    Returns None if the socket should not receive any message about this
-    annotation event, otherwise a dict containing information about the event.
+    # When using the topic exchange, this process only receives the events
+    # its clients were subscribed to, so its history isn't complete.
+    events = None
+    if not realtime.use_topic_exchange(socket.registry.settings):
+        events = recent_events.since(epoch, seq, until=socket.filter_seq)
+
+    if events is None:
+        message.reply({'type': 'error',
+                       'error': {'type': 'resume_unavailable',
+                                 'description': 'missed events are not '
+                                                'available'}},
+                      ok=False)
+        return
+
+    for event in events:
+        reply = _generate_annotation_event(_replay_event(event), socket)
+        if reply is None:
+            continue
+        socket.send_json(reply)
+
+    message.reply({'type': 'resumed'})
+websocket.MESSAGE_HANDLERS['resume'] = handle_resume_message
+
+
+def _get_registry(sockets):
+    """Return the application registry, from any connected socket."""
+    if sockets:
+        return sockets[0].registry
+    for socket in list(websocket.WebSocket.instances):
+        return socket.registry
+    return None
+
+
+def _present_annotation(annotation, group_service, registry):
+    """Return the presented annotation for delivery to sockets."""
+    base_url = registry.settings.get('h.app_url', 'http://localhost:5000')
+    links_service = LinksService(base_url, registry)
+    resource = AnnotationResource(annotation, group_service, links_service)
+    return presenters.AnnotationJSONPresenter(resource).asdict()
+
+
+def _render_annotation_event(message, serialized, annotation_id, userid, user_nipsad,
+                             seq=None, epoch=None):
+    """
+    Render annotation event `message` for delivery to any number of sockets.
+
+    This does all the work of preparing the presented annotation `serialized`
+    which doesn't depend on the socket receiving the notification, so that it
+    is only done once per event.
+
+    If `seq` is given, the event's sequence number in the history of recent
+    events (and the history's `epoch`) are included in the notification.
+
+    Returns an :py:class:`AnnotationEvent`.
     """
     action = message['action']
 
-    if action == 'read':
-        return None
+    read_permissions = serialized.get('permissions', {}).get('read', [])
+    read_principals = frozenset(translate_annotation_principals(read_permissions))
+
+    notification = {
+        'type': 'annotation-notification',
+        'options': {'action': action},
+        'payload': [serialized],
+    }
+    if action == 'delete':
+        notification['payload'] = [{'id': annotation_id}]
+    if seq is not None:
+        notification['epoch'] = epoch
+        notification['seq'] = seq
+
+    return AnnotationEvent(action=action,
+                           src_client_id=message['src_client_id'],
+                           userid=userid,
+                           user_nipsad=user_nipsad,
+                           target=FoldedTarget(serialized),
+                           read_principals=read_principals,
+                           notification=websocket.JSONMessage(notification))
+
+
+def _buffer_event(event, serialized):
+    """Return the :py:class:`BufferedEvent` to keep for replaying `event`."""
+    target = None
+    if event.action == 'delete':
+        # The notifications of deleted annotations only include their ids.
+        target = json.dumps(serialized)
+    return BufferedEvent(action=event.action,
+                         src_client_id=event.src_client_id,
+                         userid=event.userid,
+                         user_nipsad=event.user_nipsad,
+                         read_principals=event.read_principals,
+                         target=target,
+                         notification=event.notification.data)
+
+
+def _buffered_size(buffered):
+    """
+    Return the approximate size in bytes of `buffered`.
+
+    This is the size of the encoded notification and annotation, which are the
+    bulk of the memory it uses, plus the size of the user and principals.
+    """
+    size = len(buffered.notification) + len(buffered.userid or '')
+    if buffered.target is not None:
+        size += len(buffered.target)
+    return size + sum(len(p) for p in buffered.read_principals)
+
+
+def _replay_event(buffered):
+    """Return the :py:class:`AnnotationEvent` for replaying `buffered`."""
+    if buffered.target is None:
+        target = json.loads(buffered.notification)['payload'][0]
+    else:
+        target = json.loads(buffered.target)
+    return AnnotationEvent(action=buffered.action,
+                           src_client_id=buffered.src_client_id,
+                           userid=buffered.userid,
+                           user_nipsad=buffered.user_nipsad,
+                           target=FoldedTarget(target),
+                           read_principals=buffered.read_principals,
+                           notification=websocket.JSONMessage.encoded(buffered.notification))
+
+
+def _generate_annotation_event(event, socket):
+    """
+    Get message about rendered annotation event `event` to be sent to `socket`.
+
+    Decides whether or not the passed socket should receive notification of
+    the event.
 
-    if message['src_client_id'] == socket.client_id:
+    Returns None if the socket should not receive any message about this
+    annotation event, otherwise the pre-encoded notification message.
+    """
+    if event.src_client_id == socket.client_id:
         return None
 
     # We don't send anything until we have received a filter from the client
@@ -136,31 +394,19 @@ def _generate_annotation_event(message, socket, annotation, user_nipsad, group_s
 
     # Don't sent annotations from NIPSA'd users to anyone other than that
     # user.
-    if user_nipsad and socket.authenticated_userid != annotation.userid:
+    if event.user_nipsad and socket.authenticated_userid != event.userid:
         return None
 
-    notification = {
-        'type': 'annotation-notification',
-        'options': {'action': action},
-    }
-
-    base_url = socket.registry.settings.get('h.app_url',
-                                            'http://localhost:5000')
-    links_service = LinksService(base_url, socket.registry)
-    resource = AnnotationResource(annotation, group_service, links_service)
-    serialized = presenters.AnnotationJSONPresenter(resource).asdict()
-
-    permissions = serialized.get('permissions')
-    if not _authorized_to_read(socket.effective_principals, permissions):
+    # Only send the annotation to sockets which are authorized to read it. If
+    # the annotation belongs to a private group, this rules out sockets whose
+    # user isn't a member of that group.
+    if event.read_principals.isdisjoint(socket.effective_principals):
         return None
 
-    if not socket.filter.match(serialized, action):
+    if not socket.filter.match(event.target, event.action):
         return None
 
-    notification['payload'] = [serialized]
-    if action == 'delete':
-        notification['payload'] = [{'id': annotation.id}]
-    return notification
+    return event.notification
 
 
 def _generate_user_event(message, socket):
@@ -184,16 +430,3 @@ def _generate_user_event(message, socket):
         'action': message['type'],
         'model': message['session_model']
     }
-
-
-def _authorized_to_read(effective_principals, permissions):
-    """Return True if the passed request is authorized to read the annotation.
-
-    If the annotation belongs to a private group, this will return False if the
-    authenticated user isn't a member of that group.
-    """
-    read_permissions = permissions.get('read', [])
-    read_principals = translate_annotation_principals(read_permissions)
-    if set(read_principals).intersection(effective_principals):
-        return True
-    return False
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""
+A process-wide set of NIPSA'd userids for the streamer.
+
+Checking whether the author of an annotation is NIPSA'd is done for every
+annotation event, so rather than querying the database each time the streamer
+keeps the (small) set of flagged userids in memory. The set is loaded on
+first use, updated as "nipsa-change" user events arrive, and periodically
+reloaded in full to pick up any changes whose events were missed.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+
+import gevent
+
+from h.models import User
+
+log = logging.getLogger(__name__)
+
+# How often to reload the set of flagged userids in full (in seconds).
+REFRESH_INTERVAL = 300
+
+
+class FlaggedUsers(object):
+
+    """The set of NIPSA'd userids."""
+
+    def __init__(self):
+        self._userids = frozenset()
+        self.loaded = False
+
+    def __contains__(self, userid):
+        return userid in self._userids
+
+    def __len__(self):
+        return len(self._userids)
+
+    def is_flagged(self, userid, session):
+        """
+        Return whether `userid` is flagged as NIPSA.
+
+        The set is loaded using `session` if it has not been loaded yet.
+        """
+        if not self.loaded:
+            self.refresh(session)
+        return userid in self._userids
+
+    def refresh(self, session):
+        """Reload the set of flagged userids from the database."""
+        query = session.query(User.username, User.authority).filter_by(nipsa=True)
+        self._userids = frozenset('acct:{}@{}'.format(username, authority)
+                                  for username, authority in query)
+        self.loaded = True
+
+    def update(self, userid, nipsa):
+        """Record a change to the NIPSA flag of `userid`."""
+        if nipsa:
+            self._userids = self._userids | {userid}
+        else:
+            self._userids = self._userids - {userid}
+
+
+FLAGGED_USERS = FlaggedUsers()
+
+
+def refresh_periodically(settings, session_factory, interval=REFRESH_INTERVAL):
+    """Reload :py:data:`FLAGGED_USERS` in full every `interval` seconds."""
+    while True:
+        session = session_factory(settings)
+        try:
+            FLAGGED_USERS.refresh(session)
+        except Exception:
+            log.exception('failed to refresh NIPSA flagged users')
+            session.rollback()
+        else:
+            session.commit()
+        finally:
+            session.close()
+        gevent.sleep(interval)
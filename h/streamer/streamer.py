@@ -7,7 +7,9 @@ import gevent
 
 from h import db
 from h import stats
+from h.streamer import history
 from h.streamer import messages
+from h.streamer import nipsa
 from h.streamer import websocket
 
 log = logging.getLogger(__name__)
@@ -20,6 +22,16 @@ log = logging.getLogger(__name__)
 # using .put(...) with a timeout or .put_nowait(...) as appropriate.
 WORK_QUEUE = gevent.queue.Queue(maxsize=4096)
 
+# The default number of greenlets processing messages from the work queue.
+# Each one holds a database connection from a shared pool. This can be
+# overridden with the `h.streamer.workers` setting.
+DEFAULT_WORKERS = 1
+
+# The maximum number of messages waiting for each worker greenlet when there
+# is more than one. When these are full the dispatcher blocks, and messages
+# back up into (and are eventually dropped from) the work queue.
+WORKER_QUEUE_SIZE = 256
+
 # Message queues that the streamer processes messages from
 ANNOTATION_TOPIC = 'annotation'
 USER_TOPIC = 'user'
@@ -38,6 +50,22 @@ def start(event):
     The function does not block.
     """
     settings = event.app.registry.settings
+    workers = int(settings.get('h.streamer.workers', DEFAULT_WORKERS))
+    history.RECENT_EVENTS = history.EventHistory(
+        max_events=int(settings.get('h.streamer.history_size',
+                                    history.DEFAULT_MAX_EVENTS)),
+        max_bytes=int(settings.get('h.streamer.history_max_bytes',
+                                   history.DEFAULT_MAX_BYTES)))
+    session_factory = _make_session_factory(settings, pool_size=workers)
+
+    # With a single worker it can process the work queue directly. Otherwise,
+    # a dispatcher routes each message to one of the workers' own queues.
+    if workers > 1:
+        worker_queues = [gevent.queue.Queue(maxsize=WORKER_QUEUE_SIZE)
+                         for _ in range(workers)]
+    else:
+        worker_queues = [WORK_QUEUE]
+
     greenlets = [
         # Start greenlets to process messages from RabbitMQ
         gevent.spawn(messages.process_messages,
@@ -49,16 +77,41 @@ def start(event):
                      USER_TOPIC,
                      WORK_QUEUE),
         # A greenlet to periodically report to statsd
-        gevent.spawn(report_stats, settings),
-        # And one to process the queued work
-        gevent.spawn(process_work_queue, settings, WORK_QUEUE)
+        gevent.spawn(report_stats, settings, worker_queues),
+        # A greenlet to periodically reload the NIPSA'd users
+        gevent.spawn(nipsa.refresh_periodically, settings, session_factory),
     ]
 
+    if workers > 1:
+        greenlets.append(gevent.spawn(dispatch_work_queue,
+                                      WORK_QUEUE,
+                                      worker_queues))
+
+    # And the greenlets to process the queued work
+    for queue in worker_queues:
+        greenlets.append(gevent.spawn(process_work_queue,
+                                      settings,
+                                      queue,
+                                      session_factory=session_factory))
+
     # Start a "greenlet of last resort" to monitor the worker greenlets and
     # bail if any unexpected errors occur.
     gevent.spawn(supervise, greenlets)
 
 
+def dispatch_work_queue(queue, worker_queues):
+    """
+    Route each message from `queue` to one of `worker_queues`.
+
+    Messages are partitioned so that all the messages from a given websocket,
+    and all the realtime messages about a given annotation or user, are routed
+    to the same worker. Each worker processes its messages in turn, so these
+    are handled in the order in which they were received.
+    """
+    for msg in queue:
+        worker_queues[_partition(msg, len(worker_queues))].put(msg)
+
+
 def process_work_queue(settings, queue, session_factory=None):
     """
     Process each message from the queue in turn, handling exceptions.
@@ -111,12 +164,22 @@ def process_work_queue(settings, queue, session_factory=None):
         s.send()
 
 
-def report_stats(settings):
+def report_stats(settings, worker_queues=()):
     client = stats.get_client(settings)
     while True:
-        client.gauge('streamer.connected_clients',
-                     len(websocket.WebSocket.instances))
+        sockets = list(websocket.WebSocket.instances)
+        client.gauge('streamer.connected_clients', len(sockets))
         client.gauge('streamer.queue_length', WORK_QUEUE.qsize())
+        client.gauge('streamer.worker_queue_length',
+                     max([q.qsize() for q in worker_queues] or [0]))
+        client.gauge('streamer.outbox.max_length',
+                     max([s.outbox_size for s in sockets] or [0]))
+        client.timing('streamer.outbox.max_lag',
+                      int(max([s.outbox_lag for s in sockets] or [0]) * 1000))
+        for key in ('dropped', 'disconnected'):
+            count = websocket.OUTBOX_STATS.pop(key, 0)
+            if count:
+                client.incr('streamer.outbox.' + key, count)
         gevent.sleep(10)
 
 
@@ -138,3 +201,30 @@ def supervise(greenlets):
 def _get_session(settings):
     engine = db.make_engine(settings)
     return db.Session(bind=engine)
+
+
+def _make_session_factory(settings, pool_size):
+    """
+    Return a session factory for the work queue greenlets.
+
+    The sessions share a single engine, with a connection pool large enough
+    for each greenlet to hold a connection.
+    """
+    engine = db.make_engine(settings, pool_size=pool_size)
+
+    def session_factory(_):
+        return db.Session(bind=engine)
+
+    return session_factory
+
+
+def _partition(msg, count):
+    """Return the index of the worker which should process `msg`."""
+    if isinstance(msg, websocket.Message):
+        key = id(msg.socket)
+    elif isinstance(msg, messages.Message) and isinstance(msg.payload, dict):
+        key = (msg.topic,
+               msg.payload.get('annotation_id') or msg.payload.get('userid'))
+    else:
+        key = None
+    return hash(key) % count
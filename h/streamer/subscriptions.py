@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+An inverted index of streamer filter subscriptions.
+
+Almost every filter sent to us by a client consists of a single clause
+matching the annotation's URI against a (backend-expanded) list of URIs. Rather
+than evaluating every connected socket's filter for every annotation event, we
+index sockets by the values of the clauses they subscribe to, so that an event
+only needs to be checked against the sockets which could possibly match it.
+
+The index is deliberately conservative: it only ever narrows the set of sockets
+which are considered for an event, and the full filter is still evaluated for
+each candidate socket. Filters which can't be expressed as a set of lookup keys
+(such as those using an "exclude" match policy, or substring matches) are
+registered as wildcards and are returned for every event.
+"""
+
+from __future__ import unicode_literals
+
+import weakref
+
+from jsonpointer import resolve_pointer
+
+from h import realtime
+from h._compat import string_types
+from h.util.text import uni_fold
+
+# The filter fields which we index. Each of these is expected to resolve to a
+# single string value in the serialized annotation.
+INDEXED_FIELDS = ('/uri', '/group', '/user')
+
+
+class SubscriptionIndex(object):
+
+    """
+    A mapping from filter clause values to the sockets interested in them.
+
+    Sockets are held by weak reference, so a socket which is garbage collected
+    without being explicitly removed will silently drop out of the index.
+    """
+
+    def __init__(self):
+        self._by_key = {}
+        self._wildcards = weakref.WeakSet()
+        self._keys = weakref.WeakKeyDictionary()
+        self._routing_keys = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, socket, filter_):
+        """
+        Register (or re-register) `socket` as subscribing with `filter_`.
+
+        Any existing registration for the socket is replaced.
+
+        :param socket: the socket which set the filter
+        :param filter_: the filter JSON, with any URI clauses already expanded
+        :type filter_: dict
+        """
+        self.remove(socket)
+        self._routing_keys = None
+
+        keys = _index_keys(filter_)
+        if keys is None:
+            self._wildcards.add(socket)
+            self._keys[socket] = None
+            return
+
+        for key in keys:
+            self._by_key.setdefault(key, weakref.WeakSet()).add(socket)
+        self._keys[socket] = keys
+
+    def remove(self, socket):
+        """Remove any registration for `socket` from the index."""
+        try:
+            keys = self._keys.pop(socket)
+        except KeyError:
+            return
+
+        self._routing_keys = None
+
+        if keys is None:
+            self._wildcards.discard(socket)
+            return
+
+        for key in keys:
+            sockets = self._by_key.get(key)
+            if sockets is None:
+                continue
+            sockets.discard(socket)
+            if not sockets:
+                del self._by_key[key]
+
+    def sockets_for(self, target):
+        """
+        Return the sockets whose filters could match `target`.
+
+        :param target: the serialized annotation (or a dict containing at
+                       least its indexed fields)
+        :type target: dict
+
+        :rtype: list
+        """
+        result = set(self._wildcards)
+        for field in INDEXED_FIELDS:
+            value = resolve_pointer(target, field, None)
+            if value is None:
+                continue
+            sockets = self._by_key.get((field, uni_fold(value)))
+            if sockets:
+                result.update(sockets)
+        return list(result)
+
+    def routing_keys(self):
+        """
+        Return the realtime binding keys for the events sockets subscribe to.
+
+        These are the topic exchange binding keys (see
+        :py:func:`h.realtime.annotation_binding_key`) which together match
+        every annotation event that could match a subscribed socket's filter.
+        The result is cached until the index next changes.
+
+        :rtype: frozenset
+        """
+        if self._routing_keys is None:
+            self._routing_keys = self._compute_routing_keys()
+        return self._routing_keys
+
+    def _compute_routing_keys(self):
+        if self._wildcards:
+            return frozenset([realtime.annotation_binding_key()])
+
+        keys = set()
+        for (field, value), sockets in self._by_key.items():
+            if not sockets:
+                continue
+            if field == '/uri':
+                keys.add(realtime.annotation_binding_key(uri=value))
+            elif field == '/group':
+                keys.add(realtime.annotation_binding_key(groupid=value))
+            else:
+                # Events can't be routed by any other field.
+                return frozenset([realtime.annotation_binding_key()])
+        return frozenset(keys)
+
+
+def _index_keys(filter_):
+    """
+    Return the set of index keys under which to register `filter_`.
+
+    Returns None if the filter can't be indexed and must be considered a
+    candidate for every event.
+    """
+    clauses = filter_.get('clauses', [])
+    if not clauses:
+        return None
+
+    policy = filter_.get('match_policy')
+    clause_keys = [_clause_keys(c) for c in clauses]
+
+    if policy == 'include_any':
+        # Every clause must be indexable, because any one of them matching is
+        # enough for the filter to match.
+        if any(keys is None for keys in clause_keys):
+            return None
+        return frozenset().union(*clause_keys)
+
+    if policy == 'include_all':
+        # Every clause must match, so any single indexable clause is enough to
+        # rule out events. Pick the most selective one.
+        indexable = [keys for keys in clause_keys if keys is not None]
+        if not indexable:
+            return None
+        return min(indexable, key=len)
+
+    return None
+
+
+def _clause_keys(clause):
+    """
+    Return the index keys for a single filter clause.
+
+    Returns None if the clause can't be expressed as an equality test against
+    one of a set of values.
+    """
+    field = clause.get('field')
+    if field not in INDEXED_FIELDS:
+        return None
+
+    operator = clause.get('operator')
+    value = clause.get('value')
+
+    if isinstance(value, list) and operator in ('one_of', 'matches'):
+        values = value
+    elif not isinstance(value, list) and operator == 'equals':
+        values = [value]
+    else:
+        return None
+
+    if not all(isinstance(v, string_types) for v in values):
+        return None
+
+    return frozenset((field, uni_fold(v)) for v in values)
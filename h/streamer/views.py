@@ -11,12 +11,18 @@ from h.streamer import streamer, websocket
 
 @view_config(route_name='ws')
 def websocket_view(request):
+    settings = request.registry.settings
+
     # Provide environment which the WebSocket handler can use...
     request.environ.update({
         'h.ws.authenticated_userid': request.authenticated_userid,
         'h.ws.effective_principals': request.effective_principals,
         'h.ws.registry': request.registry,
         'h.ws.streamer_work_queue': streamer.WORK_QUEUE,
+        'h.ws.outbox_size': int(settings.get('h.streamer.outbox_size',
+                                             websocket.DEFAULT_OUTBOX_SIZE)),
+        'h.ws.slow_client_policy': settings.get('h.streamer.slow_client_policy',
+                                                'drop'),
     })
 
     # ...and ensure that any persistent connections associated with this
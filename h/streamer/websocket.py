@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 
+from collections import Counter
 from collections import namedtuple
 import copy
 import json
 import logging
+import socket
+import time
 import weakref
 
+import gevent
 from gevent.queue import Full
+from gevent.queue import Queue
 import jsonschema
+from ws4py.messaging import TextMessage
 from ws4py.websocket import WebSocket as _WebSocket
 
 from h import storage
 from h.streamer import filter
+from h.streamer import history
+from h.streamer.subscriptions import SubscriptionIndex
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +27,13 @@ log = logging.getLogger(__name__)
 # below.
 MESSAGE_HANDLERS = {}
 
+# The default maximum number of messages waiting to be sent to each client.
+DEFAULT_OUTBOX_SIZE = 256
+
+# Counts of messages dropped and clients disconnected because their outboxes
+# were full, since they were last reported to statsd.
+OUTBOX_STATS = Counter()
+
 
 # An incoming message from a WebSocket client.
 class Message(namedtuple('Message', [
@@ -42,13 +57,49 @@ class Message(namedtuple('Message', [
         self.socket.send_json(data)
 
 
+class JSONMessage(TextMessage):
+    """
+    An outgoing JSON message which can be sent to any number of websockets.
+
+    The payload is serialized when the message is created, and the websocket
+    frame is built the first time the message is sent and reused thereafter,
+    so broadcasting a message to many clients costs a single encode.
+    """
+
+    def __init__(self, payload):
+        super(JSONMessage, self).__init__(json.dumps(payload))
+        self._frame = None
+
+    @classmethod
+    def encoded(cls, data):
+        """Return a message of `data`, a payload already encoded as JSON."""
+        message = cls.__new__(cls)
+        super(JSONMessage, message).__init__(data)
+        message._frame = None
+        return message
+
+    def single(self, mask=False):
+        # Masked frames use a fresh random key each time, so can't be shared.
+        # Servers never mask frames they send, so this is the uncommon case.
+        if mask:
+            return super(JSONMessage, self).single(mask=mask)
+        if self._frame is None:
+            self._frame = super(JSONMessage, self).single()
+        return self._frame
+
+
 class WebSocket(_WebSocket):
     # All instances of WebSocket, allowing us to iterate over open websockets
     instances = weakref.WeakSet()
 
+    # An index of the filters set by open websockets, allowing us to find the
+    # sockets interested in a given annotation without checking every one
+    subscriptions = SubscriptionIndex()
+
     # Instance attributes
     client_id = None
     filter = None
+    filter_seq = None
     query = None
 
     def __init__(self, sock, protocols=None, extensions=None, environ=None):
@@ -64,6 +115,17 @@ class WebSocket(_WebSocket):
 
         self._work_queue = environ['h.ws.streamer_work_queue']
 
+        # Messages to the client are queued here and sent by a greenlet of
+        # their own, so that a slow client can't hold up sending to others.
+        self._outbox = Queue(maxsize=environ.get('h.ws.outbox_size',
+                                                 DEFAULT_OUTBOX_SIZE))
+        # What to do when the outbox is full: "drop" discards the message, and
+        # "disconnect" closes the connection to the client.
+        self._slow_client_policy = environ.get('h.ws.slow_client_policy',
+                                               'drop')
+        self._sender = None
+        self._disconnecting = False
+
     def __new__(cls, *args, **kwargs):
         instance = super(WebSocket, cls).__new__(cls, *args, **kwargs)
         cls.instances.add(instance)
@@ -82,15 +144,74 @@ class WebSocket(_WebSocket):
             log.warn('Streamer work queue full! Unable to queue message from '
                      'WebSocket client having waited 0.1s: giving up.')
 
+    def opened(self):
+        self._sender = gevent.spawn(self._send_outbox)
+
     def closed(self, code, reason=None):
         try:
             self.instances.remove(self)
         except KeyError:
             pass
+        self.subscriptions.remove(self)
+        if self._sender is not None:
+            self._sender.kill(block=False)
+
+    @property
+    def outbox_size(self):
+        """The number of messages waiting to be sent to the client."""
+        return self._outbox.qsize()
+
+    @property
+    def outbox_lag(self):
+        """How long (in seconds) the oldest unsent message has been waiting."""
+        try:
+            queued_at, _ = self._outbox.peek_nowait()
+        except gevent.queue.Empty:
+            return 0
+        return time.time() - queued_at
 
     def send_json(self, payload):
-        if not self.terminated:
-            self.send(json.dumps(payload))
+        """
+        Queue `payload` to be sent to the client.
+
+        If the client's outbox is full, the message is dropped or the client
+        is disconnected, according to the slow client policy.
+
+        :param payload: a JSON-serializable object, or a :py:class:`JSONMessage`
+                        prepared ahead of time
+        """
+        if self.terminated or self._disconnecting:
+            return
+        if not isinstance(payload, JSONMessage):
+            payload = JSONMessage(payload)
+        try:
+            self._outbox.put_nowait((time.time(), payload))
+        except Full:
+            self._outbox_full()
+
+    def _outbox_full(self):
+        if self._slow_client_policy == 'disconnect':
+            log.info('disconnecting slow websocket client: outbox full')
+            OUTBOX_STATS['disconnected'] += 1
+            self._disconnecting = True
+            # Shutting down the socket, rather than sending a close frame which
+            # the client isn't reading, ends the connection's read loop which
+            # then cleans up as usual.
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, socket.error):
+                pass
+        else:
+            OUTBOX_STATS['dropped'] += 1
+
+    def _send_outbox(self):
+        while True:
+            _, message = self._outbox.get()
+            try:
+                self.send(message)
+            except (RuntimeError, socket.error):
+                # The connection has been closed.
+                return
 
 
 def handle_message(message, session=None):
@@ -156,6 +277,10 @@ def handle_filter_message(message, session=None):
         # Add backend expands for clauses
         _expand_clauses(session, filter_)
     message.socket.filter = filter.FilterHandler(filter_)
+    # Record the last event before the filter was set, from which point the
+    # client is sent events as they happen.
+    message.socket.filter_seq = history.RECENT_EVENTS.last_seq
+    WebSocket.subscriptions.update(message.socket, filter_)
 MESSAGE_HANDLERS['filter'] = handle_filter_message
 
 
@@ -196,7 +321,7 @@ def _expand_uris(session, clause):
     if not isinstance(uris, list):
         uris = [uris]
 
-    for item in uris:
-        expanded.update(storage.expand_uri(session, item))
+    for item_uris in storage.expand_uris(session, uris).values():
+        expanded.update(item_uris)
 
     clause['value'] = list(expanded)
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
+from pyramid.settings import asbool
 
 from h import __version__
 from h import emails
+from h import presenters
+from h import realtime
 from h import storage
+from h.interfaces import IGroupService
 from h.notification import reply
+from h.resources import AnnotationResource
 from h.tasks import mailer
 
 
@@ -31,12 +36,46 @@ def add_renderer_globals(event):
 
 def publish_annotation_event(event):
     """Publish an annotation event to the message queue."""
+    request = event.request
     data = {
         'action': event.action,
         'annotation_id': event.annotation_id,
-        'src_client_id': event.request.headers.get('X-Client-Id'),
+        'src_client_id': request.headers.get('X-Client-Id'),
     }
-    event.request.realtime.publish_annotation(data)
+    kwargs = {}
+
+    # If enabled, include the presented annotation in the message so that
+    # the streamer processes don't each need to fetch it from the database.
+    # If the topic exchange is in use, the message is routed by the
+    # annotation's group and URI.
+    settings = request.registry.settings
+    embed = asbool(settings.get('h.realtime.embed_annotations', False))
+    topic = realtime.use_topic_exchange(settings)
+    if (embed or topic) and event.action != 'read':
+        with request.tm:
+            annotation = storage.fetch_annotation(request.db,
+                                                  event.annotation_id)
+            if annotation is not None:
+                if embed:
+                    data['annotation'] = _present_for_realtime(request,
+                                                               annotation)
+                kwargs = {'groupid': annotation.groupid,
+                          'uri': annotation.target_uri}
+
+    request.realtime.publish_annotation(data, **kwargs)
+
+
+def _present_for_realtime(request, annotation):
+    """
+    Return the annotation as presented to streamer clients.
+
+    This matches the presentation in :py:mod:`h.streamer.messages`, which
+    doesn't include any of the user-specific formatting done by the API.
+    """
+    group_service = request.find_service(IGroupService)
+    links_service = request.find_service(name='links')
+    resource = AnnotationResource(annotation, group_service, links_service)
+    return presenters.AnnotationJSONPresenter(resource).asdict()
 
 
 def send_reply_notifications(event,
@@ -7,6 +7,7 @@ from datetime import datetime, timedelta
 from h import models
 from h.celery import celery
 from h.celery import get_task_logger
+from h.tasks.indexer import THREAD_ROOT_DELAY
 
 
 log = get_task_logger(__name__)
@@ -43,6 +44,21 @@ def purge_expired_tokens():
         .delete()
 
 
+@celery.task
+def purge_scheduled_thread_roots():
+    """
+    Remove the records of thread roots scheduled to be reindexed a while ago.
+
+    Once :py:data:`h.tasks.indexer.THREAD_ROOT_DELAY` seconds have passed
+    since a thread root was scheduled, its record no longer stops it being
+    scheduled again.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=THREAD_ROOT_DELAY)
+    celery.request.db.query(models.ScheduledThreadRoot) \
+        .filter(models.ScheduledThreadRoot.scheduled < cutoff) \
+        .delete()
+
+
 @celery.task
 def purge_removed_features():
     """Remove old feature flags from the database."""
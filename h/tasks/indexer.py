@@ -1,12 +1,43 @@
 # -*- coding: utf-8 -*-
 
+import os
+from collections import OrderedDict
+
+from celery.contrib.batches import Batches
+
 from h import models, storage
 from h.celery import celery, get_task_logger
 from h.indexer.reindexer import SETTING_NEW_INDEX
-from h.search.index import BatchIndexer, delete, index
+from h.search.index import BatchIndexer, delete, fetch_annotations, index
+from h.util.cache import ExpiringLRUCache
 
 log = get_task_logger(__name__)
 
+#: The maximum number of messages which :py:func:`sync_annotation` processes
+#: in one batch, and the maximum time (in seconds) it waits for a batch to
+#: fill up before processing it anyway. Workers which consume these messages
+#: need a prefetch limit of at least the batch size (see
+#: :py:func:`h.celery.check_indexer_prefetch`).
+#:
+#: These are read from the environment rather than from the app's settings
+#: because they're needed to define the task, before the settings are loaded.
+BATCH_SIZE = int(os.environ.get('INDEXER_BATCH_SIZE', 100))
+BATCH_WAIT = float(os.environ.get('INDEXER_BATCH_WAIT', 1))
+
+#: How many times an annotation is requeued after it fails to be indexed in a
+#: batch.
+BATCH_MAX_RETRIES = 3
+
+#: How long (in seconds) the reindexing of a thread root is delayed after one
+#: of its replies has been indexed. Replies which are indexed in the meantime,
+#: by any worker, don't schedule the root to be reindexed again.
+THREAD_ROOT_DELAY = int(os.environ.get('INDEXER_THREAD_ROOT_DELAY', 10))
+
+#: The thread roots which this worker process has scheduled to be reindexed,
+#: so that it only needs to check whether other processes have scheduled the
+#: roots it hasn't.
+SCHEDULED_THREAD_ROOTS = ExpiringLRUCache(maxsize=10000, ttl=THREAD_ROOT_DELAY)
+
 
 @celery.task
 def add_annotation(id_):
@@ -22,7 +53,8 @@ def add_annotation(id_):
                   target_index=future_index)
 
         if annotation.is_reply:
-            add_annotation.delay(annotation.thread_root_id)
+            _reindex_thread_roots([annotation.thread_root_id])
+
 
 @celery.task
 def delete_annotation(id_):
@@ -35,6 +67,47 @@ def delete_annotation(id_):
         delete(celery.request.es, id_, target_index=future_index)
 
 
+@celery.task(base=Batches, flush_every=BATCH_SIZE, flush_interval=BATCH_WAIT)
+def sync_annotation(requests):
+    """
+    Index or delete annotations in batches.
+
+    This is the batched form of :py:func:`add_annotation` and
+    :py:func:`delete_annotation`. Each message has the annotation id and the
+    action (``create``, ``update`` or ``delete``) which was taken on it.
+
+    The messages in a batch are coalesced by annotation, the annotations are
+    loaded in one query, and the changes are sent to Elasticsearch in one bulk
+    request. Whether an annotation is indexed or marked as deleted depends on
+    its state in the database rather than on the order of the messages.
+
+    The messages are only acknowledged after the batch has been processed,
+    and annotations which fail to index are requeued, so every annotation is
+    indexed at least once.
+    """
+    retries = OrderedDict()
+    deletes = set()
+    for req in requests:
+        id_, action = req.args
+        retries[id_] = max(retries.get(id_, 0), req.kwargs.get('retries', 0))
+        if action == 'delete':
+            deletes.add(id_)
+
+    # Batches tasks don't send the task signals which reset the request
+    # between tasks (see h.celery), so that is done here.
+    celery.request.find_service(name='nipsa').clear()
+    try:
+        errored = _sync_annotations(celery.request, list(retries), deletes)
+    except Exception:
+        _requeue(retries, retries, deletes)
+        raise
+    finally:
+        celery.request.tm.abort()
+
+    if errored:
+        _requeue(errored, retries, deletes)
+
+
 @celery.task
 def reindex_user_annotations(userid):
     ids = [a.id for a in celery.request.db.query(models.Annotation.id).filter_by(userid=userid)]
@@ -45,6 +118,64 @@ def reindex_user_annotations(userid):
         log.warning('Failed to re-index annotations %s', errored)
 
 
+def _sync_annotations(request, ids, deletes):
+    annotations = fetch_annotations(request.db, ids)
+    found = set(a.id for a in annotations)
+    indexed = [a for a in annotations if not a.deleted]
+    deleted_ids = ([a.id for a in annotations if a.deleted] +
+                   [id_ for id_ in ids if id_ in deletes and id_ not in found])
+
+    # Send the whole batch in one bulk request (per index).
+    targets = [None]
+    future_index = _current_reindex_new_name(request)
+    if future_index is not None:
+        targets.append(future_index)
+    errored = set()
+    for target_index in targets:
+        indexer = BatchIndexer(request.db, request.es, request,
+                               target_index=target_index,
+                               chunk_size=len(ids))
+        errored.update(indexer.sync(indexed, deleted_ids))
+
+    # Replies change the document of their thread root. Roots which are in
+    # this batch have just been indexed with their replies.
+    roots = set(a.thread_root_id for a in indexed if a.is_reply) - set(ids)
+    _reindex_thread_roots(roots)
+
+    return errored
+
+
+def _reindex_thread_roots(roots):
+    """
+    Schedule the given thread roots to be reindexed, unless they already are.
+
+    A root is reindexed :py:data:`THREAD_ROOT_DELAY` seconds after it is first
+    scheduled, which picks up all of the replies indexed until then, so busy
+    threads don't have their root reindexed for every reply. Which roots have
+    been scheduled is recorded in the database (see
+    :py:class:`h.models.ScheduledThreadRoot`), so that this holds across all
+    worker processes.
+    """
+    engine = celery.request.db.bind
+    for root in roots:
+        if (SCHEDULED_THREAD_ROOTS.get(root) or
+                not models.ScheduledThreadRoot.claim(engine, root, THREAD_ROOT_DELAY)):
+            celery.request.stats.incr('indexer.thread_root.skipped')
+            continue
+        SCHEDULED_THREAD_ROOTS.set(root, True)
+        celery.request.stats.incr('indexer.thread_root.scheduled')
+        add_annotation.apply_async((root,), countdown=THREAD_ROOT_DELAY)
+
+
+def _requeue(ids, retries, deletes):
+    for id_ in ids:
+        action = 'delete' if id_ in deletes else 'update'
+        if retries[id_] >= BATCH_MAX_RETRIES:
+            log.error('Failed to %s annotation %s', action, id_)
+            continue
+        sync_annotation.delay(id_, action, retries=retries[id_] + 1)
+
+
 def _current_reindex_new_name(request):
     settings = celery.request.find_service(name='settings')
     new_index = settings.get(SETTING_NEW_INDEX)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import collections
+import threading
+import time
+
+
+class ExpiringLRUCache(object):
+    """
+    A bounded, thread-safe mapping whose entries expire after a while.
+
+    Up to `maxsize` entries are kept, with the least recently used entry being
+    evicted to make room for a new one. If `maxbytes` is given, entries are
+    also evicted while the total of the sizes they were set with exceeds it.
+    The sizes are given by the caller, and are usually approximate.
+
+    Entries older than `ttl` seconds are treated as missing, which bounds how
+    stale a value can get when it can be changed by other processes that can't
+    invalidate this cache.
+
+    The number of hits and misses are recorded in the `hits` and `misses`
+    attributes.
+
+    Example::
+
+        cache = ExpiringLRUCache(maxsize=1000, ttl=60)
+
+        cache.get('foo')         # => None
+        cache.set('foo', 'bar')
+        cache.get('foo')         # => 'bar'
+        cache.invalidate(['foo'])
+        cache.get('foo')         # => None
+    """
+
+    def __init__(self, maxsize=128, ttl=60, clock=time.time, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value cached for `key`, or `default` if there isn't one."""
+        with self._lock:
+            entry = self._pop(key)
+            if entry is None or entry[0] <= self._clock():
+                self.misses += 1
+                return default
+
+            # Re-insert the entry to mark it as the most recently used.
+            self._entries[key] = entry
+            self._bytes += entry[2]
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, size=0):
+        """
+        Cache `value` for `key`, evicting the least recently used entries if full.
+
+        `size` is the size of the entry in bytes, which only matters if the
+        cache has a `maxbytes` limit. Values larger than the limit aren't
+        cached.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._pop(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._entries[key] = (self._clock() + self.ttl, value, size)
+            self._bytes += size
+            while (len(self._entries) > self.maxsize or
+                   (self.maxbytes is not None and self._bytes > self.maxbytes)):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def invalidate(self, keys):
+        """Remove any entries cached for `keys`."""
+        with self._lock:
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+        return entry
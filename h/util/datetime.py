@@ -2,7 +2,18 @@
 
 """Shared utility functions for manipulating dates and times."""
 
+from __future__ import absolute_import
+
+import datetime as _datetime
+
+UTC_ISO8601_FORMAT = '%Y-%m-%dT%H:%M:%S.%f+00:00'
+
 
 def utc_iso8601(datetime):
     """Convert a UTC datetime into an ISO8601 timestamp string."""
-    return datetime.strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
+    return datetime.strftime(UTC_ISO8601_FORMAT)
+
+
+def parse_utc_iso8601(timestamp):
+    """Convert an ISO8601 timestamp string from :py:func:`utc_iso8601` into a UTC datetime."""
+    return _datetime.datetime.strptime(timestamp, UTC_ISO8601_FORMAT)
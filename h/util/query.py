@@ -5,61 +5,52 @@
 import sqlalchemy as sa
 
 
-def column_windows(session, column, windowsize=2000, where=None):
+def keyset_windows(session, columns, windowsize=2000, where=None):
     """
-    Return a series of WHERE clauses against a given column that break it into
-    windows.
+    Return a series of WHERE clauses against the given columns that break
+    the rows they are from into windows.
+
+    The windows are ordered by `columns`, which must uniquely identify a row,
+    for example ``[Annotation.updated, Annotation.id]``.
+
+    The windows are generated lazily using keyset pagination: each one is
+    found by fetching the key columns of the next `windowsize` rows after the
+    end of the previous window, which is an index range scan if there is an
+    index on `columns`. Rows which are inserted, or have their key changed, to
+    after the end of the latest window are included in later windows.
 
     :param session: the SQLAlchemy session object
-    :param column: the SQLAlchemy column object with which to generate windows
+    :param columns: the SQLAlchemy column objects with which to generate
+        windows
     :param windowsize: how many rows to include in each window
     :param where: an optional SQLAlchemy expression to filter the base query
 
     Returns an iterable of SQLAlchemy expressions which can be used in a
     .filter(...) clause.
     """
+    key = sa.tuple_(*columns)
 
-    # This function is adapted from a recipe supplied by the SQLAlchemy
-    # maintainers:
-    #
-    #   https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/WindowedRangeQuery
-    #
-    # In overview: we generate a list of all the possible values of `column`
-    # on the server, and then turn that list into a subquery with
-    # Query#from_self(). We then use the row number of the inner query to
-    # select every `windowsize`'th row. The resulting values are then
-    # translated into an iterable of SQLAlchemy expressions suitable for use
-    # in Query#filter(...).
-
-    def interval_for_range(start_id, end_id):
-        if end_id:
-            return sa.and_(
-                column >= start_id,
-                column < end_id
-            )
-        else:
-            return column >= start_id
-
-    q = session.query(
-        column,
-        sa.func.row_number().over(order_by=column).label('rownum')
-    )
-
+    q = session.query(*columns)
     if where is not None:
         q = q.filter(where)
+    q = q.order_by(*columns).limit(windowsize)
 
-    q = q.from_self(column)
+    start = None
+    while True:
+        window = q
+        if start is not None:
+            window = window.filter(key > tuple(start))
+        rows = window.all()
 
-    # Select every "windowsize'th" row from the inner query.
-    if windowsize > 1:
-        q = q.filter(sa.text("rownum %% %d=1" % windowsize))
+        if not rows:
+            return
+        end = tuple(rows[-1])
 
-    intervals = [id for id, in q]
-
-    while intervals:
-        start = intervals.pop(0)
-        if intervals:
-            end = intervals[0]
+        if start is None:
+            yield key <= end
         else:
-            end = None
-        yield interval_for_range(start, end)
+            yield sa.and_(key > start, key <= end)
+
+        if len(rows) < windowsize:
+            return
+        start = end
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""Shared utility functions for manipulating text."""
+
+import unicodedata
+
+from h._compat import text_type
+
+
+def uni_fold(text):
+    """
+    Return `text` case- and accent-folded, for comparing it with other text.
+
+    Byte strings are decoded as UTF-8 first. Values which aren't text are
+    returned unchanged.
+    """
+    # Convert bytes to text
+    if isinstance(text, bytes):
+        text = text_type(text, "utf-8")
+
+    # Do not touch other types
+    if not isinstance(text, text_type):
+        return text
+
+    text = text.lower()
+    text = unicodedata.normalize('NFKD', text)
+    return u"".join([c for c in text if not unicodedata.combining(c)])
@@ -5,6 +5,7 @@ from pyramid.view import view_config
 from sqlalchemy.exc import IntegrityError
 
 from h import models
+from h.models import blocklist
 from h.i18n import TranslationString as _
 
 
@@ -34,6 +35,8 @@ def badge_add(request):
         request.db.rollback()
         msg = _("{uri} is already blocked.").format(uri=uri)
         request.session.flash(msg, 'error')
+    else:
+        _invalidate_blocklist_after_commit(request)
 
     index = request.route_path('admin_badge')
     return httpexceptions.HTTPSeeOther(location=index)
@@ -47,6 +50,17 @@ def badge_add(request):
 def badge_remove(request):
     uri = request.params['remove']
     request.db.query(models.Blocklist).filter_by(uri=uri).delete()
+    _invalidate_blocklist_after_commit(request)
 
     index = request.route_path('admin_badge')
     return httpexceptions.HTTPSeeOther(location=index)
+
+
+def _invalidate_blocklist_after_commit(request):
+    # Until the change is committed, other requests still see the old
+    # blocklist, and could compile it again if it was invalidated now.
+    def invalidate(success):
+        if success:
+            blocklist.COMPILED_BLOCKLIST.invalidate()
+
+    request.tm.get().addAfterCommitHook(invalidate)
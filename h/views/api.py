@@ -16,8 +16,12 @@ particular, requests to the CRUD API endpoints are protected by the Pyramid
 authorization system. You can find the mapping between annotation "permissions"
 objects and Pyramid ACLs in :mod:`h.resources`.
 """
+import json
+
 from pyramid import i18n
 from pyramid import security
+from pyramid.response import Response
+from pyramid.settings import asbool
 import venusian
 
 from h import search as search_lib
@@ -181,20 +185,32 @@ def search(request):
     params = request.params.copy()
 
     separate_replies = params.pop('_separate_replies', False)
+    all_replies = params.pop('_all_replies', False)
     stats = getattr(request, 'stats', None)
+    present_from_source = asbool(
+        request.registry.settings.get('h.search.present_from_source', False))
     result = search_lib.Search(request,
                                separate_replies=separate_replies,
-                               stats=stats).run(params)
+                               stats=stats,
+                               all_replies=all_replies,
+                               use_cache=True,
+                               include_sources=present_from_source).run(params)
 
     svc = request.find_service(name='annotation_json_presentation')
 
     out = {
         'total': result.total,
-        'rows': svc.present_all(result.annotation_ids)
+        'rows': svc.present_all(result.annotation_ids, sources=result.sources)
     }
 
+    if result.cursor is not None:
+        out['cursor'] = result.cursor
+
     if separate_replies:
-        out['replies'] = svc.present_all(result.reply_ids)
+        if all_replies:
+            return _json_response_with_replies(
+                request, out, svc.present_all_in_chunks(result.reply_ids))
+        out['replies'] = svc.present_all(result.reply_ids, sources=result.sources)
 
     return out
 
@@ -292,6 +308,37 @@ def delete(context, request):
     return {'id': context.annotation.id, 'deleted': True}
 
 
+def _json_response_with_replies(request, out, reply_chunks):
+    """
+    Return a JSON response of `out` with a "replies" list of `reply_chunks`.
+
+    The replies are presented and encoded a chunk at a time as the response
+    body is sent, so only one chunk of replies is in memory at once.
+    """
+    def body():
+        try:
+            # Leave the closing brace off the encoded `out` so that the
+            # replies can be appended to it.
+            yield json.dumps(out)[:-1] + ', "replies": ['
+            separator = ''
+            for chunk in reply_chunks:
+                if not chunk:
+                    continue
+                yield separator + ', '.join(json.dumps(reply) for reply in chunk)
+                separator = ', '
+            yield ']}'
+        finally:
+            # The body is sent after pyramid_tm has ended the request's
+            # transaction and the request's database session has been closed,
+            # so loading the replies begins a new transaction which nothing
+            # else will end.
+            request.tm.abort()
+
+    return Response(app_iter=body(),
+                    content_type='application/json',
+                    charset='utf-8')
+
+
 def _json_payload(request):
     """
     Return a parsed JSON payload for the request.
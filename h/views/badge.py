@@ -4,9 +4,19 @@ from __future__ import unicode_literals
 
 from pyramid import httpexceptions
 
-from h import models, search
+from h import models, search, storage
+from h.util.cache import ExpiringLRUCache
+from h.util.uri import normalize as uri_normalize
 from h.util.view import json_view
 
+#: Recently counted badge totals, keyed by the user they were counted for and
+#: the (normalized) expanded URIs of the page. Totals are only cached briefly,
+#: as they go stale as soon as someone annotates the page.
+BADGE_COUNTS = ExpiringLRUCache(maxsize=10000, ttl=30)
+
+#: The maximum number of URIs which can be counted in one batch request.
+MAX_BATCH_SIZE = 50
+
 
 @json_view(route_name='badge')
 def badge(request):
@@ -24,10 +34,60 @@ def badge(request):
     if not uri:
         raise httpexceptions.HTTPBadRequest()
 
-    if models.Blocklist.is_blocked(request.db, uri):
-        return {'total': 0}
+    return {'total': _badge_counts(request, [uri])[uri]}
+
+
+@json_view(route_name='badges')
+def badges(request):
+    """Return the number of public annotations on each of several pages.
+
+    This is the batch form of :py:func:`badge`, for clients which prefetch
+    the badge numbers of many pages. The pages are given by up to
+    :py:data:`MAX_BATCH_SIZE` ``uri`` params, and the response maps each
+    URI to its number of annotations.
+
+    """
+    uris = [uri for uri in request.params.getall('uri') if uri]
+
+    if not uris or len(uris) > MAX_BATCH_SIZE:
+        raise httpexceptions.HTTPBadRequest()
+
+    return {'totals': _badge_counts(request, uris)}
+
+
+def _badge_counts(request, uris):
+    """Return a dict mapping each of `uris` to its badge number."""
+    counts = {}
+    uncached = {}
+
+    for uri in set(uris):
+        if models.Blocklist.is_blocked(request.db, uri):
+            counts[uri] = 0
+            continue
+
+        key = _cache_key(request, uri)
+        total = BADGE_COUNTS.get(key)
+        if total is None:
+            request.stats.incr('badge.cache.miss')
+            uncached[uri] = key
+        else:
+            request.stats.incr('badge.cache.hit')
+            counts[uri] = total
+
+    if uncached:
+        uris_to_count = list(uncached)
+        totals = search.Search(request, stats=request.stats).count(
+            [{'uri': uri} for uri in uris_to_count])
+        for uri, total in zip(uris_to_count, totals):
+            BADGE_COUNTS.set(uncached[uri], total)
+            counts[uri] = total
+
+    return counts
 
-    query = {'uri': uri, 'limit': 0}
-    result = search.Search(request, stats=request.stats).run(query)
 
-    return {'total': result.total}
+def _cache_key(request, uri):
+    # Pages with the same expanded URIs have the same annotations, and the
+    # annotations which are visible depend only on the user.
+    expanded = storage.expand_uri(request.db, uri, stats=request.stats)
+    return (request.authenticated_userid,
+            frozenset(uri_normalize(u) for u in expanded))
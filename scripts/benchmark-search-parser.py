@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark parsing of activity page search queries.
+
+Simulates the `q` strings of a stream of activity page views, in which a few
+queries (the empty query, a popular tag or user, ...) are very common and the
+rest are rarely repeated, and reports the time taken per query when:
+
+- every query is parsed (which is what the activity pages used to do), and
+- queries are parsed with `h.search.parser.parse`, which caches the results
+  of recently parsed queries.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import random
+import timeit
+
+from webob.multidict import MultiDict
+
+from h.search import parser
+
+
+def make_queries(count, distinct):
+    common = ['',
+              'tag:foo',
+              'user:bar',
+              'tag:"open access" tag:research',
+              'group:abc123 user:alice',
+              'uri:https://example.com/articles/1']
+    queries = []
+    for i in range(count):
+        if random.random() < 0.8:
+            queries.append(random.choice(common))
+        else:
+            n = random.randrange(distinct)
+            queries.append('tag:tag{} user:user{} "some words {}"'.format(n, n % 50, n))
+    return queries
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--queries', type=int, default=5000)
+    argparser.add_argument('--distinct', type=int, default=2000,
+                           help='number of distinct uncommon queries')
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args()
+
+    random.seed(0)
+    queries = make_queries(args.queries, args.distinct)
+    uncached_parse = parser._parse.__wrapped__
+
+    def uncached():
+        for q in queries:
+            MultiDict(uncached_parse(q))
+
+    def cached():
+        parser._parse.cache_clear()
+        for q in queries:
+            parser.parse(q)
+
+    print('{} queries ({} distinct)'.format(len(queries), len(set(queries))))
+
+    baseline = None
+    for name, func in [('uncached', uncached), ('cached', cached)]:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        per_query = best / len(queries) * 1e6
+        if baseline is None:
+            baseline = best
+        print('{:<10} {:8.2f} us/query  {:5.1f}x'.format(name, per_query, baseline / best))
+
+
+if __name__ == '__main__':
+    main()
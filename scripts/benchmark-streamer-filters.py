@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark matching of annotation events against streamer filters.
+
+Simulates fanning out a stream of annotation events to a set of sockets whose
+filters look like those sent by the client sidebar (a `/uri` clause with the
+backend-expanded URIs of the page), plus a few with additional group or tag
+clauses, and reports the time taken per filter evaluation when:
+
+- the filter is evaluated by the streamer's original `FilterHandler`, copied
+  below as `LegacyFilterHandler`, which folds every clause value and field
+  value again for every evaluation,
+- the filter is compiled for every evaluation,
+- the filter is compiled once and matched against the raw serialized
+  annotation, and
+- the filter is compiled once and matched against a FoldedTarget shared by all
+  the sockets receiving the event, as the streamer does.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import copy
+import operator
+import random
+import timeit
+
+from jsonpointer import resolve_pointer
+
+from h.streamer.filter import FilterHandler, FoldedTarget
+from h.util.text import uni_fold
+
+
+def _match_of(a, b):
+    for subb in b:
+        if subb in a:
+            return True
+    return False
+
+
+class LegacyFilterHandler(object):
+    """
+    The streamer's filter implementation before filters were compiled.
+
+    Only the operators used by the benchmark's filters are kept, and they are
+    looked up in a dict rather than patched onto the `operator` module.
+    """
+
+    operators = {
+        'equals': operator.eq,
+        'one_of': operator.contains,
+        'match_of': _match_of,
+    }
+
+    def __init__(self, filter_json):
+        self.filter = filter_json
+
+    def evaluate_clause(self, clause, target):
+        if isinstance(clause['field'], list):
+            for field in clause['field']:
+                copied = copy.deepcopy(clause)
+                copied['field'] = field
+                result = self.evaluate_clause(copied, target)
+                if result:
+                    return True
+            return False
+        else:
+            field_value = resolve_pointer(target, clause['field'], None)
+            if field_value is None:
+                return False
+
+            cval = clause['value']
+            fval = field_value
+
+            if isinstance(cval, list):
+                tval = []
+                for cv in cval:
+                    tval.append(uni_fold(cv))
+                cval = tval
+            else:
+                cval = uni_fold(cval)
+
+            if isinstance(fval, list):
+                tval = []
+                for fv in fval:
+                    tval.append(uni_fold(fv))
+                fval = tval
+            else:
+                fval = uni_fold(fval)
+
+            reversed_order = False
+            if isinstance(cval, list) or isinstance(fval, list):
+                if clause['operator'] in ['one_of', 'matches']:
+                    reversed_order = True
+                    if isinstance(field_value, list):
+                        reversed_order = False
+
+            if reversed_order:
+                lval = cval
+                rval = fval
+            else:
+                lval = fval
+                rval = cval
+
+            op = self.operators[clause['operator']]
+            return op(lval, rval)
+
+    def include_any(self, target):
+        for clause in self.filter['clauses']:
+            if self.evaluate_clause(clause, target):
+                return True
+        return False
+
+    def include_all(self, target):
+        for clause in self.filter['clauses']:
+            if not self.evaluate_clause(clause, target):
+                return False
+        return True
+
+    def match(self, target, action=None):
+        if not action or action == 'past' or action in self.filter['actions']:
+            if len(self.filter['clauses']) > 0:
+                return getattr(self, self.filter['match_policy'])(target)
+            else:
+                return True
+        else:
+            return False
+
+
+def make_filters(count, pages):
+    filters = []
+    for i in range(count):
+        page = random.choice(pages)
+        clauses = [{'field': '/uri', 'operator': 'one_of', 'value': page}]
+        policy = 'include_any'
+        if i % 10 == 0:
+            policy = 'include_all'
+            clauses.append({'field': '/group', 'operator': 'equals',
+                            'value': 'group{}'.format(i % 7)})
+        if i % 25 == 0:
+            policy = 'include_all'
+            clauses.append({'field': '/tags', 'operator': 'match_of',
+                            'value': ['Research', 'Café', 'todo']})
+        filters.append({
+            'match_policy': policy,
+            'clauses': clauses,
+            'actions': {'create': True, 'update': True, 'delete': True},
+        })
+    return filters
+
+
+def make_pages(count):
+    pages = []
+    for i in range(count):
+        base = 'https://Example.com/Articles/{}'.format(i)
+        pages.append([base,
+                      base + '?utm_source=feed',
+                      'https://example.com/articles/{}/print'.format(i),
+                      'doi:10.1000/ÉTUDE.{}'.format(i),
+                      'urn:x-pdf:{:032x}'.format(i)])
+    return pages
+
+
+def make_events(count, pages):
+    events = []
+    for i in range(count):
+        page = random.choice(pages)
+        events.append({
+            'id': 'annotation{}'.format(i),
+            'uri': random.choice(page),
+            'group': 'group{}'.format(i % 7),
+            'user': 'acct:user{}@example.com'.format(i % 100),
+            'tags': ['research', 'Todo'] if i % 3 == 0 else [],
+            'text': 'Lorem ipsum dolor sit amet ' * 5,
+        })
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sockets', type=int, default=500)
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    pages = make_pages(args.pages)
+    filters = make_filters(args.sockets, pages)
+    events = make_events(args.events, pages)
+    handlers = [FilterHandler(f) for f in filters]
+    legacy_handlers = [LegacyFilterHandler(f) for f in filters]
+
+    for event in events:
+        for legacy, h in zip(legacy_handlers, handlers):
+            if legacy.match(event, 'create') != h.match(event, 'create'):
+                raise RuntimeError('filter implementations disagree')
+
+    def legacy():
+        for event in events:
+            for h in legacy_handlers:
+                h.match(event, 'create')
+
+    def uncompiled():
+        for event in events:
+            for f in filters:
+                FilterHandler(f).match(event, 'create')
+
+    def compiled():
+        for event in events:
+            for h in handlers:
+                h.match(event, 'create')
+
+    def compiled_shared_target():
+        for event in events:
+            target = FoldedTarget(event)
+            for h in handlers:
+                h.match(target, 'create')
+
+    evaluations = args.sockets * args.events
+    print('{} sockets, {} events ({} filter evaluations)'.format(
+        args.sockets, args.events, evaluations))
+
+    baseline = None
+    for name, func in [('legacy', legacy),
+                       ('uncompiled', uncompiled),
+                       ('compiled', compiled),
+                       ('compiled, shared target', compiled_shared_target)]:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        per_eval = best / evaluations * 1e6
+        if baseline is None:
+            baseline = best
+        print('{:<25} {:8.2f} us/evaluation  {:5.1f}x'.format(
+            name, per_eval, baseline / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,7 @@ NONAPI_PATHS = (
     '/login',
     '/account/settings',
     '/api/badge',
+    '/api/badges',
     '/api/token',
 )
 
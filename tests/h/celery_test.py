@@ -6,6 +6,7 @@ import mock
 import pytest
 
 from billiard.einfo import ExceptionInfo
+from celery.exceptions import ImproperlyConfigured
 
 from h import celery
 
@@ -48,6 +49,42 @@ class TestCelery(object):
         register_logger_signal.assert_called_once_with(mock.sentinel.sentry,
                                                        loglevel=logging.ERROR)
 
+    def test_bootstrap_worker_checks_indexer_prefetch(self, patch):
+        check_indexer_prefetch = patch('h.celery.check_indexer_prefetch')
+        sender = mock.Mock(spec=['app'])
+        request = sender.app.webapp_bootstrap.return_value
+
+        celery.bootstrap_worker(sender)
+
+        check_indexer_prefetch.assert_called_once_with(
+            sender, request.registry.settings)
+
+    def test_check_indexer_prefetch_raises_if_prefetch_is_below_batch_size(self, worker):
+        with pytest.raises(ImproperlyConfigured):
+            celery.check_indexer_prefetch(worker, {'h.indexer.batch': 'true'})
+
+    @pytest.mark.parametrize('concurrency,multiplier', [
+        (1, 100),
+        (4, 25),
+        (4, 0),
+    ])
+    def test_check_indexer_prefetch_allows_prefetch_of_a_batch(self,
+                                                               worker,
+                                                               concurrency,
+                                                               multiplier):
+        worker.concurrency = concurrency
+        worker.prefetch_multiplier = multiplier
+
+        celery.check_indexer_prefetch(worker, {'h.indexer.batch': 'true'})
+
+    def test_check_indexer_prefetch_ignores_unbatched_indexing(self, worker):
+        celery.check_indexer_prefetch(worker, {})
+
+    def test_check_indexer_prefetch_ignores_workers_not_consuming_indexer_queue(self, worker):
+        worker.app.amqp.queues.consume_from = {'celery': mock.sentinel.queue}
+
+        celery.check_indexer_prefetch(worker, {'h.indexer.batch': 'true'})
+
     def test_nipsa_cache(self, pyramid_config, pyramid_request):
         sender = mock.Mock(app=mock.Mock(request=pyramid_request))
         nipsa_svc = mock.Mock()
@@ -103,6 +140,16 @@ class TestCelery(object):
 
         assert not log.error.called
 
+    @pytest.fixture
+    def worker(self):
+        worker = mock.Mock(spec=['app', 'concurrency', 'prefetch_multiplier'])
+        worker.app.amqp.queues.consume_from = {'celery': mock.sentinel.queue,
+                                               'indexer': mock.sentinel.queue}
+        worker.concurrency = 4
+        worker.prefetch_multiplier = 1
+        with mock.patch('h.tasks.indexer.BATCH_SIZE', 100):
+            yield worker
+
 
 def _patch(modulepath, request):
     patcher = mock.patch(modulepath, autospec=True)
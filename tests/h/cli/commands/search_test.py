@@ -19,7 +19,38 @@ class TestReindexCommand(object):
         assert result.exit_code == 0
         reindex.assert_called_once_with(pyramid_request.db,
                                         pyramid_request.es,
-                                        pyramid_request)
+                                        pyramid_request,
+                                        parallel=1,
+                                        bootstrap=cliconfig['bootstrap'],
+                                        resume=False)
+
+    def test_passes_resume_to_reindex(self, cli, cliconfig, reindex):
+        result = cli.invoke(search.reindex, ['--resume'], obj=cliconfig)
+
+        assert result.exit_code == 0
+        _, kwargs = reindex.call_args
+        assert kwargs['resume'] is True
+
+    def test_handles_runtimeerror(self, cli, cliconfig, reindex):
+        reindex.side_effect = RuntimeError('no reindex to resume')
+
+        result = cli.invoke(search.reindex, ['--resume'], obj=cliconfig)
+
+        assert result.exit_code == 1
+        assert 'no reindex to resume' in result.output
+
+    def test_passes_parallelism_to_reindex(self, cli, cliconfig, reindex):
+        result = cli.invoke(search.reindex, ['--parallel', '4'], obj=cliconfig)
+
+        assert result.exit_code == 0
+        _, kwargs = reindex.call_args
+        assert kwargs['parallel'] == 4
+
+    def test_rejects_parallelism_below_one(self, cli, cliconfig, reindex):
+        result = cli.invoke(search.reindex, ['--parallel', '0'], obj=cliconfig)
+
+        assert result.exit_code != 0
+        assert not reindex.called
 
     @pytest.fixture
     def reindex(self, patch):
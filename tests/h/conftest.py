@@ -21,6 +21,8 @@ from webob.multidict import MultiDict
 
 from h import db
 from h import form
+from h.models.blocklist import COMPILED_BLOCKLIST
+from h.models.document import DOCUMENT_URIS_CACHE
 from h.settings import database_url
 from h._compat import text_type
 
@@ -139,6 +141,10 @@ def db_session(db_engine):
         session.close()
         trans.rollback()
         conn.close()
+        # The cached document URIs and compiled blocklist were loaded from
+        # rows which have just been rolled back.
+        DOCUMENT_URIS_CACHE.clear()
+        COMPILED_BLOCKLIST.invalidate()
 
 
 @pytest.yield_fixture
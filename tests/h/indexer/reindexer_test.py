@@ -1,17 +1,40 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import json
+
 import mock
 import pytest
 
-from h.indexer.reindexer import reindex, SETTING_NEW_INDEX
+from h.indexer import reindexer
+from h.indexer.reindexer import reindex, SETTING_CHECKPOINT, SETTING_NEW_INDEX
 from h.search import client
+from h.search.index import Window
+
+WINDOWS = [Window(None, datetime.datetime(2017, 1, 1)),
+           Window(datetime.datetime(2017, 1, 1), None)]
+
+
+class FakeSettingsService(object):
+    def __init__(self):
+        self._data = {}
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def put(self, key, value):
+        self._data[key] = value
+
+    def delete(self, key):
+        self._data.pop(key, None)
 
 
 @pytest.mark.usefixtures('BatchIndexer',
                          'configure_index',
                          'get_aliased_index',
                          'update_aliased_index',
-                         'settings_service')
+                         'settings_service',
+                         'partition')
 class TestReindex(object):
     def test_sets_op_type_to_create(self, pyramid_request, es, BatchIndexer):
         reindex(mock.sentinel.session, es, pyramid_request)
@@ -19,22 +42,23 @@ class TestReindex(object):
         _, kwargs = BatchIndexer.call_args
         assert kwargs['op_type'] == 'create'
 
-    def test_indexes_annotations(self, pyramid_request, es, batchindexer):
-        """Should call .index() on the batch indexer instance."""
+    def test_indexes_annotations_by_window(self, pyramid_request, es, batchindexer, partition):
+        """Should call .index() on the batch indexer instance for each window."""
         reindex(mock.sentinel.session, es, pyramid_request)
 
-        batchindexer.index.assert_called_once_with()
+        partition.assert_called_once_with(mock.sentinel.session, reindexer.WINDOW_COUNT)
+        assert batchindexer.index.mock_calls == [
+            mock.call(window=window) for window in WINDOWS
+        ]
 
     def test_retries_failed_annotations(self, pyramid_request, es, batchindexer):
         """Should call .index() a second time with any failed annotation IDs."""
-        batchindexer.index.return_value = ['abc123', 'def456']
+        batchindexer.index.side_effect = [set(['abc123']), set(['def456']), set()]
 
         reindex(mock.sentinel.session, es, pyramid_request)
 
-        assert batchindexer.index.mock_calls == [
-            mock.call(),
-            mock.call(['abc123', 'def456']),
-        ]
+        args, _ = batchindexer.index.call_args
+        assert sorted(args[0]) == ['abc123', 'def456']
 
     def test_creates_new_index(self, pyramid_request, es, configure_index, matchers):
         """Creates a new target index."""
@@ -81,12 +105,13 @@ class TestReindex(object):
 
         reindex(mock.sentinel.session, es, pyramid_request)
 
-        settings_service.put.assert_called_once_with(SETTING_NEW_INDEX, 'hypothesis-abcd1234')
+        settings_service.put.assert_any_call(SETTING_NEW_INDEX, 'hypothesis-abcd1234')
 
     def test_deletes_index_name_setting(self, pyramid_request, es, settings_service):
         reindex(mock.sentinel.session, es, pyramid_request)
 
-        settings_service.delete.assert_called_once_with(SETTING_NEW_INDEX)
+        settings_service.delete.assert_any_call(SETTING_NEW_INDEX)
+        assert settings_service.get(SETTING_NEW_INDEX) is None
 
     def test_deletes_index_name_setting_when_exception_raised(self, pyramid_request, es, settings_service, batchindexer):
         batchindexer.index.side_effect = RuntimeError('boom!')
@@ -96,13 +121,114 @@ class TestReindex(object):
 
         settings_service.delete.assert_called_once_with(SETTING_NEW_INDEX)
 
+    def test_records_indexed_windows(self, pyramid_request, es, settings_service, batchindexer):
+        batchindexer.index.side_effect = [set(), RuntimeError('boom!')]
+
+        with pytest.raises(RuntimeError):
+            reindex(mock.sentinel.session, es, pyramid_request)
+
+        checkpoint = json.loads(settings_service.get(SETTING_CHECKPOINT))
+        assert checkpoint['done'] == [0]
+
+    def test_does_not_record_windows_with_errors(self, pyramid_request, es, settings_service, batchindexer):
+        batchindexer.index.side_effect = [set(['abc123']), RuntimeError('boom!')]
+
+        with pytest.raises(RuntimeError):
+            reindex(mock.sentinel.session, es, pyramid_request)
+
+        checkpoint = json.loads(settings_service.get(SETTING_CHECKPOINT))
+        assert checkpoint['done'] == []
+
+    def test_deletes_checkpoint_when_reindexed(self, pyramid_request, es, settings_service):
+        reindex(mock.sentinel.session, es, pyramid_request)
+
+        assert settings_service.get(SETTING_CHECKPOINT) is None
+
+    def test_resume_indexes_remaining_windows_into_checkpointed_index(self,
+                                                                     pyramid_request,
+                                                                     es,
+                                                                     batchindexer,
+                                                                     configure_index,
+                                                                     BatchIndexer,
+                                                                     update_aliased_index,
+                                                                     interrupted_reindex):
+        reindex(mock.sentinel.session, es, pyramid_request, resume=True)
+
+        assert not configure_index.called
+        es.conn.indices.exists.assert_called_once_with(index='hypothesis-abcd1234')
+        assert mock.call(window=WINDOWS[0]) not in batchindexer.index.mock_calls
+        batchindexer.index.assert_any_call(window=WINDOWS[1])
+        for _, kwargs in BatchIndexer.call_args_list:
+            assert kwargs['target_index'] == 'hypothesis-abcd1234'
+        update_aliased_index.assert_called_once_with(es, 'hypothesis-abcd1234')
+
+    def test_resume_catches_up_on_annotations_updated_since_start(self,
+                                                                  pyramid_request,
+                                                                  es,
+                                                                  batchindexer,
+                                                                  BatchIndexer,
+                                                                  interrupted_reindex):
+        reindex(mock.sentinel.session, es, pyramid_request, resume=True)
+
+        _, kwargs = BatchIndexer.call_args
+        assert 'op_type' not in kwargs
+        batchindexer.catch_up.assert_called_once_with(datetime.datetime(2017, 1, 1, 12))
+
+    def test_resume_raises_if_there_is_no_reindex_to_resume(self, pyramid_request, es):
+        with pytest.raises(RuntimeError):
+            reindex(mock.sentinel.session, es, pyramid_request, resume=True)
+
+    def test_resume_raises_if_index_does_not_exist(self, pyramid_request, es, interrupted_reindex):
+        es.conn.indices.exists.return_value = False
+
+        with pytest.raises(RuntimeError):
+            reindex(mock.sentinel.session, es, pyramid_request, resume=True)
+
+    def test_parallel_indexes_windows_in_worker_processes(self,
+                                                          pyramid_request,
+                                                          es,
+                                                          batchindexer,
+                                                          configure_index,
+                                                          Pool):
+        configure_index.return_value = 'hypothesis-abcd1234'
+        bootstrap = mock.Mock()
+
+        reindex(mock.sentinel.session, es, pyramid_request, parallel=2, bootstrap=bootstrap)
+
+        Pool.assert_called_once_with(processes=2,
+                                     initializer=reindexer._init_worker,
+                                     initargs=(bootstrap,))
+        Pool.return_value.imap_unordered.assert_called_once_with(
+            reindexer._index_window,
+            [('hypothesis-abcd1234', i, window) for i, window in enumerate(WINDOWS)])
+        assert not batchindexer.index.called
+
+    def test_parallel_retries_failed_annotations(self, pyramid_request, es, batchindexer, Pool):
+        Pool.return_value.imap_unordered.return_value = [(0, set(['abc123'])),
+                                                         (1, set(['def456']))]
+
+        reindex(mock.sentinel.session, es, pyramid_request, parallel=2, bootstrap=mock.Mock())
+
+        args, _ = batchindexer.index.call_args
+        assert sorted(args[0]) == ['abc123', 'def456']
+
+    def test_parallel_terminates_pool_when_exception_raised(self, pyramid_request, es, Pool):
+        Pool.return_value.imap_unordered.side_effect = RuntimeError('boom!')
+
+        with pytest.raises(RuntimeError):
+            reindex(mock.sentinel.session, es, pyramid_request, parallel=2, bootstrap=mock.Mock())
+
+        Pool.return_value.terminate.assert_called_once_with()
+
     @pytest.fixture
     def BatchIndexer(self, patch):
         return patch('h.indexer.reindexer.BatchIndexer')
 
     @pytest.fixture
     def configure_index(self, patch):
-        return patch('h.indexer.reindexer.configure_index')
+        configure_index = patch('h.indexer.reindexer.configure_index')
+        configure_index.return_value = 'hypothesis-new'
+        return configure_index
 
     @pytest.fixture
     def get_aliased_index(self, patch):
@@ -114,10 +240,23 @@ class TestReindex(object):
     def update_aliased_index(self, patch):
         return patch('h.indexer.reindexer.update_aliased_index')
 
+    @pytest.fixture
+    def partition(self, patch):
+        partition = patch('h.indexer.reindexer.partition')
+        partition.return_value = (WINDOWS, 2000)
+        return partition
+
+    @pytest.fixture
+    def Pool(self, patch):
+        Pool = patch('h.indexer.reindexer.multiprocessing.Pool')
+        Pool.return_value.imap_unordered.return_value = [(0, set()), (1, set())]
+        return Pool
+
     @pytest.fixture
     def batchindexer(self, BatchIndexer):
         indexer = BatchIndexer.return_value
-        indexer.index.return_value = []
+        indexer.index.return_value = set()
+        indexer.catch_up.return_value = set()
         return indexer
 
     @pytest.fixture
@@ -125,15 +264,60 @@ class TestReindex(object):
         mock_es = mock.Mock(spec=client.Client('localhost', 'hypothesis'))
         mock_es.index = 'hypothesis'
         mock_es.t.annotation = 'annotation'
+        mock_es.conn.indices.exists.return_value = True
         return mock_es
 
     @pytest.fixture
     def settings_service(self, pyramid_config):
-        service = mock.Mock()
+        service = mock.Mock(wraps=FakeSettingsService())
         pyramid_config.register_service(service, name='settings')
         return service
 
+    @pytest.fixture
+    def interrupted_reindex(self, settings_service):
+        settings_service.put(SETTING_CHECKPOINT, json.dumps({
+            'index': 'hypothesis-abcd1234',
+            'started': '2017-01-01T12:00:00.000000+00:00',
+            'total': 2000,
+            'windows': [[None, '2017-01-01T00:00:00.000000+00:00'],
+                        ['2017-01-01T00:00:00.000000+00:00', None]],
+            'done': [0],
+        }))
+        settings_service.reset_mock()
+
     @pytest.fixture
     def pyramid_request(self, pyramid_request):
         pyramid_request.tm = mock.Mock()
         return pyramid_request
+
+
+class TestIndexWindow(object):
+    def test_it_indexes_the_window_with_the_worker_request(self, worker_request, BatchIndexer):
+        BatchIndexer.return_value.index.return_value = set(['abc123'])
+        window = Window(1, 2)
+
+        result = reindexer._index_window(('hypothesis-abcd1234', 3, window))
+
+        BatchIndexer.assert_called_once_with(worker_request.db,
+                                             worker_request.es,
+                                             worker_request,
+                                             target_index='hypothesis-abcd1234',
+                                             op_type='create')
+        BatchIndexer.return_value.index.assert_called_once_with(window=window)
+        assert result == (3, set(['abc123']))
+
+    def test_it_ends_the_transaction(self, worker_request, BatchIndexer):
+        reindexer._index_window(('hypothesis-abcd1234', 3, Window(1, 2)))
+
+        worker_request.tm.abort.assert_called_once_with()
+
+    @pytest.fixture
+    def worker_request(self, monkeypatch):
+        bootstrap = mock.Mock()
+        monkeypatch.setattr(reindexer, '_worker_request', None)
+        reindexer._init_worker(bootstrap)
+        return bootstrap.return_value
+
+    @pytest.fixture
+    def BatchIndexer(self, patch):
+        return patch('h.indexer.reindexer.BatchIndexer')
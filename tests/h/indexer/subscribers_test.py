@@ -6,7 +6,7 @@ from h import events
 from h.indexer import subscribers
 
 
-@pytest.mark.usefixtures('add_annotation', 'delete_annotation')
+@pytest.mark.usefixtures('add_annotation', 'delete_annotation', 'sync_annotation')
 class TestSubscribeAnnotationEvent(object):
 
     @pytest.mark.parametrize('action', ['create', 'update'])
@@ -37,6 +37,24 @@ class TestSubscribeAnnotationEvent(object):
         delete_annotation.delay.assert_called_once_with(event.annotation_id)
         assert not add_annotation.delay.called
 
+    @pytest.mark.parametrize('action', ['create', 'update', 'delete'])
+    def test_it_enqueues_sync_annotation_celery_task_in_batch_mode(self,
+                                                                  action,
+                                                                  add_annotation,
+                                                                  delete_annotation,
+                                                                  sync_annotation,
+                                                                  pyramid_request):
+        pyramid_request.registry.settings['h.indexer.batch'] = True
+        event = events.AnnotationEvent(pyramid_request,
+                                       {'id': 'test_annotation_id'},
+                                       action)
+
+        subscribers.subscribe_annotation_event(event)
+
+        sync_annotation.delay.assert_called_once_with(event.annotation_id, action)
+        assert not add_annotation.delay.called
+        assert not delete_annotation.delay.called
+
     @pytest.fixture
     def add_annotation(self, patch):
         return patch('h.indexer.subscribers.add_annotation')
@@ -44,3 +62,7 @@ class TestSubscribeAnnotationEvent(object):
     @pytest.fixture
     def delete_annotation(self, patch):
         return patch('h.indexer.subscribers.delete_annotation')
+
+    @pytest.fixture
+    def sync_annotation(self, patch):
+        return patch('h.indexer.subscribers.sync_annotation')
@@ -2,7 +2,18 @@
 
 from __future__ import unicode_literals
 
+import mock
+import pytest
+import sqlalchemy as sa
+from hypothesis import assume, given
+from hypothesis import strategies as st
+
 from h import models
+from h.models.blocklist import BlocklistMatcher, CompiledBlocklist
+
+# Patterns and URIs are generated from a small alphabet so that wildcards,
+# escapes and literal matches are all common.
+LIKE_ALPHABET = 'ab/%_\\'
 
 
 def test_is_blocked(db_session):
@@ -22,3 +33,141 @@ def test_is_blocked_with_wildcards(db_session):
     assert models.Blocklist.is_blocked(db_session, "http://example.com/")
     assert models.Blocklist.is_blocked(db_session, "http://example.com/bar")
     assert models.Blocklist.is_blocked(db_session, "http://example.com/foo")
+
+
+@given(pattern=st.text(alphabet=LIKE_ALPHABET, max_size=6),
+       uri=st.text(alphabet=LIKE_ALPHABET, max_size=6))
+def test_matcher_has_the_same_semantics_as_sql_like(db_session, pattern, uri):
+    assume(not _ends_with_escape(pattern))
+
+    expected = db_session.query(sa.literal(uri).like(pattern)).scalar()
+
+    assert BlocklistMatcher([pattern]).matches(uri) == expected
+
+
+class TestBlocklistMatcher(object):
+    @pytest.mark.parametrize('pattern,uri,expected', [
+        # Patterns without wildcards match exactly
+        ('http://example.com', 'http://example.com', True),
+        ('http://example.com', 'http://example.com/', False),
+        ('http://example.com', 'HTTP://example.com', False),
+        ('', '', True),
+        # Trailing wildcards match prefixes
+        ('http://example.com/%', 'http://example.com/', True),
+        ('http://example.com/%', 'http://example.com/foo', True),
+        ('http://example.com/%', 'http://example.org/foo', False),
+        ('%', '', True),
+        # Other wildcards
+        ('%//example.com%', 'https://example.com/foo', True),
+        ('%//example.com%', 'https://example.org/foo', False),
+        ('http://example.co_', 'http://example.com', True),
+        ('http://example.co_', 'http://example.co', False),
+        ('http://_.com%', 'http://a.com/foo', True),
+        ('%.pdf', 'http://example.com/foo.pdf', True),
+        ('%.pdf', 'http://example.com/foo.pdfx', False),
+        # Wildcards match newlines and non-ASCII characters
+        ('%', 'foo\nbar', True),
+        ('caf_', 'café', True),
+        # Escaped wildcards match literally
+        ('100\\%', '100%', True),
+        ('100\\%', '1000', False),
+        ('a\\_b%', 'a_bc', True),
+        ('a\\_b%', 'axbc', False),
+        ('a\\\\b', 'a\\b', True),
+        ('\\a', 'a', True),
+        # Regex metacharacters match literally
+        ('http://example.com/?q=(a|b)*', 'http://example.com/?q=(a|b)*', True),
+        ('http://example.com/?q=(a|b)*%', 'http://example.com/?q=a', False),
+        ('%.com/[a]%', 'http://example.com/[a]', True),
+    ])
+    def test_matches(self, pattern, uri, expected):
+        assert BlocklistMatcher([pattern]).matches(uri) is expected
+
+    def test_matches_any_pattern(self):
+        matcher = BlocklistMatcher(['http://a.com', 'http://b.com/%', '%.c.com%'])
+
+        assert matcher.matches('http://a.com')
+        assert matcher.matches('http://b.com/foo')
+        assert matcher.matches('http://www.c.com/')
+        assert not matcher.matches('http://d.com')
+
+    def test_ignores_patterns_ending_with_an_escape(self):
+        matcher = BlocklistMatcher(['http://a.com\\', 'http://b.com'])
+
+        assert not matcher.matches('http://a.com')
+        assert not matcher.matches('http://a.com\\')
+        assert matcher.matches('http://b.com')
+
+    @given(pattern=st.text(alphabet=LIKE_ALPHABET, max_size=8),
+           uri=st.text(alphabet=LIKE_ALPHABET, max_size=8))
+    def test_matches_like_reference_implementation(self, pattern, uri):
+        assume(not _ends_with_escape(pattern))
+
+        assert BlocklistMatcher([pattern]).matches(uri) == _like(uri, pattern)
+
+    @given(patterns=st.lists(st.text(alphabet=LIKE_ALPHABET, max_size=6), max_size=5),
+           uri=st.text(alphabet=LIKE_ALPHABET, max_size=6))
+    def test_matches_if_any_pattern_matches(self, patterns, uri):
+        patterns = [p for p in patterns if not _ends_with_escape(p)]
+
+        expected = any(_like(uri, p) for p in patterns)
+
+        assert BlocklistMatcher(patterns).matches(uri) == expected
+
+
+class TestCompiledBlocklist(object):
+    def test_loads_blocklist_on_first_use(self, session):
+        blocklist = CompiledBlocklist()
+
+        matcher = blocklist.matcher(session)
+
+        assert matcher.matches('http://example.com/foo')
+
+    def test_caches_blocklist(self, session):
+        blocklist = CompiledBlocklist()
+
+        assert blocklist.matcher(session) is blocklist.matcher(session)
+        assert session.query.call_count == 1
+
+    def test_reloads_blocklist_after_refresh_interval(self, session):
+        clock = mock.Mock(return_value=1000)
+        blocklist = CompiledBlocklist(refresh_interval=60, clock=clock)
+        blocklist.matcher(session)
+
+        clock.return_value = 1060
+        blocklist.matcher(session)
+
+        assert session.query.call_count == 2
+
+    def test_invalidate_reloads_blocklist(self, session):
+        blocklist = CompiledBlocklist()
+        blocklist.matcher(session)
+
+        blocklist.invalidate()
+        blocklist.matcher(session)
+
+        assert session.query.call_count == 2
+
+    @pytest.fixture
+    def session(self):
+        session = mock.Mock(spec_set=['query'])
+        session.query.return_value = [('http://example.com/%',)]
+        return session
+
+
+def _ends_with_escape(pattern):
+    trailing = len(pattern) - len(pattern.rstrip('\\'))
+    return trailing % 2 == 1
+
+
+def _like(string, pattern):
+    """A straightforward (and slow) reference implementation of LIKE."""
+    if not pattern:
+        return not string
+    if pattern[0] == '\\':
+        return bool(string) and string[0] == pattern[1] and _like(string[1:], pattern[2:])
+    if pattern[0] == '%':
+        return any(_like(string[i:], pattern[1:]) for i in range(len(string) + 1))
+    if pattern[0] == '_':
+        return bool(string) and _like(string[1:], pattern[1:])
+    return bool(string) and string[0] == pattern[0] and _like(string[1:], pattern[1:])
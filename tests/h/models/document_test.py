@@ -675,6 +675,14 @@ class TestMergeDocuments(object):
         assert 0 == \
             db_session.query(models.Annotation).filter_by(document_id=duplicate_2.id).count()
 
+    def test_merge_documents_invalidates_cached_document_uris(self, db_session, merge_data):
+        key = document.uri_normalize('https://en.wikipedia.org/wiki/Main_Page')
+        document.DOCUMENT_URIS_CACHE.set(key, ())
+
+        document.merge_documents(db_session, merge_data)
+
+        assert document.DOCUMENT_URIS_CACHE.get(key) is None
+
     def test_raises_retryable_error_when_flush_fails(self, db_session, merge_data, monkeypatch):
         def err():
             raise sa.exc.IntegrityError(None, None, None)
@@ -795,7 +803,7 @@ class TestUpdateDocumentMetadata(object):
 
     def test_it_calls_first(self, annotation, session, Document):
         """If it finds only one document it calls first()."""
-        Document.find_or_create_by_uris.return_value = mock.Mock(
+        Document.find_or_create_by_uris.return_value = mock.MagicMock(
             count=mock.Mock(return_value=1))
 
         document.update_document_metadata(session, annotation, [], [])
@@ -810,7 +818,7 @@ class TestUpdateDocumentMetadata(object):
                                          session):
         yesterday_ = "yesterday"
         document_ = merge_documents.return_value = mock.Mock(
-            updated=yesterday_)
+            updated=yesterday_, document_uris=[])
         Document.find_or_create_by_uris.return_value.first.return_value = (
             document_)
 
@@ -874,7 +882,7 @@ class TestUpdateDocumentMetadata(object):
                                          Document,
                                          factories,
                                          session):
-        document_ = mock.Mock(web_uri=None)
+        document_ = mock.Mock(web_uri=None, document_uris=[])
         Document.find_or_create_by_uris.return_value.count.return_value = 1
         Document.find_or_create_by_uris.return_value.first.return_value = document_
 
@@ -947,6 +955,22 @@ class TestUpdateDocumentMetadata(object):
 
         assert result == Document.find_or_create_by_uris.return_value.first.return_value
 
+    def test_it_invalidates_cached_document_uris(self,
+                                                 annotation,
+                                                 session,
+                                                 Document,
+                                                 invalidate_cached_uris):
+        document_ = Document.find_or_create_by_uris.return_value.first.return_value
+
+        document.update_document_metadata(session,
+                                          annotation.target_uri,
+                                          [],
+                                          [],
+                                          annotation.created,
+                                          annotation.updated)
+
+        invalidate_cached_uris.assert_called_once_with(session, document_)
+
     @pytest.fixture
     def annotation(self):
         return mock.Mock(spec=models.Annotation())
@@ -971,6 +995,45 @@ class TestUpdateDocumentMetadata(object):
     def session(self, db_session):
         return mock.Mock(spec=db_session)
 
+    @pytest.fixture(autouse=True)
+    def invalidate_cached_uris(self, patch):
+        return patch('h.models.document._invalidate_cached_uris')
+
+
+class TestInvalidateCachedUris(object):
+
+    def test_it_invalidates_cached_document_uris(self, session, doc):
+        document.DOCUMENT_URIS_CACHE.set('httpx://example.com', ())
+
+        document._invalidate_cached_uris(session, doc)
+
+        assert document.DOCUMENT_URIS_CACHE.get('httpx://example.com') is None
+
+    def test_it_invalidates_cached_document_uris_again_after_commit(self, session, doc):
+        document._invalidate_cached_uris(session, doc)
+        document.DOCUMENT_URIS_CACHE.set('httpx://example.com', ())
+
+        session.commit()
+
+        assert document.DOCUMENT_URIS_CACHE.get('httpx://example.com') is None
+
+    def test_it_only_invalidates_after_the_next_commit(self, session, doc):
+        document._invalidate_cached_uris(session, doc)
+        session.commit()
+        document.DOCUMENT_URIS_CACHE.set('httpx://example.com', ())
+
+        session.commit()
+
+        assert document.DOCUMENT_URIS_CACHE.get('httpx://example.com') == ()
+
+    @pytest.fixture
+    def session(self):
+        return sa.orm.Session()
+
+    @pytest.fixture
+    def doc(self):
+        return mock.Mock(document_uris=[mock.Mock(uri_normalized='httpx://example.com')])
+
 
 def now():
     return datetime.datetime.now()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import datetime
+import uuid
+
+import pytest
+
+from h.db.types import _get_urlsafe_from_hex
+from h.models import ScheduledThreadRoot
+
+
+class TestScheduledThreadRootClaim(object):
+    def test_it_claims_roots_which_have_not_been_scheduled(self, db_engine, root):
+        assert ScheduledThreadRoot.claim(db_engine, root, 10) is True
+
+    def test_it_does_not_claim_roots_scheduled_within_the_interval(self, db_engine, root):
+        ScheduledThreadRoot.claim(db_engine, root, 10)
+
+        assert ScheduledThreadRoot.claim(db_engine, root, 10) is False
+
+    def test_it_claims_roots_scheduled_before_the_interval(self, db_engine, root, table):
+        ScheduledThreadRoot.claim(db_engine, root, 10)
+        db_engine.execute(table.update().values(
+            scheduled=datetime.datetime.utcnow() - datetime.timedelta(seconds=10)))
+
+        assert ScheduledThreadRoot.claim(db_engine, root, 10) is True
+        assert ScheduledThreadRoot.claim(db_engine, root, 10) is False
+
+    def test_claims_are_seen_by_other_connections(self, db_engine, root, table):
+        ScheduledThreadRoot.claim(db_engine, root, 10)
+
+        conn = db_engine.connect()
+        try:
+            rows = conn.execute(table.select()).fetchall()
+        finally:
+            conn.close()
+        assert [row.annotation_id for row in rows] == [root]
+
+    @pytest.fixture
+    def root(self):
+        return _get_urlsafe_from_hex(uuid.uuid4().hex)
+
+    @pytest.fixture
+    def table(self):
+        return ScheduledThreadRoot.__table__
+
+    @pytest.fixture(autouse=True)
+    def delete_claims(self, db_engine, table):
+        # Claims are committed by their own transactions, rather than in the
+        # per-test transaction which is rolled back.
+        yield
+        db_engine.execute(table.delete())
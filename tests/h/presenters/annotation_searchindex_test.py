@@ -3,11 +3,19 @@
 from __future__ import unicode_literals
 
 import datetime
+from collections import namedtuple
 
 import mock
 import pytest
 
+from h import models
+from h.presenters.annotation_json import AnnotationJSONPresenter
 from h.presenters.annotation_searchindex import AnnotationSearchIndexPresenter
+from h.presenters.annotation_searchindex import IndexedAnnotation
+from h.resources import AnnotationResource
+from h.search.subscribers import add_extra
+
+FakeEvent = namedtuple('FakeEvent', ['request', 'annotation', 'annotation_dict'])
 
 
 @pytest.mark.usefixtures('DocumentSearchIndexPresenter')
@@ -27,8 +35,7 @@ class TestAnnotationSearchIndexPresenter(object):
             shared=True,
             target_selectors=[{'TestSelector': 'foobar'}],
             references=['referenced-id-1', 'referenced-id-2'],
-            thread_ids=['thread-id-1', 'thread-id-2'],
-            extra={'extra-1': 'foo', 'extra-2': 'bar'})
+            thread_ids=['thread-id-1', 'thread-id-2'])
         DocumentSearchIndexPresenter.return_value.asdict.return_value = {'foo': 'bar'}
 
         annotation_dict = AnnotationSearchIndexPresenter(annotation).asdict()
@@ -68,3 +75,91 @@ class TestAnnotationSearchIndexPresenter(object):
         class_ = patch('h.presenters.annotation_searchindex.DocumentSearchIndexPresenter')
         class_.return_value.asdict.return_value = {}
         return class_
+
+
+class TestIndexedAnnotation(object):
+
+    @pytest.mark.parametrize('shared,references', [
+        (True, []),
+        (False, ['parent-id']),
+    ])
+    def test_it_is_presented_like_the_annotation(self, annotation, shared, references):
+        annotation.shared = shared
+        annotation.references = references
+
+        indexed = IndexedAnnotation(annotation.id, self.source(annotation))
+
+        assert self.present(indexed) == self.present(annotation)
+
+    def test_it_has_the_annotations_attributes(self, annotation):
+        annotation.references = ['root-id', 'parent-id']
+
+        indexed = IndexedAnnotation(annotation.id, self.source(annotation))
+
+        assert indexed.id == annotation.id
+        assert indexed.created == annotation.created
+        assert indexed.updated == annotation.updated
+        assert indexed.target_uri_normalized == annotation.target_uri_normalized
+        assert indexed.is_reply
+        assert indexed.parent_id == 'parent-id'
+        assert indexed.thread_root_id == 'root-id'
+        assert not indexed.deleted
+
+    def test_thread_root_id_is_own_id_if_not_a_reply(self, annotation):
+        indexed = IndexedAnnotation(annotation.id, self.source(annotation))
+
+        assert indexed.thread_root_id == annotation.id
+
+    def test_document_has_indexed_title_and_web_uri(self, annotation):
+        indexed = IndexedAnnotation(annotation.id, self.source(annotation))
+
+        assert indexed.document.title == 'My Document'
+        assert [u.uri for u in indexed.document.document_uris] == ['http://example.com/doc']
+
+    def test_document_is_none_if_annotation_has_no_document(self, annotation):
+        annotation.document = None
+
+        indexed = IndexedAnnotation(annotation.id, self.source(annotation))
+
+        assert indexed.document is None
+
+    def test_is_complete(self, annotation):
+        source = self.source(annotation)
+
+        assert IndexedAnnotation.is_complete(source)
+
+        del source['extra']
+        assert not IndexedAnnotation.is_complete(source)
+
+    def source(self, annotation):
+        source = AnnotationSearchIndexPresenter(annotation).asdict()
+        add_extra(FakeEvent(None, annotation, source))
+        # The search index doesn't return the id as part of the source.
+        del source['id']
+        return source
+
+    def present(self, annotation):
+        group_service = mock.Mock(spec_set=['find'])
+        group_service.find.return_value = None
+        links_service = mock.Mock(spec_set=['get_all'])
+        links_service.get_all.side_effect = lambda ann: {'html': ann.id}
+        resource = AnnotationResource(annotation, group_service, links_service)
+        return AnnotationJSONPresenter(resource).asdict()
+
+    @pytest.fixture
+    def annotation(self):
+        document = models.Document(title='My Document', web_uri='http://example.com/doc')
+        return models.Annotation(id='xyz123',
+                                 created=datetime.datetime(2016, 2, 24, 18, 3, 25, 768),
+                                 updated=datetime.datetime(2016, 2, 29, 10, 24, 5, 564),
+                                 userid='acct:luke@hypothes.is',
+                                 groupid='__world__',
+                                 shared=True,
+                                 target_uri='http://example.com/doc',
+                                 target_selectors=[{'type': 'TextQuoteSelector',
+                                                    'exact': 'foo'}],
+                                 text='It is magical!',
+                                 tags=['magic'],
+                                 references=[],
+                                 extra={'extra-1': 'foo'},
+                                 document=document)
@@ -76,10 +76,70 @@ class TestConsumer(object):
 
         consumer.handle_message({}, message)
 
+    def test_get_consumers_binds_queue_to_binding_keys(self, Queue, binding, handler):
+        exchange = realtime.get_topic_exchange()
+        consumer = realtime.Consumer(mock.sentinel.connection,
+                                     'annotation',
+                                     handler,
+                                     exchange=exchange,
+                                     binding_keys=lambda: frozenset(['annotation.#']))
+        channel = mock.Mock()
+
+        consumer.get_consumers(mock.Mock(spec_set=[]), channel)
+
+        binding.assert_called_once_with(exchange, routing_key='annotation.#')
+        Queue.assert_called_once_with(mock.ANY,
+                                      bindings=[binding.return_value],
+                                      durable=False,
+                                      auto_delete=True,
+                                      channel=channel)
+
+    def test_on_iteration_updates_bindings(self, Queue, binding, handler):
+        exchange = realtime.get_topic_exchange()
+        keys = [frozenset(['annotation.a.*', 'annotation.b.*'])]
+        consumer = realtime.Consumer(mock.sentinel.connection,
+                                     'annotation',
+                                     handler,
+                                     exchange=exchange,
+                                     binding_keys=lambda: keys[0])
+        consumer.get_consumers(mock.Mock(spec_set=[]), mock.Mock())
+        queue = Queue.return_value
+
+        keys[0] = frozenset(['annotation.b.*', 'annotation.c.*'])
+        consumer.on_iteration()
+
+        queue.bind_to.assert_called_once_with(exchange, 'annotation.c.*')
+        queue.unbind_from.assert_called_once_with(exchange, 'annotation.a.*')
+
+    def test_on_iteration_does_nothing_if_bindings_unchanged(self, Queue, binding, handler):
+        keys = frozenset(['annotation.a.*'])
+        consumer = realtime.Consumer(mock.sentinel.connection,
+                                     'annotation',
+                                     handler,
+                                     exchange=realtime.get_topic_exchange(),
+                                     binding_keys=lambda: keys)
+        consumer.get_consumers(mock.Mock(spec_set=[]), mock.Mock())
+
+        consumer.on_iteration()
+
+        assert not Queue.return_value.bind_to.called
+        assert not Queue.return_value.unbind_from.called
+
+    def test_on_iteration_does_nothing_without_binding_keys(self, Queue, consumer):
+        consumer.get_consumers(mock.Mock(spec_set=[]), mock.Mock())
+
+        consumer.on_iteration()
+
+        assert not Queue.return_value.bind_to.called
+
     @pytest.fixture
     def Queue(self, patch):
         return patch('h.realtime.kombu.Queue')
 
+    @pytest.fixture
+    def binding(self, patch):
+        return patch('h.realtime.kombu.binding')
+
     @pytest.fixture
     def consumer(self, handler):
         return realtime.Consumer(mock.sentinel.connection, 'annotation', handler)
@@ -128,6 +188,22 @@ class TestPublisher(object):
                                                  routing_key='user',
                                                  headers=expected_headers)
 
+    def test_publish_annotation_with_topic_exchange(self, matchers, producer_pool, pyramid_request):
+        pyramid_request.registry.settings['h.realtime.topic_exchange'] = 'true'
+        payload = {'action': 'create', 'annotation_id': 'foobar'}
+        producer = producer_pool['foobar'].acquire().__enter__()
+        exchange = realtime.get_topic_exchange()
+
+        publisher = realtime.Publisher(pyramid_request)
+        publisher.publish_annotation(payload, groupid='__world__', uri='http://example.com')
+
+        producer.publish.assert_called_once_with(
+            payload,
+            exchange=exchange,
+            declare=[exchange],
+            routing_key=realtime.annotation_routing_key('__world__', 'http://example.com'),
+            headers=matchers.mapping_containing('timestamp'))
+
     @pytest.fixture
     def producer_pool(self, patch):
         return patch('h.realtime.producer_pool')
@@ -153,6 +229,43 @@ class TestGetExchange(object):
         assert exchange.delivery_mode == 1
 
 
+class TestGetTopicExchange(object):
+    def test_type(self):
+        exchange = realtime.get_topic_exchange()
+        assert exchange.type == 'topic'
+
+    def test_is_not_the_direct_exchange(self):
+        assert realtime.get_topic_exchange().name != realtime.get_exchange().name
+
+
+class TestAnnotationRoutingKey(object):
+    def test_format(self):
+        key = realtime.annotation_routing_key('__world__', 'http://example.com')
+
+        assert key == 'annotation.__world__.{}'.format(realtime.uri_hash('http://example.com'))
+
+    def test_uri_hash_is_case_and_accent_insensitive(self):
+        assert (realtime.uri_hash(u'http://Example.com/Café') ==
+                realtime.uri_hash(u'http://example.com/cafe'))
+
+    def test_hashes_groups_which_are_not_valid_segments(self):
+        key = realtime.annotation_routing_key('foo.bar#', 'http://example.com')
+
+        assert key.count('.') == 2
+        assert '#' not in key
+
+    @pytest.mark.parametrize('kwargs,expected', [
+        ({}, 'annotation.#'),
+        ({'groupid': 'abc'}, 'annotation.abc.*'),
+        ({'uri': 'http://example.com'},
+         'annotation.*.' + realtime.uri_hash('http://example.com')),
+        ({'groupid': 'abc', 'uri': 'http://example.com'},
+         realtime.annotation_routing_key('abc', 'http://example.com')),
+    ])
+    def test_binding_keys(self, kwargs, expected):
+        assert realtime.annotation_binding_key(**kwargs) == expected
+
+
 class TestGetConnection(object):
     def test_defaults(self, Connection):
         realtime.get_connection({})
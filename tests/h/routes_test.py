@@ -79,6 +79,7 @@ def test_includeme():
         call('api.search', '/api/search'),
         call('api.users', '/api/users'),
         call('badge', '/api/badge'),
+        call('badges', '/api/badges'),
         call('token', '/api/token'),
         call('session', '/app'),
         call('sidebar_app', '/app.html'),
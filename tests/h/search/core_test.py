@@ -1,5 +1,6 @@
 import mock
 import pytest
+from elasticsearch.exceptions import TransportError
 
 from h.search import core
 
@@ -8,6 +9,9 @@ class FakeStatsdClient(object):
     def pipeline(self):
         return FakeStatsdPipeline()
 
+    def incr(self, name):
+        pass
+
 
 class FakeStatsdPipeline(object):
     def timer(self, name):
@@ -32,7 +36,7 @@ class TestSearch(object):
     def test_run_searches_annotations(self, pyramid_request, search_annotations):
         params = mock.Mock()
 
-        search_annotations.return_value = (0, [], {})
+        search_annotations.return_value = (0, [], {}, None)
 
         search = core.Search(pyramid_request)
         search.run(params)
@@ -44,7 +48,7 @@ class TestSearch(object):
                                   search_replies,
                                   search_annotations):
         annotation_ids = [mock.Mock(), mock.Mock()]
-        search_annotations.return_value = (2, annotation_ids, {})
+        search_annotations.return_value = (2, annotation_ids, {}, None)
 
         search = core.Search(pyramid_request)
         search.run({})
@@ -59,13 +63,174 @@ class TestSearch(object):
         annotation_ids = ['id-1', 'id-3', 'id-6', 'id-5']
         reply_ids = ['reply-8', 'reply-5']
         aggregations = {'foo': 'bar'}
-        search_annotations.return_value = (total, annotation_ids, aggregations)
+        cursor = 'the-cursor'
+        search_annotations.return_value = (total, annotation_ids, aggregations, cursor)
         search_replies.return_value = reply_ids
 
         search = core.Search(pyramid_request)
         result = search.run({})
 
-        assert result == core.SearchResult(total, annotation_ids, reply_ids, aggregations)
+        assert result == core.SearchResult(total, annotation_ids, reply_ids, aggregations,
+                                           cursor)
+
+    def test_run_searches_annotations_and_replies_when_asked(self,
+                                                            pyramid_request,
+                                                            search_annotations_and_replies):
+        search_annotations_and_replies.return_value = (2, ['id-1', 'id-2'], {}, ['reply-1'],
+                                                       'the-cursor')
+
+        search = core.Search(pyramid_request, separate_replies=True)
+        result = search.run({})
+
+        search_annotations_and_replies.assert_called_once_with(search, {})
+        assert result == core.SearchResult(2, ['id-1', 'id-2'], ['reply-1'], {},
+                                           'the-cursor')
+
+    def test_run_does_not_cache_results_by_default(self, pyramid_request, search_annotations,
+                                                  results_cache):
+        search_annotations.return_value = (0, [], {}, None)
+
+        core.Search(pyramid_request).run({})
+        core.Search(pyramid_request).run({})
+
+        assert search_annotations.call_count == 2
+        assert len(results_cache) == 0
+
+    def test_run_returns_cached_results(self, pyramid_request, search_annotations,
+                                        search_replies):
+        search_annotations.return_value = (1, ['id-1'], {}, None)
+        first = core.Search(pyramid_request, use_cache=True).run({'group': 'foo'})
+
+        result = core.Search(pyramid_request, use_cache=True).run({'group': 'foo'})
+
+        assert search_annotations.call_count == 1
+        assert result == first
+
+    def test_run_caches_results_per_query(self, pyramid_request, search_annotations,
+                                          search_replies):
+        search_annotations.return_value = (0, [], {}, None)
+
+        core.Search(pyramid_request, use_cache=True).run({'group': 'foo'})
+        core.Search(pyramid_request, use_cache=True).run({'group': 'bar'})
+
+        assert search_annotations.call_count == 2
+
+    def test_run_caches_results_per_principals(self, pyramid_config, pyramid_request,
+                                               search_annotations, search_replies):
+        search_annotations.return_value = (0, [], {}, None)
+        core.Search(pyramid_request, use_cache=True).run({'group': 'foo'})
+
+        pyramid_config.testing_securitypolicy('acct:bob@example.com',
+                                              groupids=['group:foo'])
+        core.Search(pyramid_request, use_cache=True).run({'group': 'foo'})
+
+        assert search_annotations.call_count == 2
+
+    def test_run_records_cache_hits_and_misses(self, pyramid_request, search_annotations,
+                                               search_replies):
+        search_annotations.return_value = (0, [], {}, None)
+        stats = mock.Mock(spec_set=['incr'])
+
+        core.Search(pyramid_request, stats=stats, use_cache=True).run({'group': 'foo'})
+        core.Search(pyramid_request, stats=stats, use_cache=True).run({'group': 'foo'})
+
+        assert stats.incr.call_args_list == [mock.call('search.cache.miss'),
+                                             mock.call('search.cache.hit')]
+
+    def test_run_limits_the_size_of_cached_results(self, pyramid_request, search_annotations,
+                                                   search_replies, results_cache):
+        results_cache.maxbytes = 1000
+        search_annotations.return_value = (1, ['id-1'], {}, None)
+        search_replies.return_value = ['x' * 1000]
+
+        core.Search(pyramid_request, use_cache=True).run({'group': 'foo'})
+
+        assert len(results_cache) == 0
+
+    def test_run_results_expire(self, pyramid_request, search_annotations,
+                                search_replies, results_cache):
+        search_annotations.return_value = (0, [], {}, None)
+        core.Search(pyramid_request, use_cache=True).run({'group': 'foo'})
+
+        results_cache._clock.return_value += results_cache.ttl
+        core.Search(pyramid_request, use_cache=True).run({'group': 'foo'})
+
+        assert search_annotations.call_count == 2
+
+    def test_search_annotations_and_replies_makes_one_request(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True)
+        search.es.conn.msearch.return_value = msearch_results(
+            annotations=[('id-1', ['reply-1', 'reply-2']), ('id-2', [])],
+            replies=[('reply-1', ['id-1']), ('reply-2', ['id-1', 'reply-1'])])
+
+        result = search.search_annotations_and_replies({'group': 'foo'})
+
+        assert result == (2, ['id-1', 'id-2'], {}, ['reply-1', 'reply-2'], None)
+        assert search.es.conn.msearch.call_count == 1
+        assert not search.es.conn.search.called
+
+    def test_search_annotations_and_replies_excludes_replies_from_annotations(self,
+                                                                              pyramid_request,
+                                                                              query):
+        search = core.Search(pyramid_request, separate_replies=True)
+        search.builder = mock.Mock()
+        search.builder.build.return_value = {}
+        search.reply_builder = mock.Mock()
+        search.reply_builder.build.return_value = {'query': {}}
+        search.es.conn.msearch.return_value = msearch_results()
+
+        search.search_annotations_and_replies({})
+
+        search.builder.append_filter.assert_called_once_with(
+            query.TopLevelAnnotationsFilter.return_value)
+
+    def test_search_annotations_and_replies_only_returns_replies_to_the_annotations(self,
+                                                                                    pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True)
+        search.es.conn.msearch.return_value = msearch_results(
+            annotations=[('id-1', ['reply-1'])],
+            replies=[('reply-1', ['id-1']), ('reply-2', ['id-3'])])
+
+        _, _, _, reply_ids, _ = search.search_annotations_and_replies({})
+
+        assert reply_ids == ['reply-1']
+
+    @pytest.mark.parametrize('annotations,replies,replies_total', [
+        # Too many replies to return
+        ([('id-1', ['reply-1'])], [('reply-1', ['id-1'])], 201),
+        # Some replies in the annotation's thread weren't found
+        ([('id-1', ['reply-1', 'reply-2'])], [('reply-1', ['id-1'])], None),
+    ])
+    def test_search_annotations_and_replies_searches_replies_again_if_some_may_be_missing(
+            self, pyramid_request, search_replies, annotations, replies, replies_total):
+        search = core.Search(pyramid_request, separate_replies=True, stats=mock.Mock())
+        search.es.conn.msearch.return_value = msearch_results(annotations, replies,
+                                                              replies_total)
+
+        _, _, _, reply_ids, _ = search.search_annotations_and_replies({})
+
+        search_replies.assert_called_once_with(search, ['id-1'])
+        assert reply_ids == search_replies.return_value
+        search.stats.incr.assert_called_once_with('search.replies.fallback')
+
+    def test_search_annotations_and_replies_raises_if_a_search_fails(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True)
+        search.es.conn.msearch.return_value = {'responses': [
+            {'hits': {'total': 0, 'hits': []}},
+            {'error': 'SearchPhaseExecutionException', 'status': 400},
+        ]}
+
+        with pytest.raises(TransportError):
+            search.search_annotations_and_replies({})
+
+    def test_search_annotations_and_replies_works_with_stats_client(self, pyramid_request):
+        search = core.Search(pyramid_request,
+                             stats=FakeStatsdClient(),
+                             separate_replies=True)
+        search.es.conn.msearch.return_value = msearch_results(
+            annotations=[('id-1', ['reply-1'])])
+        # This should not raise
+        search.search_annotations_and_replies({})
 
     def test_search_annotations_includes_replies_by_default(self, pyramid_request, query):
         search = core.Search(pyramid_request)
@@ -106,9 +271,70 @@ class TestSearch(object):
         foobaragg = mock.Mock(key='foobar')
         search.append_aggregation(foobaragg)
 
-        _, _, aggregations = search.search_annotations({})
+        _, _, aggregations, _ = search.search_annotations({})
         assert aggregations == {'foobar': foobaragg.parse_result.return_value}
 
+    def test_search_annotations_returns_cursor_for_next_page(self, pyramid_request):
+        search = core.Search(pyramid_request)
+        search.es.conn.search.return_value = {
+            'hits': {'total': 3, 'hits': [{'_id': 'id-1', 'sort': [2000, 'annotation#id-1']},
+                                          {'_id': 'id-2', 'sort': [1000, 'annotation#id-2']}]},
+        }
+
+        _, _, _, cursor = search.search_annotations({'limit': 2, 'cursor': ''})
+
+        assert core.query.decode_cursor(cursor) == {
+            'sort': 'updated', 'order': 'desc', 'value': 1000, 'uid': 'annotation#id-2'}
+
+    def test_run_does_not_return_sources_by_default(self, pyramid_request):
+        pyramid_request.es.conn.search.return_value = dummy_search_results(count=2)
+
+        result = core.Search(pyramid_request).run({})
+
+        assert pyramid_request.es.conn.search.call_args[1]['_source'] is False
+        assert result.sources is None
+
+    def test_run_returns_sources_when_asked(self, pyramid_request):
+        pyramid_request.es.conn.search.return_value = dummy_search_results(count=2)
+
+        result = core.Search(pyramid_request, include_sources=True).run({})
+
+        assert pyramid_request.es.conn.search.call_args[1]['_source'] is True
+        assert result.sources == {'id_1': {'name': 'annotation_1'},
+                                  'id_2': {'name': 'annotation_2'}}
+
+    def test_run_returns_sources_of_annotations_and_replies_when_asked(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True, include_sources=True)
+        search.es.conn.msearch.return_value = msearch_results(
+            annotations=[('id-1', ['reply-1'])],
+            replies=[('reply-1', ['id-1']), ('reply-2', ['other-id'])])
+
+        result = search.run({})
+
+        bodies = search.es.conn.msearch.call_args[1]['body']
+        assert all('_source' not in body for body in bodies[1::2])
+        assert result.sources == {'id-1': {'thread_ids': ['reply-1']},
+                                  'reply-1': {'references': ['id-1']}}
+
+    def test_search_annotations_returns_no_cursor_after_last_page(self, pyramid_request):
+        search = core.Search(pyramid_request)
+        search.es.conn.search.return_value = {'hits': {'total': 0, 'hits': []}}
+
+        _, _, _, cursor = search.search_annotations({'cursor': ''})
+
+        assert cursor is None
+
+    def test_search_annotations_returns_no_cursor_unless_asked(self, pyramid_request):
+        search = core.Search(pyramid_request)
+        search.es.conn.search.return_value = {
+            'hits': {'total': 3, 'hits': [{'_id': 'id-1', 'sort': [2000]},
+                                          {'_id': 'id-2', 'sort': [1000]}]},
+        }
+
+        _, _, _, cursor = search.search_annotations({'limit': 2})
+
+        assert cursor is None
+
     def test_search_annotations_works_with_stats_client(self, pyramid_request):
         search = core.Search(pyramid_request, stats=FakeStatsdClient())
         # This should not raise
@@ -161,6 +387,41 @@ class TestSearch(object):
         search.search_replies(['id-1'])
         assert log.warn.call_count == 1
 
+    def test_search_replies_scrolls_through_all_replies_when_asked(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True, all_replies=True)
+        search.es.conn.search.return_value = scroll_results('scroll-1', ['reply-1', 'reply-2'])
+        search.es.conn.scroll.side_effect = [
+            scroll_results('scroll-2', ['reply-3']),
+            scroll_results('scroll-3', []),
+        ]
+
+        reply_ids = search.search_replies(['id-1'])
+
+        assert reply_ids == ['reply-1', 'reply-2', 'reply-3']
+        assert search.es.conn.search.call_args[1]['scroll'] == core.SCROLL_TIMEOUT
+        assert search.es.conn.scroll.call_args_list == [
+            mock.call(scroll_id='scroll-1', scroll=core.SCROLL_TIMEOUT),
+            mock.call(scroll_id='scroll-2', scroll=core.SCROLL_TIMEOUT),
+        ]
+
+    def test_search_replies_clears_the_scroll(self, pyramid_request):
+        search = core.Search(pyramid_request, separate_replies=True, all_replies=True)
+        search.es.conn.search.return_value = scroll_results('scroll-1', ['reply-1'])
+        search.es.conn.scroll.return_value = scroll_results('scroll-2', [])
+
+        search.search_replies(['id-1'])
+
+        search.es.conn.clear_scroll.assert_called_once_with(scroll_id='scroll-2')
+
+    def test_search_replies_does_not_warn_when_scrolling(self, pyramid_request, log):
+        search = core.Search(pyramid_request, separate_replies=True, all_replies=True)
+        search.es.conn.search.return_value = scroll_results('scroll-1', ['reply-1'], total=1100)
+        search.es.conn.scroll.return_value = scroll_results('scroll-2', [])
+
+        search.search_replies(['id-1'])
+
+        assert not log.warn.called
+
     def test_search_replies_works_with_stats_client(self, pyramid_request):
         search = core.Search(pyramid_request,
                              stats=FakeStatsdClient(),
@@ -168,6 +429,44 @@ class TestSearch(object):
         # This should not raise
         search.search_replies(['id-1'])
 
+    def test_count_counts_each_query_in_one_request(self, pyramid_request):
+        search = core.Search(pyramid_request)
+        search.es.conn.msearch.return_value = {'responses': [
+            {'hits': {'total': 3, 'hits': []}},
+            {'hits': {'total': 5, 'hits': []}},
+        ]}
+
+        totals = search.count([{'group': 'foo'}, {'group': 'bar'}])
+
+        assert totals == [3, 5]
+        assert search.es.conn.msearch.call_count == 1
+
+    def test_count_does_not_fetch_annotations(self, pyramid_request):
+        search = core.Search(pyramid_request)
+        search.es.conn.msearch.return_value = {'responses': [
+            {'hits': {'total': 3, 'hits': []}},
+        ]}
+
+        search.count([{'group': 'foo'}])
+
+        _, body = search.es.conn.msearch.call_args[1]['body']
+        assert body['size'] == 0
+
+    def test_count_raises_if_a_query_fails(self, pyramid_request):
+        search = core.Search(pyramid_request)
+        search.es.conn.msearch.return_value = {'responses': [
+            {'error': 'SearchPhaseExecutionException', 'status': 400},
+        ]}
+
+        with pytest.raises(TransportError):
+            search.count([{'group': 'foo'}])
+
+    def test_count_works_with_stats_client(self, pyramid_request):
+        search = core.Search(pyramid_request, stats=FakeStatsdClient())
+        search.es.conn.msearch.return_value = {'responses': []}
+        # This should not raise
+        search.count([])
+
     def test_append_filter_appends_to_annotation_builder(self, pyramid_request):
         filter_ = mock.Mock()
         search = core.Search(pyramid_request)
@@ -219,7 +518,13 @@ class TestSearch(object):
 
     @pytest.fixture
     def search_replies(self, patch):
-        return patch('h.search.core.Search.search_replies')
+        search_replies = patch('h.search.core.Search.search_replies')
+        search_replies.return_value = []
+        return search_replies
+
+    @pytest.fixture
+    def search_annotations_and_replies(self, patch):
+        return patch('h.search.core.Search.search_annotations_and_replies')
 
     @pytest.fixture
     def query(self, patch):
@@ -321,6 +626,35 @@ def dummy_search_results(start=1, count=0, name='annotation'):
     return out
 
 
+def scroll_results(scroll_id, ids, total=None):
+    """Generate a dummy page of results of a scroll."""
+    if total is None:
+        total = len(ids)
+    return {
+        '_scroll_id': scroll_id,
+        'hits': {'total': total, 'hits': [{'_id': id_} for id_ in ids]},
+    }
+
+
+def msearch_results(annotations=(), replies=(), replies_total=None):
+    """
+    Generate dummy results of searching for annotations and replies.
+
+    :param annotations: (id, thread_ids) pairs
+    :param replies: (id, references) pairs
+    """
+    if replies_total is None:
+        replies_total = len(replies)
+    return {'responses': [
+        {'hits': {'total': len(annotations),
+                  'hits': [{'_id': id_, '_source': {'thread_ids': thread_ids}}
+                           for id_, thread_ids in annotations]}},
+        {'hits': {'total': replies_total,
+                  'hits': [{'_id': id_, '_source': {'references': references}}
+                           for id_, references in replies]}},
+    ]}
+
+
 @pytest.fixture
 def pyramid_request(pyramid_request):
     """Return a mock request with a faked out Elasticsearch connection."""
@@ -329,6 +663,14 @@ def pyramid_request(pyramid_request):
     return pyramid_request
 
 
+@pytest.fixture(autouse=True)
+def results_cache(monkeypatch):
+    results_cache = core.ExpiringLRUCache(maxsize=100, ttl=10,
+                                          clock=mock.Mock(return_value=1000))
+    monkeypatch.setattr(core, 'RESULTS_CACHE', results_cache)
+    return results_cache
+
+
 @pytest.fixture
 def log(patch):
     return patch('h.search.core.log')
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import datetime
+
 import mock
 import pytest
 
@@ -95,6 +97,70 @@ class TestDeleteAnnotation:
 
 
 class TestBatchIndexer(object):
+    def test_sync_indexes_annotations_and_marks_deleted_ids_deleted(self, indexer, streaming_bulk):
+        annotation = mock.Mock(id='ann-1')
+        results = []
+
+        def fake_streaming_bulk(*args, **kwargs):
+            callback = kwargs.get('expand_action_callback')
+            for item in list(args[1])[1:]:
+                results.append(callback(item))
+            return set()
+
+        streaming_bulk.side_effect = fake_streaming_bulk
+
+        indexer.sync([annotation], ['ann-2'])
+
+        assert results == [
+            ({'index': {'_type': indexer.es_client.t.annotation,
+                        '_index': 'hypothesis',
+                        '_id': 'ann-2'}},
+             {'deleted': True}),
+        ]
+
+    def test_catch_up_syncs_annotations_updated_since(self, db_session, indexer, factories):
+        factories.Annotation(updated=datetime.datetime(2017, 1, 1))
+        updated = factories.Annotation(updated=datetime.datetime(2017, 1, 3))
+        deleted = factories.Annotation(updated=datetime.datetime(2017, 1, 3), deleted=True)
+        indexer.sync = mock.Mock(return_value=set(['abc123']))
+
+        errored = indexer.catch_up(datetime.datetime(2017, 1, 2))
+
+        indexer.sync.assert_called_once_with([updated], [deleted.id])
+        assert errored == set(['abc123'])
+
+    def test_catch_up_syncs_thread_roots_of_updated_replies(self, db_session, indexer, factories):
+        root = factories.Annotation(updated=datetime.datetime(2017, 1, 1))
+        reply = factories.Annotation(updated=datetime.datetime(2017, 1, 3),
+                                     references=[root.id])
+        indexer.sync = mock.Mock(return_value=set())
+
+        indexer.catch_up(datetime.datetime(2017, 1, 2))
+
+        assert indexer.sync.call_args_list == [mock.call([reply], []),
+                                               mock.call([root], [])]
+
+    def test_catch_up_syncs_annotations_hidden_since(self, db_session, indexer, factories):
+        hidden = factories.Annotation(updated=datetime.datetime(2017, 1, 1))
+        factories.AnnotationModeration(annotation=hidden,
+                                       created=datetime.datetime(2017, 1, 3))
+        factories.AnnotationModeration(
+            annotation=factories.Annotation(updated=datetime.datetime(2017, 1, 1)),
+            created=datetime.datetime(2017, 1, 1))
+        indexer.sync = mock.Mock(return_value=set())
+
+        indexer.catch_up(datetime.datetime(2017, 1, 2))
+
+        indexer.sync.assert_called_once_with([hidden], [])
+
+    def test_sync_sends_chunks_of_the_given_size(self, db_session, es, pyramid_request, streaming_bulk):
+        indexer = index.BatchIndexer(db_session, es, pyramid_request, chunk_size=42)
+
+        indexer.sync([], [])
+
+        _, kwargs = streaming_bulk.call_args
+        assert kwargs['chunk_size'] == 42
+
     def test_index_indexes_all_annotations_to_es(self, db_session, indexer, matchers, streaming_bulk, factories):
         ann_1, ann_2 = factories.Annotation(), factories.Annotation()
 
@@ -116,6 +182,17 @@ class TestBatchIndexer(object):
             indexer.es_client.conn, matchers.iterable_with([ann_1, ann_2]),
             chunk_size=mock.ANY, raise_on_error=False, expand_action_callback=mock.ANY)
 
+    def test_index_indexes_annotations_in_window_to_es(self, db_session, indexer, matchers, streaming_bulk, factories):
+        ann_1 = factories.Annotation(updated=datetime.datetime(2017, 1, 1))
+        ann_2 = factories.Annotation(updated=datetime.datetime(2017, 1, 2))
+        factories.Annotation(updated=datetime.datetime(2017, 1, 3))
+
+        indexer.index(window=index.Window(None, datetime.datetime(2017, 1, 3)))
+
+        streaming_bulk.assert_called_once_with(
+            indexer.es_client.conn, matchers.iterable_with([ann_1, ann_2]),
+            chunk_size=mock.ANY, raise_on_error=False, expand_action_callback=mock.ANY)
+
     def test_index_indexes_filtered_annotations_to_es(self, db_session, indexer, matchers, streaming_bulk, factories):
         ann_1, ann_2 = factories.Annotation(), factories.Annotation()
 
@@ -303,6 +380,52 @@ class TestBatchIndexer(object):
         return patch('h.search.index.es_helpers.streaming_bulk')
 
 
+class TestPartition(object):
+    def test_it_returns_one_window_for_one_partition(self, db_session, factories):
+        factories.Annotation.create_batch(3)
+
+        windows, total = index.partition(db_session, 1)
+
+        assert windows == [index.Window(None, None)]
+        assert total == 3
+
+    def test_windows_cover_all_annotations(self, db_session, factories):
+        annotations = factories.Annotation.create_batch(10)
+        factories.Annotation(deleted=True)
+
+        windows, total = index.partition(db_session, 4)
+
+        assert len(windows) == 4
+        assert total == 10
+        for annotation in annotations:
+            assert len([w for w in windows if _in_window(annotation, w)]) == 1
+
+    def test_it_returns_one_window_without_annotations(self, db_session):
+        windows, total = index.partition(db_session, 4)
+
+        assert windows == [index.Window(None, None)]
+        assert total == 0
+
+
+class TestFetchAnnotations(object):
+    def test_it_fetches_annotations_including_deleted_ones(self, db_session, factories):
+        ann_1 = factories.Annotation()
+        ann_2 = factories.Annotation(deleted=True)
+        factories.Annotation()
+
+        result = index.fetch_annotations(db_session, [ann_1.id, ann_2.id])
+
+        assert set(result) == set([ann_1, ann_2])
+
+    def test_it_returns_empty_list_for_no_ids(self, db_session):
+        assert index.fetch_annotations(db_session, []) == []
+
+
+def _in_window(annotation, window):
+    return ((window.start is None or annotation.updated >= window.start) and
+            (window.end is None or annotation.updated < window.end))
+
+
 @pytest.fixture
 def es():
     mock_es = mock.Mock(spec=client.Client('localhost', 'hypothesis'))
@@ -97,6 +97,24 @@ def test_parse_with_odd_quotes_combinations(query_in, query_out):
     assert parser.parse(query_in) == query_out
 
 
+def test_parse_caches_results():
+    parser._parse.cache_clear()
+
+    parser.parse('user:luke tag:foo')
+    parser.parse('user:luke tag:foo')
+
+    assert parser._parse.cache_info().hits == 1
+
+
+def test_parse_returns_a_new_multidict_every_time():
+    first = parser.parse('user:luke tag:foo')
+    first['user'] = 'alice'
+    first.add('tag', 'bar')
+
+    assert parser.parse('user:luke tag:foo') == MultiDict([('user', 'luke'),
+                                                         ('tag', 'foo')])
+
+
 @given(st.text())
 @pytest.mark.fuzz
 def test_parse_always_return_a_multidict(text):
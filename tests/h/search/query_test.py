@@ -6,6 +6,7 @@ from hypothesis import strategies as st
 from hypothesis import given
 from webob import multidict
 
+from h.schemas import ValidationError
 from h.search import query
 
 MISSING = object()
@@ -88,7 +89,6 @@ class TestBuilder(object):
         q = builder.build({})
 
         sort = q["sort"]
-        assert len(sort) == 1
         assert sort[0].keys() == ["updated"]
 
     def test_sort_includes_ignore_unmapped(self):
@@ -105,7 +105,29 @@ class TestBuilder(object):
 
         q = builder.build({"sort": "title"})
 
-        assert q["sort"] == [{'title': {'ignore_unmapped': True, 'order': 'desc'}}]
+        assert q["sort"][0] == {'title': {'ignore_unmapped': True, 'order': 'desc'}}
+
+    @pytest.mark.parametrize('order', ['asc', 'desc'])
+    def test_sort_breaks_ties_by_uid_when_paginating_by_cursor(self, order):
+        builder = query.Builder()
+
+        q = builder.build({"order": order, "cursor": ""})
+
+        assert q["sort"][1:] == [{'_uid': {'order': order}}]
+
+    def test_sort_does_not_break_ties_without_cursor(self):
+        builder = query.Builder()
+
+        q = builder.build({})
+
+        assert len(q["sort"]) == 1
+
+    def test_empty_cursor_does_not_filter_results(self):
+        builder = query.Builder()
+
+        q = builder.build({"cursor": ""})
+
+        assert q["query"] == {"match_all": {}}
 
     def test_order_defaults_to_desc(self):
         """'order': "desc" is returned in the q dict by default."""
@@ -249,6 +271,120 @@ class TestBuilder(object):
             "foobar": {"terms": {"field": "foo"}}
         }
 
+    def test_cursor_filters_results_after_cursor(self):
+        builder = query.Builder()
+        cursor = query.encode_cursor({'sort': 'updated', 'order': 'desc',
+                                      'value': 1000, 'uid': 'annotation#id-1'})
+
+        q = builder.build({"cursor": cursor})
+
+        assert q["query"] == {
+            "filtered": {
+                "filter": {"and": [{"or": [
+                    {"range": {"updated": {"lt": 1000}}},
+                    {"and": [
+                        {"range": {"updated": {"gte": 1000, "lte": 1000}}},
+                        {"range": {"_uid": {"lt": "annotation#id-1"}}},
+                    ]},
+                ]}]},
+                "query": {"match_all": {}},
+            },
+        }
+
+    def test_cursor_filters_results_after_cursor_in_ascending_order(self):
+        builder = query.Builder()
+        cursor = query.encode_cursor({'sort': 'created', 'order': 'asc',
+                                      'value': 1000, 'uid': 'annotation#id-1'})
+
+        q = builder.build({"cursor": cursor, "sort": "created", "order": "asc"})
+
+        [after, same] = q["query"]["filtered"]["filter"]["and"][0]["or"]
+        assert after == {"range": {"created": {"gt": 1000}}}
+        assert same["and"][1] == {"range": {"_uid": {"gt": "annotation#id-1"}}}
+
+    def test_cursor_replaces_offset(self):
+        builder = query.Builder()
+        cursor = query.encode_cursor({'sort': 'updated', 'order': 'desc',
+                                      'value': 1000, 'uid': 'annotation#id-1'})
+
+        q = builder.build({"cursor": cursor, "offset": 40})
+
+        assert q["from"] == 0
+
+    def test_cursor_is_not_passed_to_filters(self):
+        testfilter = mock.Mock(return_value=None)
+        builder = query.Builder()
+        builder.append_filter(testfilter)
+        cursor = query.encode_cursor({'sort': 'updated', 'order': 'desc',
+                                      'value': 1000, 'uid': 'annotation#id-1'})
+
+        builder.build({"cursor": cursor, "foo": "bar"})
+
+        testfilter.assert_called_with({"foo": "bar"})
+
+    @pytest.mark.parametrize('cursor', [
+        'foo',
+        '!!!',
+        query.encode_cursor(['not', 'a', 'dict']),
+        query.encode_cursor({'sort': 'updated'}),
+        query.encode_cursor({'sort': 'updated', 'order': 'desc', 'value': 1000}),
+    ])
+    def test_raises_if_cursor_is_invalid(self, cursor):
+        builder = query.Builder()
+
+        with pytest.raises(ValidationError):
+            builder.build({"cursor": cursor})
+
+    @pytest.mark.parametrize('params', [
+        {"sort": "created"},
+        {"order": "asc"},
+    ])
+    def test_raises_if_cursor_does_not_match_sort_order(self, params):
+        builder = query.Builder()
+        params["cursor"] = query.encode_cursor({'sort': 'updated', 'order': 'desc',
+                                                'value': 1000, 'uid': 'annotation#id-1'})
+
+        with pytest.raises(ValidationError):
+            builder.build(params)
+
+
+class TestNextCursor(object):
+    def test_returns_none_if_not_paginating_by_cursor(self):
+        hits = [hit('id-1', 3000), hit('id-2', 2000)]
+
+        assert query.next_cursor({'limit': 2}, hits) is None
+
+    def test_returns_none_if_there_are_no_hits(self):
+        assert query.next_cursor({'cursor': ''}, []) is None
+
+    def test_returns_none_if_there_are_fewer_hits_than_the_limit(self):
+        hits = [hit('id-1', 3000), hit('id-2', 2000)]
+
+        assert query.next_cursor({'cursor': '', 'limit': 3}, hits) is None
+
+    def test_returns_none_if_hits_have_no_sort_values(self):
+        assert query.next_cursor({'cursor': '', 'limit': 1}, [{'_id': 'id-1'}]) is None
+
+    def test_records_sort_order_and_last_sort_values(self):
+        hits = [hit('id-1', 3000), hit('id-2', 2000)]
+
+        cursor = query.next_cursor({'cursor': '', 'sort': 'created', 'order': 'asc', 'limit': 2},
+                                   hits)
+
+        assert query.decode_cursor(cursor) == {
+            'sort': 'created',
+            'order': 'asc',
+            'value': 2000,
+            'uid': 'annotation#id-2',
+        }
+
+    def test_defaults_to_default_sort_order_and_limit(self):
+        hits = [hit('id-{}'.format(i), 1000) for i in range(query.LIMIT_DEFAULT)]
+
+        cursor = query.decode_cursor(query.next_cursor({'cursor': ''}, hits))
+
+        assert (cursor['sort'], cursor['order']) == ('updated', 'desc')
+
 
 class TestAuthFilter(object):
     def test_unauthenticated(self):
@@ -311,17 +447,17 @@ class TestUriFilter(object):
         of the expansion.
         """
         request = mock.Mock()
-        storage.expand_uri.side_effect = lambda _, x: [
-            "http://giraffes.com/",
-            "https://elephants.com/",
-        ]
+        storage.expand_uris.side_effect = lambda _, uris, stats: {
+            "http://example.com/": ["http://giraffes.com/", "https://elephants.com/"],
+        }
 
         urifilter = query.UriFilter(request)
 
         result = urifilter({"uri": "http://example.com/"})
         query_uris = result["terms"]["target.scope"]
 
-        storage.expand_uri.assert_called_with(request.db, "http://example.com/")
+        storage.expand_uris.assert_called_once_with(request.db, ["http://example.com/"],
+                                                    stats=request.stats)
         assert sorted(query_uris) == sorted(["httpx://giraffes.com",
                                              "httpx://elephants.com"])
 
@@ -336,18 +472,20 @@ class TestUriFilter(object):
         params = multidict.MultiDict()
         params.add("uri", "http://example.com")
         params.add("uri", "http://example.net")
-        storage.expand_uri.side_effect = [
-            ["http://giraffes.com/", "https://elephants.com/"],
-            ["http://tigers.com/", "https://elephants.com/"],
-        ]
+        storage.expand_uris.side_effect = lambda _, uris, stats: {
+            "http://example.com": ["http://giraffes.com/", "https://elephants.com/"],
+            "http://example.net": ["http://tigers.com/", "https://elephants.com/"],
+        }
 
         urifilter = query.UriFilter(request)
 
         result = urifilter(params)
         query_uris = result["terms"]["target.scope"]
 
-        storage.expand_uri.assert_any_call(request.db, "http://example.com")
-        storage.expand_uri.assert_any_call(request.db, "http://example.net")
+        storage.expand_uris.assert_called_once_with(request.db,
+                                                    ["http://example.com",
+                                                     "http://example.net"],
+                                                    stats=request.stats)
         assert sorted(query_uris) == sorted(["httpx://giraffes.com",
                                              "httpx://elephants.com",
                                              "httpx://tigers.com"])
@@ -357,18 +495,20 @@ class TestUriFilter(object):
         params = multidict.MultiDict()
         params.add("uri", "http://example.com")
         params.add("url", "http://example.net")
-        storage.expand_uri.side_effect = [
-            ["http://giraffes.com/", "https://elephants.com/"],
-            ["http://tigers.com/", "https://elephants.com/"],
-        ]
+        storage.expand_uris.side_effect = lambda _, uris, stats: {
+            "http://example.com": ["http://giraffes.com/", "https://elephants.com/"],
+            "http://example.net": ["http://tigers.com/", "https://elephants.com/"],
+        }
 
         urifilter = query.UriFilter(request)
 
         result = urifilter(params)
         query_uris = result["terms"]["target.scope"]
 
-        storage.expand_uri.assert_any_call(request.db, "http://example.com")
-        storage.expand_uri.assert_any_call(request.db, "http://example.net")
+        storage.expand_uris.assert_called_once_with(request.db,
+                                                    ["http://example.com",
+                                                     "http://example.net"],
+                                                    stats=request.stats)
         assert sorted(query_uris) == sorted(["httpx://giraffes.com",
                                              "httpx://elephants.com",
                                              "httpx://tigers.com"])
@@ -376,7 +516,7 @@ class TestUriFilter(object):
     @pytest.fixture
     def storage(self, patch):
         storage = patch('h.search.query.storage')
-        storage.expand_uri.side_effect = lambda x: [x]
+        storage.expand_uris.side_effect = lambda _, uris, stats: {u: [u] for u in uris}
         return storage
 
     @pytest.fixture
@@ -569,3 +709,7 @@ class TestUsersAggregation(object):
     def test_parse_result_with_empty(self):
         agg = query.UsersAggregation()
         assert agg.parse_result({}) == {}
+
+
+def hit(id_, sort_value):
+    return {'_id': id_, 'sort': [sort_value, 'annotation#' + id_]}
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+import mock
+
+from h.search import subscribers
+
+FakeEvent = namedtuple('FakeEvent', ['request', 'annotation', 'annotation_dict'])
+
+
+class TestAddExtra(object):
+
+    def test_it_adds_the_extra_fields(self):
+        annotation = mock.Mock(extra={'extra-1': 'foo', 'extra-2': 'bar'})
+        event = FakeEvent(None, annotation, {'id': 'xyz123'})
+
+        subscribers.add_extra(event)
+
+        assert event.annotation_dict == {
+            'id': 'xyz123',
+            'extra': {'extra-1': 'foo', 'extra-2': 'bar'},
+        }
+
+    def test_it_adds_empty_extra_fields_if_the_annotation_has_none(self):
+        event = FakeEvent(None, mock.Mock(extra=None), {})
+
+        subscribers.add_extra(event)
+
+        assert event.annotation_dict == {'extra': {}}
@@ -96,6 +96,44 @@ class TestAnnotationJSONPresentationService(object):
         result = svc.present_all(['ann-1'])
         assert result == [present.return_value]
 
+    def test_present_all_presents_annotations_from_complete_sources(self, svc, storage, resources,
+                                                                   IndexedAnnotation):
+        IndexedAnnotation.is_complete.side_effect = lambda source: source['complete']
+        ann_2 = mock.Mock(id='ann-2')
+        storage.fetch_ordered_annotations.return_value = [ann_2]
+
+        svc.present_all(['ann-1', 'ann-2', 'ann-3'],
+                        sources={'ann-1': {'complete': True}, 'ann-2': {'complete': False}})
+
+        storage.fetch_ordered_annotations.assert_called_once_with(
+            svc.session, ['ann-2', 'ann-3'], query_processor=mock.ANY)
+        IndexedAnnotation.assert_called_once_with('ann-1', {'complete': True})
+        assert [args[0] for args, _ in resources.AnnotationResource.call_args_list] == [
+            IndexedAnnotation.return_value, ann_2]
+
+    def test_present_all_preloads_formatters_for_annotations_from_sources(self, svc, storage,
+                                                                          IndexedAnnotation):
+        formatter = mock.Mock(spec_set=['preload'])
+        svc.formatters = [formatter]
+
+        svc.present_all(['ann-1', 'ann-2'], sources={'ann-1': {}})
+
+        formatter.preload.assert_called_once_with(['ann-1', 'ann-2'])
+
+    def test_present_all_in_chunks_presents_chunks_of_annotations(self, svc, present_all):
+        present_all.side_effect = lambda _, ids: [id_.upper() for id_ in ids]
+
+        chunks = svc.present_all_in_chunks(['ann-1', 'ann-2', 'ann-3'], chunk_size=2)
+
+        assert list(chunks) == [['ANN-1', 'ANN-2'], ['ANN-3']]
+
+    def test_present_all_in_chunks_loads_each_chunk_when_needed(self, svc, present_all):
+        chunks = svc.present_all_in_chunks(['ann-1', 'ann-2', 'ann-3'], chunk_size=2)
+
+        next(chunks)
+
+        present_all.assert_called_once_with(svc, ['ann-1', 'ann-2'])
+
     @pytest.fixture
     def svc(self, services):
         return AnnotationJSONPresentationService(session=mock.sentinel.db_session,
@@ -123,10 +161,20 @@ class TestAnnotationJSONPresentationService(object):
     def resources(self, patch):
         return patch('h.services.annotation_json_presentation.resources')
 
+    @pytest.fixture
+    def IndexedAnnotation(self, patch):
+        IndexedAnnotation = patch('h.services.annotation_json_presentation.IndexedAnnotation')
+        IndexedAnnotation.is_complete.return_value = True
+        return IndexedAnnotation
+
     @pytest.fixture
     def present(self, patch):
         return patch('h.services.annotation_json_presentation.AnnotationJSONPresentationService.present')
 
+    @pytest.fixture
+    def present_all(self, patch):
+        return patch('h.services.annotation_json_presentation.AnnotationJSONPresentationService.present_all')
+
     @pytest.fixture
     def formatters(self, patch):
         return patch('h.services.annotation_json_presentation.formatters')
@@ -2,6 +2,7 @@
 
 from __future__ import unicode_literals
 
+import mock
 import pytest
 
 from h.services.nipsa import NipsaService
@@ -56,6 +57,22 @@ class TestNipsaService(object):
 
         reindex_user_annotations.delay.assert_called_once_with('acct:renata@example.com')
 
+    def test_flag_publishes_nipsa_change(self, db_session, users):
+        publish = mock.Mock(spec_set=[])
+        svc = NipsaService(db_session, publish=publish)
+
+        svc.flag(users['dominic'])
+
+        publish.assert_called_once_with('acct:dominic@example.com', True)
+
+    def test_unflag_publishes_nipsa_change(self, db_session, users):
+        publish = mock.Mock(spec_set=[])
+        svc = NipsaService(db_session, publish=publish)
+
+        svc.unflag(users['renata'])
+
+        publish.assert_called_once_with('acct:renata@example.com', False)
+
     def test_clear_resets_cache(self, db_session, users):
         svc = NipsaService(db_session)
 
@@ -77,6 +94,19 @@ def test_nipsa_factory(pyramid_request):
     assert svc.session == pyramid_request.db
 
 
+def test_nipsa_factory_publishes_user_events(pyramid_request):
+    pyramid_request.realtime = mock.Mock(spec_set=['publish_user'])
+    svc = nipsa_factory(None, pyramid_request)
+
+    svc.publish('acct:renata@example.com', True)
+
+    pyramid_request.realtime.publish_user.assert_called_once_with({
+        'type': 'nipsa-change',
+        'userid': 'acct:renata@example.com',
+        'nipsa': True,
+    })
+
+
 @pytest.fixture
 def reindex_user_annotations(patch):
     return patch('h.services.nipsa.reindex_user_annotations')
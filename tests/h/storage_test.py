@@ -7,6 +7,7 @@ import copy
 import pytest
 import mock
 
+from h.models import document as document_models
 from h.models.annotation import Annotation
 from h.models.document import Document, DocumentURI
 
@@ -86,6 +87,130 @@ class TestExpandURI(object):
             'http://bar.com/'
         ]
 
+    def test_expand_uri_caches_document_uris(self, db_session):
+        document = Document(document_uris=[
+            DocumentURI(uri='http://foo.com/', claimant='http://bar.com'),
+            DocumentURI(uri='http://bar.com/', claimant='http://bar.com'),
+        ])
+        db_session.add(document)
+        db_session.flush()
+        storage.expand_uri(db_session, 'http://foo.com/')
+
+        # Changes which bypass `update_document_metadata` aren't seen until
+        # the cached URIs expire.
+        document.document_uris.append(
+            DocumentURI(uri='http://baz.com/', claimant='http://bar.com'))
+        db_session.flush()
+
+        assert storage.expand_uri(db_session, 'HTTP://FOO.COM') == [
+            'http://foo.com/',
+            'http://bar.com/'
+        ]
+
+    def test_expand_uri_caches_missing_documents(self, db_session):
+        storage.expand_uri(db_session, 'http://example.com/')
+        db_session.add(Document(document_uris=[
+            DocumentURI(uri='http://example.com/', claimant='http://example.com/'),
+            DocumentURI(uri='http://example.org/', claimant='http://example.com/'),
+        ]))
+        db_session.flush()
+
+        assert storage.expand_uri(db_session, 'http://example.com/') == [
+            'http://example.com/']
+
+    def test_expand_uri_sees_document_metadata_updates(self, db_session):
+        storage.expand_uri(db_session, 'http://example.com/')
+
+        document_models.update_document_metadata(db_session, 'http://example.com/', [], [
+            {'uri': 'http://example.com/', 'claimant': 'http://example.com/',
+             'type': 'self-claim', 'content_type': ''},
+            {'uri': 'http://example.org/', 'claimant': 'http://example.com/',
+             'type': 'rel-alternate', 'content_type': ''},
+        ])
+        db_session.flush()
+
+        assert sorted(storage.expand_uri(db_session, 'http://example.com/')) == [
+            'http://example.com/',
+            'http://example.org/',
+        ]
+
+    def test_expand_uri_counts_cache_hits_and_misses(self, db_session):
+        stats = mock.Mock(spec_set=['incr'])
+
+        storage.expand_uri(db_session, 'http://example.com/', stats=stats)
+        storage.expand_uri(db_session, 'http://example.com/', stats=stats)
+
+        assert stats.incr.call_args_list == [
+            mock.call('storage.expand_uri.cache.miss'),
+            mock.call('storage.expand_uri.cache.hit'),
+        ]
+
+
+class TestExpandURIs(object):
+
+    def test_it_expands_each_uri(self, db_session):
+        db_session.add_all([
+            Document(document_uris=[
+                DocumentURI(uri='http://foo.com/', claimant='http://foo.com'),
+                DocumentURI(uri='http://bar.com/', claimant='http://foo.com'),
+            ]),
+            Document(document_uris=[
+                DocumentURI(uri='http://baz.com/', claimant='http://baz.com'),
+                DocumentURI(uri='http://baz.com/', type='rel-canonical',
+                            claimant='http://baz.com'),
+            ]),
+        ])
+        db_session.flush()
+
+        result = storage.expand_uris(db_session, ['http://foo.com/',
+                                                  'http://baz.com/',
+                                                  'http://example.com/'])
+
+        assert result == {
+            'http://foo.com/': ['http://foo.com/', 'http://bar.com/'],
+            'http://baz.com/': ['http://baz.com/'],
+            'http://example.com/': ['http://example.com/'],
+        }
+
+    def test_it_expands_equivalent_uris_separately(self, db_session):
+        db_session.add(Document(document_uris=[
+            DocumentURI(uri='http://foo.com/', claimant='http://foo.com'),
+            DocumentURI(uri='http://bar.com/', claimant='http://foo.com'),
+        ]))
+        db_session.flush()
+
+        result = storage.expand_uris(db_session, ['http://foo.com/', 'HTTP://FOO.COM'])
+
+        assert result == {
+            'http://foo.com/': ['http://foo.com/', 'http://bar.com/'],
+            'HTTP://FOO.COM': ['http://foo.com/', 'http://bar.com/'],
+        }
+
+    def test_it_loads_uncached_uris_in_one_query(self, db_session):
+        storage.expand_uri(db_session, 'http://example.com/')
+        query = mock.Mock(wraps=db_session.query)
+
+        with mock.patch.object(db_session, 'query', query):
+            storage.expand_uris(db_session, ['http://example.com/',
+                                             'http://foo.com/',
+                                             'http://bar.com/'])
+
+        # One query for the subquery of matching URIs, and one for the
+        # document URIs.
+        assert query.call_count == 2
+
+    def test_it_does_not_query_if_all_uris_are_cached(self, db_session):
+        storage.expand_uris(db_session, ['http://foo.com/', 'http://bar.com/'])
+        query = mock.Mock(wraps=db_session.query)
+
+        with mock.patch.object(db_session, 'query', query):
+            storage.expand_uris(db_session, ['http://foo.com/', 'http://bar.com/'])
+
+        assert not query.called
+
+    def test_it_returns_an_empty_dict_if_there_are_no_uris(self, db_session):
+        assert storage.expand_uris(db_session, []) == {}
+
 
 @pytest.mark.usefixtures('models', 'group_service', 'update_document_metadata')
 class TestCreateAnnotation(object):
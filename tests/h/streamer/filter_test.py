@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import pytest
+
+from h.streamer.filter import FilterHandler, FoldedTarget
+
+
+class TestFilterHandler(object):
+    @pytest.mark.parametrize('clause,target,expected', [
+        # equals
+        ({'field': '/uri', 'operator': 'equals', 'value': 'http://example.com'},
+         {'uri': 'http://example.com'}, True),
+        ({'field': '/uri', 'operator': 'equals', 'value': 'http://Example.com'},
+         {'uri': 'http://EXAMPLE.com'}, True),
+        ({'field': '/uri', 'operator': 'equals', 'value': 'http://example.com'},
+         {'uri': 'http://example.org'}, False),
+        # one_of with a list of values tests membership
+        ({'field': '/uri', 'operator': 'one_of', 'value': ['http://a.com', 'http://b.com']},
+         {'uri': 'http://b.com'}, True),
+        ({'field': '/uri', 'operator': 'one_of', 'value': ['http://a.com', 'http://b.com']},
+         {'uri': 'http://c.com'}, False),
+        ({'field': '/uri', 'operator': 'one_of', 'value': ['http://a.com/café']},
+         {'uri': 'http://a.com/CAFÉ'}, True),
+        # one_of/matches against a list field tests membership in the field
+        ({'field': '/tags', 'operator': 'matches', 'value': 'b'},
+         {'tags': ['a', 'B']}, True),
+        ({'field': '/tags', 'operator': 'matches', 'value': 'c'},
+         {'tags': ['a', 'b']}, False),
+        # matches with a single value is a substring match
+        ({'field': '/text', 'operator': 'matches', 'value': 'ello'},
+         {'text': 'Hello world'}, True),
+        ({'field': '/text', 'operator': 'matches', 'value': 'goodbye'},
+         {'text': 'Hello world'}, False),
+        # comparisons
+        ({'field': '/created', 'operator': 'gt', 'value': '2000-01-01'},
+         {'created': '2017-01-01'}, True),
+        ({'field': '/created', 'operator': 'lt', 'value': '2000-01-01'},
+         {'created': '2017-01-01'}, False),
+        ({'field': '/n', 'operator': 'ge', 'value': 3}, {'n': 3}, True),
+        ({'field': '/n', 'operator': 'le', 'value': 3}, {'n': 4}, False),
+        # first_of
+        ({'field': '/tags', 'operator': 'first_of', 'value': 'a'},
+         {'tags': ['A', 'b']}, True),
+        ({'field': '/tags', 'operator': 'first_of', 'value': 'b'},
+         {'tags': ['a', 'b']}, False),
+        # match_of
+        ({'field': '/tags', 'operator': 'match_of', 'value': ['x', 'b']},
+         {'tags': ['a', 'B']}, True),
+        ({'field': '/tags', 'operator': 'match_of', 'value': ['x', 'y']},
+         {'tags': ['a', 'b']}, False),
+        ({'field': '/text', 'operator': 'match_of', 'value': ['foo', 'world']},
+         {'text': 'Hello world'}, True),
+        # length operators
+        ({'field': '/tags', 'operator': 'lene', 'value': 2}, {'tags': ['a', 'b']}, True),
+        ({'field': '/tags', 'operator': 'leng', 'value': 2}, {'tags': ['a', 'b']}, False),
+        ({'field': '/tags', 'operator': 'lenge', 'value': 2}, {'tags': ['a', 'b']}, True),
+        ({'field': '/tags', 'operator': 'lenl', 'value': 2}, {'tags': ['a']}, True),
+        ({'field': '/tags', 'operator': 'lenle', 'value': 0}, {'tags': ['a']}, False),
+        # missing fields never match
+        ({'field': '/uri', 'operator': 'equals', 'value': 'http://example.com'},
+         {}, False),
+        # a list of fields matches if any field matches
+        ({'field': ['/uri', '/document/link'], 'operator': 'equals', 'value': 'http://a.com'},
+         {'uri': 'http://b.com', 'document': {'link': 'http://a.com'}}, True),
+    ])
+    def test_clauses(self, clause, target, expected):
+        handler = FilterHandler(make_filter([clause]))
+
+        assert handler.match(target) is expected
+
+    @pytest.mark.parametrize('policy,expected', [
+        ('include_any', True),
+        ('include_all', False),
+        ('exclude_any', False),
+        ('exclude_all', True),
+    ])
+    def test_match_policies(self, policy, expected):
+        handler = FilterHandler(make_filter([
+            {'field': '/uri', 'operator': 'equals', 'value': 'http://example.com'},
+            {'field': '/group', 'operator': 'equals', 'value': 'foo'},
+        ], match_policy=policy))
+
+        assert handler.match({'uri': 'http://example.com', 'group': 'bar'}) is expected
+
+    def test_matches_everything_without_clauses(self):
+        handler = FilterHandler(make_filter([]))
+
+        assert handler.match({}) is True
+
+    @pytest.mark.parametrize('action,expected', [
+        (None, True),
+        ('past', True),
+        ('create', True),
+        ('delete', False),
+    ])
+    def test_actions(self, action, expected):
+        handler = FilterHandler(make_filter([], actions={'create': True}))
+
+        assert handler.match({}, action) is expected
+
+    def test_matches_folded_targets(self):
+        handler = FilterHandler(make_filter([
+            {'field': '/uri', 'operator': 'one_of', 'value': ['http://example.com']},
+        ]))
+
+        assert handler.match(FoldedTarget({'uri': 'http://EXAMPLE.com'})) is True
+
+    def test_does_not_modify_filter(self):
+        clause = {'field': '/uri', 'operator': 'one_of', 'value': ['http://Example.com']}
+
+        FilterHandler(make_filter([clause]))
+
+        assert clause['value'] == ['http://Example.com']
+
+
+class TestFoldedTarget(object):
+    def test_get_folds_field_values(self):
+        target = FoldedTarget({'uri': 'http://Example.com/Café', 'tags': ['Foo']})
+
+        assert target.get('/uri') == 'http://example.com/cafe'
+        assert target.get('/tags') == ['foo']
+
+    def test_get_returns_none_for_missing_fields(self):
+        target = FoldedTarget({})
+
+        assert target.get('/uri') is None
+
+    def test_get_caches_values(self):
+        target = FoldedTarget({'tags': ['Foo']})
+
+        assert target.get('/tags') is target.get('/tags')
+
+
+def make_filter(clauses, match_policy='include_any', actions=None):
+    if actions is None:
+        actions = {'create': True, 'update': True, 'delete': True}
+    return {
+        'match_policy': match_policy,
+        'clauses': clauses,
+        'actions': actions,
+    }
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import pytest
+
+from h.streamer.history import EventHistory
+
+
+class TestEventHistory(object):
+    def test_next_seq_increments(self, recent_events):
+        assert recent_events.next_seq() == 1
+        assert recent_events.next_seq() == 2
+        assert recent_events.last_seq == 2
+
+    def test_since_returns_events_after_seq(self, recent_events):
+        add_events(recent_events, 'abcd')
+
+        assert recent_events.since(recent_events.epoch, 2) == ['c', 'd']
+
+    def test_since_returns_events_up_to_until(self, recent_events):
+        add_events(recent_events, 'abcd')
+
+        assert recent_events.since(recent_events.epoch, 1, until=3) == ['b', 'c']
+
+    def test_since_returns_empty_list_when_up_to_date(self, recent_events):
+        add_events(recent_events, 'ab')
+
+        assert recent_events.since(recent_events.epoch, 2) == []
+
+    def test_since_returns_none_for_other_epochs(self, recent_events):
+        add_events(recent_events, 'ab')
+
+        assert recent_events.since('something else', 1) is None
+
+    def test_since_returns_none_for_future_seqs(self, recent_events):
+        add_events(recent_events, 'ab')
+
+        assert recent_events.since(recent_events.epoch, 3) is None
+
+    def test_since_returns_none_when_events_evicted(self):
+        recent_events = EventHistory(max_events=2)
+        add_events(recent_events, 'abcd')
+
+        assert len(recent_events) == 2
+        assert recent_events.since(recent_events.epoch, 1) is None
+        assert recent_events.since(recent_events.epoch, 2) == ['c', 'd']
+
+    def test_evicts_events_to_stay_within_max_bytes(self):
+        recent_events = EventHistory(max_events=10, max_bytes=25)
+        add_events(recent_events, 'abcd', size=10)
+
+        assert recent_events.since(recent_events.epoch, 2) == ['c', 'd']
+        assert recent_events.since(recent_events.epoch, 1) is None
+
+    def test_since_returns_none_across_gaps(self, recent_events):
+        add_events(recent_events, 'ab')
+        recent_events.add(recent_events.next_seq(), None, 0)
+        add_events(recent_events, 'd')
+
+        assert recent_events.since(recent_events.epoch, 1) is None
+        assert recent_events.since(recent_events.epoch, 3) == ['d']
+
+    def test_disabled_by_default(self):
+        recent_events = EventHistory()
+        add_events(recent_events, 'ab')
+
+        assert not recent_events.enabled
+        assert len(recent_events) == 0
+        assert recent_events.since(recent_events.epoch, 0) is None
+
+    def test_epochs_differ(self):
+        assert EventHistory().epoch != EventHistory().epoch
+
+    @pytest.fixture
+    def recent_events(self):
+        return EventHistory(max_events=10)
+
+
+def add_events(recent_events, events, size=1):
+    for event in events:
+        recent_events.add(recent_events.next_seq(), event, size)
@@ -1,12 +1,30 @@
 # -*- coding: utf-8 -*-
 
+import json
+import weakref
+
+import gevent
 import mock
 import pytest
 from gevent.queue import Queue
 from pyramid import security
 from pyramid import registry
 
+from h import realtime
+from h.streamer import history
 from h.streamer import messages
+from h.streamer import subscriptions
+from h.streamer import websocket
+
+
+class FakeSubscriptions(object):
+    def __init__(self, sockets):
+        self.sockets = sockets
+        self.targets = []
+
+    def sockets_for(self, target):
+        self.targets.append(target)
+        return self.sockets
 
 
 class FakeSocket(object):
@@ -28,6 +46,8 @@ class FakeSocket(object):
         self.send_json_payloads = []
 
     def send_json(self, payload):
+        if isinstance(payload, websocket.JSONMessage):
+            payload = json.loads(payload.data)
         self.send_json_payloads.append(payload)
 
 
@@ -116,9 +136,31 @@ class TestProcessMessages(object):
     def fake_consumer(self, patch):
         return patch('h.streamer.messages.Consumer')
 
+    def test_binds_annotation_consumer_to_subscribed_keys_if_topic_exchange_enabled(self,
+                                                                                    fake_consumer,
+                                                                                    queue):
+        settings = {'h.realtime.topic_exchange': 'true'}
+
+        messages.process_messages(settings, 'annotation', queue, raise_error=False)
+
+        kwargs = fake_consumer.call_args[1]
+        assert kwargs['exchange'] == realtime.get_topic_exchange()
+        assert kwargs['binding_keys'] == websocket.WebSocket.subscriptions.routing_keys
+
+    def test_consumes_user_messages_from_topic_exchange_if_enabled(self, fake_consumer, queue):
+        settings = {'h.realtime.topic_exchange': 'true'}
+
+        messages.process_messages(settings, 'user', queue, raise_error=False)
+
+        kwargs = fake_consumer.call_args[1]
+        assert kwargs['exchange'] == realtime.get_topic_exchange()
+        assert 'binding_keys' not in kwargs
+
     @pytest.fixture
     def fake_realtime(self, patch):
-        return patch('h.streamer.messages.realtime')
+        fake_realtime = patch('h.streamer.messages.realtime')
+        fake_realtime.use_topic_exchange.return_value = False
+        return fake_realtime
 
     @pytest.fixture
     def queue(self):
@@ -126,23 +168,24 @@ class TestProcessMessages(object):
 
 
 class TestHandleMessage(object):
-    def test_calls_handler_with_list_of_sockets(self, websocket):
+    def test_calls_handler_with_payload_settings_and_session(self):
         handler = mock.Mock(return_value=None)
         session = mock.sentinel.db_session
         settings = mock.sentinel.settings
         message = messages.Message(topic='foo', payload={'foo': 'bar'})
-        websocket.instances = [FakeSocket('a'), FakeSocket('b')]
 
         messages.handle_message(message, settings, session, topic_handlers={'foo': handler})
 
-        handler.assert_called_once_with(message.payload, list(websocket.instances), settings, session)
+        handler.assert_called_once_with(message.payload, settings, session)
 
-    @pytest.fixture
-    def websocket(self, patch):
-        return patch('h.streamer.websocket.WebSocket')
+    def test_raises_for_unknown_topic(self):
+        message = messages.Message(topic='foo', payload={'foo': 'bar'})
 
+        with pytest.raises(RuntimeError):
+            messages.handle_message(message, {}, None, topic_handlers={})
 
-@pytest.mark.usefixtures('fetch_annotation', 'groupfinder_service', 'links_service', 'nipsa_service')
+
+@pytest.mark.usefixtures('fetch_annotation', 'groupfinder_service', 'links_service', 'flagged_users')
 class TestHandleAnnotationEvent(object):
     def test_it_fetches_the_annotation(self, fetch_annotation, presenter_asdict):
         message = {
@@ -155,7 +198,8 @@ class TestHandleAnnotationEvent(object):
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         fetch_annotation.assert_called_once_with(session, 'panda')
 
@@ -176,17 +220,52 @@ class TestHandleAnnotationEvent(object):
         settings = {'foo': 'bar'}
         fetch_annotation.return_value = None
 
-        result = messages.handle_annotation_event(message, [socket], settings, session)
+        result = messages.handle_annotation_event(message, settings, session,
+                                                  subscriptions=FakeSubscriptions([socket]))
 
         assert result is None
 
+    def test_it_looks_up_candidate_sockets(self, fetch_annotation):
+        message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
+        annotation = fetch_annotation.return_value
+        subscriptions = FakeSubscriptions([])
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=subscriptions)
+
+        assert subscriptions.targets == [{'uri': annotation.target_uri,
+                                          'group': annotation.groupid,
+                                          'user': annotation.userid}]
+
+    def test_it_skips_services_when_no_candidate_sockets(self, flagged_users, groupfinder_service):
+        message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([]))
+
+        assert not flagged_users.is_flagged.called
+        assert not groupfinder_service.called
+
+    def test_it_checks_nipsa_using_the_flagged_users(self, fetch_annotation, flagged_users,
+                                                     presenter_asdict):
+        message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_event(message, {}, session,
+                                         subscriptions=FakeSubscriptions([FakeSocket('giraffe')]))
+
+        flagged_users.is_flagged.assert_called_once_with(fetch_annotation.return_value.userid,
+                                                         session)
+
     def test_it_initializes_groupfinder_service(self, groupfinder_service):
         message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
         session = mock.sentinel.db_session
         socket = FakeSocket('giraffe')
         settings = {'h.authority': 'example.org'}
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         groupfinder_service.assert_called_once_with(session, 'example.org')
 
@@ -203,7 +282,8 @@ class TestHandleAnnotationEvent(object):
         presenters.AnnotationJSONPresenter.return_value.asdict.return_value = (
             self.serialized_annotation())
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         annotation_resource.assert_called_once_with(
             fetch_annotation.return_value,
@@ -214,6 +294,42 @@ class TestHandleAnnotationEvent(object):
             annotation_resource.return_value)
         assert presenters.AnnotationJSONPresenter.return_value.asdict.called
 
+    def test_it_serializes_the_annotation_once_for_all_sockets(self, presenters):
+        message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
+        sockets = [FakeSocket('giraffe'), FakeSocket('elephant')]
+        presenters.AnnotationJSONPresenter.return_value.asdict.return_value = (
+            self.serialized_annotation())
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions(sockets))
+
+        assert presenters.AnnotationJSONPresenter.return_value.asdict.call_count == 1
+        assert len(sockets[0].send_json_payloads) == 1
+        assert len(sockets[1].send_json_payloads) == 1
+
+    def test_it_sends_the_same_message_to_all_sockets(self, presenter_asdict):
+        message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
+        sockets = [mock.Mock(client_id=None,
+                             authenticated_userid=None,
+                             effective_principals=[security.Everyone])
+                   for _ in range(2)]
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions(sockets))
+
+        sent = [s.send_json.call_args[0][0] for s in sockets]
+        assert isinstance(sent[0], websocket.JSONMessage)
+        assert sent[0] is sent[1]
+
+    def test_it_does_not_fetch_the_annotation_for_read_events(self, fetch_annotation):
+        message = {'action': 'read', 'annotation_id': '_', 'src_client_id': '_'}
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([FakeSocket('giraffe')]))
+
+        assert not fetch_annotation.called
+
     def test_notification_format(self, presenter_asdict):
         """Check the format of the returned notification in the happy case."""
         message = {
@@ -226,7 +342,8 @@ class TestHandleAnnotationEvent(object):
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert socket.send_json_payloads[0] == {
             'payload': [self.serialized_annotation()],
@@ -247,7 +364,8 @@ class TestHandleAnnotationEvent(object):
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert socket.send_json_payloads[0] == {
             'payload': [{'id': annotation.id}],
@@ -263,7 +381,8 @@ class TestHandleAnnotationEvent(object):
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert socket.send_json_payloads == []
 
@@ -276,7 +395,8 @@ class TestHandleAnnotationEvent(object):
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert socket.send_json_payloads == []
 
@@ -288,7 +408,8 @@ class TestHandleAnnotationEvent(object):
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert socket.send_json_payloads == []
 
@@ -301,24 +422,26 @@ class TestHandleAnnotationEvent(object):
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert socket.send_json_payloads == []
 
-    def test_no_send_if_annotation_nipsad(self, nipsa_service, presenter_asdict):
+    def test_no_send_if_annotation_nipsad(self, flagged_users, presenter_asdict):
         """Should return None if the annotation is from a NIPSA'd user."""
         message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
         socket = FakeSocket('giraffe')
         session = mock.sentinel.db_session
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
-        nipsa_service.return_value.is_flagged.return_value = True
+        flagged_users.is_flagged.return_value = True
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert socket.send_json_payloads == []
 
-    def test_sends_nipsad_annotations_to_owners(self, fetch_annotation, nipsa_service, presenter_asdict):
+    def test_sends_nipsad_annotations_to_owners(self, fetch_annotation, flagged_users, presenter_asdict):
         """NIPSA'd users should see their own annotations."""
         message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
         fetch_annotation.return_value.userid = 'fred'
@@ -327,9 +450,10 @@ class TestHandleAnnotationEvent(object):
         session = mock.sentinel.db_session
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
-        nipsa_service.return_value.is_flagged.return_value = True
+        flagged_users.is_flagged.return_value = True
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert len(socket.send_json_payloads) == 1
 
@@ -349,7 +473,8 @@ class TestHandleAnnotationEvent(object):
         settings = {'foo': 'bar'}
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert len(socket.send_json_payloads) == 1
 
@@ -363,7 +488,8 @@ class TestHandleAnnotationEvent(object):
         presenter_asdict.return_value = self.serialized_annotation({
             'permissions': {'read': ['group:private-group']}})
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert socket.send_json_payloads == []
 
@@ -378,10 +504,159 @@ class TestHandleAnnotationEvent(object):
         presenter_asdict.return_value = self.serialized_annotation({
             'permissions': {'read': ['group:private-group']}})
 
-        messages.handle_annotation_event(message, [socket], settings, session)
+        messages.handle_annotation_event(message, settings, session,
+                                         subscriptions=FakeSubscriptions([socket]))
 
         assert len(socket.send_json_payloads) == 1
 
+    def test_notification_format_delete_for_embedded_annotations(self):
+        message = {'action': 'delete', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': self.embedded_annotation()}
+        socket = FakeSocket('giraffe')
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([socket]))
+
+        assert socket.send_json_payloads[0]['payload'] == [{'id': 'panda'}]
+
+    def test_it_uses_embedded_annotations(self,
+                                          fetch_annotation,
+                                          groupfinder_service,
+                                          presenters,
+                                          flagged_users):
+        annotation = self.embedded_annotation()
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': annotation}
+        socket = FakeSocket('giraffe')
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([socket]))
+
+        assert not fetch_annotation.called
+        assert not groupfinder_service.called
+        assert not presenters.AnnotationJSONPresenter.called
+        assert socket.send_json_payloads[0]['payload'] == [annotation]
+
+    def test_it_looks_up_candidate_sockets_for_embedded_annotations(self):
+        annotation = self.embedded_annotation()
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': annotation}
+        subscriptions = FakeSubscriptions([])
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=subscriptions)
+
+        assert subscriptions.targets == [annotation]
+
+    def test_it_checks_nipsa_for_embedded_annotations(self, flagged_users):
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': self.embedded_annotation()}
+        session = mock.sentinel.db_session
+
+        messages.handle_annotation_event(message, {}, session,
+                                         subscriptions=FakeSubscriptions([FakeSocket('giraffe')]))
+
+        flagged_users.is_flagged.assert_called_once_with('acct:fred@example.com', session)
+
+    def test_it_checks_read_permissions_of_embedded_annotations(self):
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': self.embedded_annotation({
+                       'permissions': {'read': ['group:private-group']}})}
+        socket = FakeSocket('giraffe')
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([socket]))
+
+        assert socket.send_json_payloads == []
+
+    def test_it_includes_history_seq_in_notifications(self, recent_events):
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': self.embedded_annotation()}
+        socket = FakeSocket('giraffe')
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([socket]),
+                                         recent_events=recent_events)
+
+        notification = socket.send_json_payloads[0]
+        assert notification['epoch'] == recent_events.epoch
+        assert notification['seq'] == 1
+
+    def test_it_records_events_without_candidate_sockets(self, recent_events):
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': self.embedded_annotation()}
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([]),
+                                         recent_events=recent_events)
+
+        events = recent_events.since(recent_events.epoch, 0)
+        assert [json.loads(e.notification)['payload'][0]['id'] for e in events] == ['panda']
+
+    def test_it_only_records_the_encoded_notification(self, recent_events):
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': self.embedded_annotation()}
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([]),
+                                         recent_events=recent_events)
+
+        [event] = recent_events.since(recent_events.epoch, 0)
+        assert event.target is None
+        assert isinstance(event.notification, bytes)
+
+    def test_it_records_the_encoded_annotation_of_delete_events(self, recent_events):
+        message = {'action': 'delete', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': self.embedded_annotation()}
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([]),
+                                         recent_events=recent_events)
+
+        [event] = recent_events.since(recent_events.epoch, 0)
+        assert json.loads(event.notification)['payload'] == [{'id': 'panda'}]
+        assert json.loads(event.target)['uri'] == 'http://example.com'
+
+    def test_it_records_the_size_of_everything_kept(self, recent_events):
+        message = {'action': 'delete', 'annotation_id': 'panda', 'src_client_id': '_',
+                   'annotation': self.embedded_annotation()}
+        recent_events.add = mock.Mock()
+
+        messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                         subscriptions=FakeSubscriptions([]),
+                                         recent_events=recent_events)
+
+        _, event, size = recent_events.add.call_args[0]
+        assert size == (len(event.notification) +
+                        len(event.target) +
+                        len(event.userid) +
+                        sum(len(p) for p in event.read_principals))
+
+    def test_it_records_a_gap_if_it_cannot_present_the_annotation(self, recent_events):
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_'}
+
+        with mock.patch.object(websocket.WebSocket, 'instances', weakref.WeakSet()):
+            messages.handle_annotation_event(message, {}, mock.sentinel.db_session,
+                                             subscriptions=FakeSubscriptions([]),
+                                             recent_events=recent_events)
+
+        assert recent_events.last_seq == 1
+        assert recent_events.since(recent_events.epoch, 0) is None
+
+    @pytest.fixture
+    def recent_events(self):
+        return history.EventHistory(max_events=10)
+
+    def embedded_annotation(self, data=None):
+        embedded = self.serialized_annotation({
+            'id': 'panda',
+            'uri': 'http://example.com',
+            'group': '__world__',
+            'user': 'acct:fred@example.com',
+        })
+        embedded.update(data or {})
+        return embedded
+
     def serialized_annotation(self, data=None):
         if data is None:
             data = {}
@@ -416,16 +691,217 @@ class TestHandleAnnotationEvent(object):
         return patch('h.streamer.messages.GroupfinderService')
 
     @pytest.fixture
-    def nipsa_service(self, patch):
-        service = patch('h.streamer.messages.NipsaService')
-        service.return_value.is_flagged.return_value = False
-        return service
+    def flagged_users(self, patch):
+        flagged_users = patch('h.streamer.nipsa.FLAGGED_USERS')
+        flagged_users.is_flagged.return_value = False
+        return flagged_users
 
     @pytest.fixture
     def annotation_resource(self, patch):
         return patch('h.streamer.messages.AnnotationResource')
 
 
+class TestHandleAnnotationEventConcurrency(object):
+    def test_socket_setting_its_filter_during_presentation_gets_the_event_once(self,
+                                                                               recent_events,
+                                                                               instances,
+                                                                               present_annotation):
+        socket = FakeSocket('giraffe')
+        instances.add(socket)
+
+        def present(annotation, group_service, registry):
+            gevent.sleep(0.01)
+            return {'id': 'panda',
+                    'uri': 'http://example.com',
+                    'group': '__world__',
+                    'user': 'acct:fred@example.com',
+                    'permissions': {'read': ['group:__world__']}}
+        present_annotation.side_effect = present
+
+        message = {'action': 'create', 'annotation_id': 'panda', 'src_client_id': '_'}
+        event = gevent.spawn(messages.handle_annotation_event,
+                             message, {}, mock.sentinel.db_session,
+                             recent_events=recent_events)
+        gevent.sleep(0)
+        websocket.handle_filter_message(websocket.Message(socket=socket, payload={
+            'filter': {'match_policy': 'include_any',
+                       'clauses': [{'field': '/uri',
+                                    'operator': 'one_of',
+                                    'value': ['http://example.com']}],
+                       'actions': {'create': True}},
+        }))
+        event.get(timeout=1)
+
+        live = socket.send_json_payloads
+        replayed = recent_events.since(recent_events.epoch, 0, until=socket.filter_seq)
+        assert len(live) + len(replayed) == 1
+
+    @pytest.fixture
+    def recent_events(self):
+        recent_events = history.EventHistory(max_events=10)
+        with mock.patch.object(history, 'RECENT_EVENTS', recent_events):
+            yield recent_events
+
+    @pytest.fixture(autouse=True)
+    def subscription_index(self):
+        index = subscriptions.SubscriptionIndex()
+        with mock.patch.object(websocket.WebSocket, 'subscriptions', index):
+            yield index
+
+    @pytest.fixture(autouse=True)
+    def instances(self):
+        instances = weakref.WeakSet()
+        with mock.patch.object(websocket.WebSocket, 'instances', instances):
+            yield instances
+
+    @pytest.fixture(autouse=True)
+    def fetch_annotation(self, patch):
+        fetch = patch('h.streamer.messages.storage.fetch_annotation')
+        fetch.return_value = mock.Mock(id='panda',
+                                       target_uri='http://example.com',
+                                       groupid='__world__',
+                                       userid='acct:fred@example.com')
+        return fetch
+
+    @pytest.fixture
+    def present_annotation(self, patch):
+        return patch('h.streamer.messages._present_annotation')
+
+    @pytest.fixture(autouse=True)
+    def flagged_users(self, patch):
+        flagged_users = patch('h.streamer.nipsa.FLAGGED_USERS')
+        flagged_users.is_flagged.return_value = False
+        return flagged_users
+
+    @pytest.fixture(autouse=True)
+    def groupfinder_service(self, patch):
+        return patch('h.streamer.messages.GroupfinderService')
+
+
+class TestHandleResumeMessage(object):
+    def test_replays_missed_events(self, recent_events, socket):
+        add_events(recent_events, 3)
+        socket.filter_seq = 3
+
+        messages.handle_resume_message(resume_message(socket, recent_events.epoch, 1),
+                                       recent_events=recent_events)
+
+        assert socket.send_json_payloads[:2] == [{'n': 2}, {'n': 3}]
+        assert socket.send_json_payloads[2]['type'] == 'resumed'
+
+    def test_does_not_replay_events_after_filter_was_set(self, recent_events, socket):
+        add_events(recent_events, 3)
+        socket.filter_seq = 2
+
+        messages.handle_resume_message(resume_message(socket, recent_events.epoch, 0),
+                                       recent_events=recent_events)
+
+        assert socket.send_json_payloads[:2] == [{'n': 1}, {'n': 2}]
+        assert socket.send_json_payloads[2]['type'] == 'resumed'
+
+    def test_replays_events_through_filter(self, recent_events, socket):
+        add_events(recent_events, 2)
+        socket.filter_seq = 2
+        socket.filter.match.side_effect = lambda target, action: target.get('/n') == 2
+
+        messages.handle_resume_message(resume_message(socket, recent_events.epoch, 0),
+                                       recent_events=recent_events)
+
+        assert socket.send_json_payloads[0] == {'n': 2}
+
+    def test_replays_events_through_filter_with_the_notifications_annotation(
+            self, recent_events, socket):
+        recent_events.add(recent_events.next_seq(), messages.BufferedEvent(
+            action='create',
+            src_client_id=None,
+            userid='acct:fred@example.com',
+            user_nipsad=False,
+            read_principals=frozenset([security.Everyone]),
+            target=None,
+            notification=json.dumps({'payload': [{'n': 1}]})), 1)
+        socket.filter_seq = 1
+
+        messages.handle_resume_message(resume_message(socket, recent_events.epoch, 0),
+                                       recent_events=recent_events)
+
+        target, _ = socket.filter.match.call_args[0]
+        assert target.get('/n') == 1
+
+    def test_replies_with_error_when_events_unavailable(self, recent_events, socket):
+        add_events(recent_events, 2)
+        socket.filter_seq = 2
+
+        messages.handle_resume_message(resume_message(socket, 'other epoch', 0),
+                                       recent_events=recent_events)
+
+        assert socket.send_json_payloads[0]['ok'] is False
+        assert socket.send_json_payloads[0]['error']['type'] == 'resume_unavailable'
+
+    def test_replies_with_error_when_using_topic_exchange(self, recent_events, socket):
+        add_events(recent_events, 2)
+        socket.filter_seq = 2
+        socket.registry.settings['h.realtime.topic_exchange'] = 'true'
+
+        messages.handle_resume_message(resume_message(socket, recent_events.epoch, 0),
+                                       recent_events=recent_events)
+
+        assert socket.send_json_payloads[0]['error']['type'] == 'resume_unavailable'
+
+    @pytest.mark.parametrize('payload', [
+        {'epoch': 'abc'},
+        {'epoch': 'abc', 'seq': 'one'},
+    ])
+    def test_replies_with_error_for_invalid_messages(self, recent_events, socket, payload):
+        payload.update({'type': 'resume', 'id': 1})
+        message = websocket.Message(socket=socket, payload=payload)
+
+        messages.handle_resume_message(message, recent_events=recent_events)
+
+        assert socket.send_json_payloads[0]['error']['type'] == 'invalid_data'
+
+    def test_replies_with_error_without_filter(self, recent_events, socket):
+        socket.filter = None
+
+        messages.handle_resume_message(resume_message(socket, recent_events.epoch, 0),
+                                       recent_events=recent_events)
+
+        assert socket.send_json_payloads[0]['error']['type'] == 'invalid_data'
+
+    def test_is_registered_as_websocket_message_handler(self):
+        assert websocket.MESSAGE_HANDLERS['resume'] == messages.handle_resume_message
+
+    @pytest.fixture
+    def recent_events(self):
+        return history.EventHistory(max_events=10)
+
+    @pytest.fixture
+    def socket(self):
+        socket = FakeSocket('giraffe')
+        socket.filter_seq = None
+        return socket
+
+
+def add_events(recent_events, count):
+    events = []
+    for _ in range(count):
+        seq = recent_events.next_seq()
+        event = messages.BufferedEvent(action='create',
+                                       src_client_id=None,
+                                       userid='acct:fred@example.com',
+                                       user_nipsad=False,
+                                       read_principals=frozenset([security.Everyone]),
+                                       target=json.dumps({'n': seq}),
+                                       notification=json.dumps({'n': seq}))
+        recent_events.add(seq, event, 1)
+        events.append(event)
+    return events
+
+
+def resume_message(socket, epoch, seq):
+    return websocket.Message(socket=socket,
+                             payload={'type': 'resume', 'id': 1, 'epoch': epoch, 'seq': seq})
+
+
 class TestHandleUserEvent(object):
     def test_sends_session_change_when_joining_or_leaving_group(self):
         session_model = mock.Mock()
@@ -438,7 +914,7 @@ class TestHandleUserEvent(object):
         socket = FakeSocket('clientid')
         socket.authenticated_userid = 'amy'
 
-        messages.handle_user_event(message, [socket], None, None)
+        messages.handle_user_event(message, None, None, sockets=[socket])
 
         assert socket.send_json_payloads[0] == {
             'type': 'session-change',
@@ -456,6 +932,26 @@ class TestHandleUserEvent(object):
         socket = FakeSocket('clientid')
         socket.authenticated_userid = 'bob'
 
-        messages.handle_user_event(message, [socket], None, None)
+        messages.handle_user_event(message, None, None, sockets=[socket])
+
+        assert socket.send_json_payloads == []
+
+    @pytest.mark.parametrize('nipsa', [True, False])
+    def test_updates_flagged_users_on_nipsa_change(self, nipsa):
+        message = {'type': 'nipsa-change', 'userid': 'amy', 'nipsa': nipsa}
+        flagged_users = mock.Mock(spec_set=['update'])
+
+        messages.handle_user_event(message, None, None, sockets=[],
+                                   flagged_users=flagged_users)
+
+        flagged_users.update.assert_called_once_with('amy', nipsa)
+
+    def test_no_send_on_nipsa_change(self):
+        message = {'type': 'nipsa-change', 'userid': 'amy', 'nipsa': True}
+        socket = FakeSocket('clientid')
+        socket.authenticated_userid = 'amy'
+
+        messages.handle_user_event(message, None, None, sockets=[socket],
+                                   flagged_users=mock.Mock(spec_set=['update']))
 
         assert socket.send_json_payloads == []
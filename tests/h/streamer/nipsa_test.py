@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import mock
+import pytest
+
+from h.streamer import nipsa
+
+
+class TestFlaggedUsers(object):
+    def test_refresh_loads_flagged_userids(self, db_session, factories):
+        factories.User(username='renata', authority='example.com', nipsa=True)
+        factories.User(username='dominic', authority='example.com', nipsa=False)
+        db_session.flush()
+        flagged_users = nipsa.FlaggedUsers()
+
+        flagged_users.refresh(db_session)
+
+        assert 'acct:renata@example.com' in flagged_users
+        assert 'acct:dominic@example.com' not in flagged_users
+        assert flagged_users.loaded
+
+    def test_is_flagged_loads_the_set_on_first_use(self, flagged_users, session):
+        flagged_users.is_flagged('acct:renata@example.com', session)
+        flagged_users.is_flagged('acct:renata@example.com', session)
+
+        flagged_users.refresh.assert_called_once_with(session)
+
+    def test_is_flagged_does_not_query_once_loaded(self, flagged_users, session):
+        flagged_users.loaded = True
+        flagged_users.update('acct:renata@example.com', True)
+
+        assert flagged_users.is_flagged('acct:renata@example.com', session)
+        assert not flagged_users.is_flagged('acct:dominic@example.com', session)
+        assert not flagged_users.refresh.called
+
+    def test_update_flags_and_unflags_users(self):
+        flagged_users = nipsa.FlaggedUsers()
+
+        flagged_users.update('acct:renata@example.com', True)
+        assert 'acct:renata@example.com' in flagged_users
+
+        flagged_users.update('acct:renata@example.com', False)
+        assert 'acct:renata@example.com' not in flagged_users
+        assert len(flagged_users) == 0
+
+    @pytest.fixture
+    def flagged_users(self):
+        flagged_users = nipsa.FlaggedUsers()
+
+        def refresh(session):
+            flagged_users.loaded = True
+
+        flagged_users.refresh = mock.Mock(spec_set=[], side_effect=refresh)
+        return flagged_users
+
+    @pytest.fixture
+    def session(self):
+        return mock.sentinel.session
+
+
+class TestRefreshPeriodically(object):
+    def test_it_refreshes_the_flagged_users(self, flagged_users, session, sleep):
+        with pytest.raises(StopIteration):
+            nipsa.refresh_periodically({}, lambda _: session, interval=5)
+
+        flagged_users.refresh.assert_called_once_with(session)
+        session.commit.assert_called_once_with()
+        session.close.assert_called_once_with()
+        sleep.assert_called_once_with(5)
+
+    def test_it_rolls_back_on_error(self, flagged_users, session, sleep):
+        flagged_users.refresh.side_effect = RuntimeError('explosion')
+
+        with pytest.raises(StopIteration):
+            nipsa.refresh_periodically({}, lambda _: session)
+
+        session.rollback.assert_called_once_with()
+        session.close.assert_called_once_with()
+
+    @pytest.fixture
+    def flagged_users(self, patch):
+        return patch('h.streamer.nipsa.FLAGGED_USERS')
+
+    @pytest.fixture
+    def session(self):
+        return mock.Mock(spec_set=['close', 'commit', 'rollback'])
+
+    @pytest.fixture
+    def sleep(self, patch):
+        sleep = patch('h.streamer.nipsa.gevent.sleep')
+        sleep.side_effect = StopIteration
+        return sleep
@@ -109,6 +109,61 @@ def test_process_work_queue_calls_close_after_rollback(session):
     ]
 
 
+class TestDispatchWorkQueue(object):
+    def test_it_routes_messages_from_the_same_socket_to_the_same_worker(self):
+        socket = mock.sentinel.SOCKET
+        queue = [websocket.Message(socket=socket, payload=i) for i in range(10)]
+        worker_queues = [FakeQueue(), FakeQueue(), FakeQueue()]
+
+        streamer.dispatch_work_queue(queue, worker_queues)
+
+        assert sorted(worker_queues, key=len)[-1] == queue
+
+    def test_it_routes_events_for_the_same_annotation_to_the_same_worker(self):
+        queue = [messages.Message(topic='annotation',
+                                  payload={'action': action, 'annotation_id': 'abc'})
+                 for action in ['create', 'update', 'delete']]
+        worker_queues = [FakeQueue(), FakeQueue(), FakeQueue()]
+
+        streamer.dispatch_work_queue(queue, worker_queues)
+
+        assert sorted(worker_queues, key=len)[-1] == queue
+
+    def test_it_routes_events_for_the_same_user_to_the_same_worker(self):
+        queue = [messages.Message(topic='user',
+                                  payload={'type': 'session-change', 'userid': 'acct:a@b.com'})
+                 for _ in range(5)]
+        worker_queues = [FakeQueue(), FakeQueue(), FakeQueue()]
+
+        streamer.dispatch_work_queue(queue, worker_queues)
+
+        assert sorted(worker_queues, key=len)[-1] == queue
+
+    def test_it_spreads_messages_across_workers(self):
+        queue = [messages.Message(topic='annotation',
+                                  payload={'action': 'create', 'annotation_id': str(i)})
+                 for i in range(100)]
+        worker_queues = [FakeQueue(), FakeQueue(), FakeQueue()]
+
+        streamer.dispatch_work_queue(queue, worker_queues)
+
+        assert all(worker_queues)
+        assert sum(len(q) for q in worker_queues) == 100
+
+    def test_it_routes_unknown_messages(self):
+        queue = ['something that is not a message']
+        worker_queues = [FakeQueue(), FakeQueue()]
+
+        streamer.dispatch_work_queue(queue, worker_queues)
+
+        assert sum(worker_queues, []) == queue
+
+
+class FakeQueue(list):
+    def put(self, item):
+        self.append(item)
+
+
 @pytest.fixture
 def session():
     return mock.Mock(spec_set=['close', 'commit', 'execute', 'rollback'])
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import pytest
+
+from h import realtime
+from h.streamer.subscriptions import SubscriptionIndex
+
+
+class FakeSocket(object):
+    pass
+
+
+class TestSubscriptionIndex(object):
+    def test_returns_sockets_subscribed_to_uri(self, index, socket):
+        index.update(socket, uri_filter(['http://example.com',
+                                         'http://example.com/alternate']))
+
+        assert index.sockets_for(target(uri='http://example.com/alternate')) == [socket]
+
+    def test_does_not_return_sockets_subscribed_to_other_uris(self, index, socket):
+        index.update(socket, uri_filter(['http://example.com']))
+
+        assert index.sockets_for(target(uri='http://example.org')) == []
+
+    def test_uri_lookup_is_case_and_accent_insensitive(self, index, socket):
+        index.update(socket, uri_filter(['http://example.com/Café']))
+
+        assert index.sockets_for(target(uri='http://EXAMPLE.com/cafe')) == [socket]
+
+    @pytest.mark.parametrize('field,key', [
+        ('/group', 'group'),
+        ('/user', 'user'),
+    ])
+    def test_returns_sockets_subscribed_to_group_or_user(self, index, socket, field, key):
+        index.update(socket, {
+            'match_policy': 'include_any',
+            'clauses': [{'field': field, 'operator': 'equals', 'value': 'foo'}],
+            'actions': {},
+        })
+
+        assert index.sockets_for(target(**{key: 'foo'})) == [socket]
+        assert index.sockets_for(target(**{key: 'bar'})) == []
+
+    def test_include_all_filters_are_indexed_by_most_selective_clause(self, index, socket):
+        index.update(socket, {
+            'match_policy': 'include_all',
+            'clauses': [
+                {'field': '/uri', 'operator': 'one_of', 'value': ['http://a.com', 'http://b.com']},
+                {'field': '/group', 'operator': 'equals', 'value': 'foo'},
+                {'field': '/text', 'operator': 'matches', 'value': 'bar'},
+            ],
+            'actions': {},
+        })
+
+        assert index.sockets_for(target(uri='http://a.com', group='foo')) == [socket]
+        assert index.sockets_for(target(uri='http://a.com', group='bar')) == []
+
+    @pytest.mark.parametrize('filter_', [
+        # No clauses match everything
+        {'match_policy': 'include_any', 'clauses': [], 'actions': {}},
+        # Exclusion filters can't be indexed
+        {'match_policy': 'exclude_any',
+         'clauses': [{'field': '/uri', 'operator': 'one_of', 'value': ['http://a.com']}],
+         'actions': {}},
+        # Unindexed fields
+        {'match_policy': 'include_any',
+         'clauses': [{'field': '/text', 'operator': 'equals', 'value': 'foo'}],
+         'actions': {}},
+        # Substring matches
+        {'match_policy': 'include_any',
+         'clauses': [{'field': '/uri', 'operator': 'matches', 'value': 'example'}],
+         'actions': {}},
+        # Any unindexable clause in an include_any filter
+        {'match_policy': 'include_any',
+         'clauses': [{'field': '/uri', 'operator': 'one_of', 'value': ['http://a.com']},
+                     {'field': '/text', 'operator': 'equals', 'value': 'foo'}],
+         'actions': {}},
+    ])
+    def test_unindexable_filters_match_every_target(self, index, socket, filter_):
+        index.update(socket, filter_)
+
+        assert index.sockets_for(target(uri='http://example.com')) == [socket]
+
+    def test_update_replaces_existing_subscription(self, index, socket):
+        index.update(socket, uri_filter(['http://example.com']))
+        index.update(socket, uri_filter(['http://example.org']))
+
+        assert index.sockets_for(target(uri='http://example.com')) == []
+        assert index.sockets_for(target(uri='http://example.org')) == [socket]
+
+    def test_remove(self, index, socket):
+        index.update(socket, uri_filter(['http://example.com']))
+
+        index.remove(socket)
+
+        assert index.sockets_for(target(uri='http://example.com')) == []
+        assert len(index) == 0
+
+    def test_remove_ignores_unknown_sockets(self, index, socket):
+        index.remove(socket)
+
+    def test_returns_each_socket_once(self, index, socket):
+        index.update(socket, {
+            'match_policy': 'include_any',
+            'clauses': [
+                {'field': '/uri', 'operator': 'one_of', 'value': ['http://a.com']},
+                {'field': '/group', 'operator': 'equals', 'value': 'foo'},
+            ],
+            'actions': {},
+        })
+
+        assert index.sockets_for(target(uri='http://a.com', group='foo')) == [socket]
+
+    def test_drops_garbage_collected_sockets(self, index):
+        index.update(FakeSocket(), uri_filter(['http://example.com']))
+
+        assert index.sockets_for(target(uri='http://example.com')) == []
+
+    def test_routing_keys_for_uri_subscriptions(self, index, socket):
+        index.update(socket, uri_filter(['http://example.com', 'http://Example.org']))
+
+        assert index.routing_keys() == frozenset([
+            realtime.annotation_binding_key(uri='http://example.com'),
+            realtime.annotation_binding_key(uri='http://example.org'),
+        ])
+
+    def test_routing_keys_for_group_subscriptions(self, index, socket):
+        index.update(socket, {
+            'match_policy': 'include_any',
+            'clauses': [{'field': '/group', 'operator': 'equals', 'value': 'foo'}],
+            'actions': {},
+        })
+
+        assert index.routing_keys() == frozenset([
+            realtime.annotation_binding_key(groupid='foo'),
+        ])
+
+    @pytest.mark.parametrize('filter_', [
+        {'match_policy': 'include_any', 'clauses': [], 'actions': {}},
+        {'match_policy': 'include_any',
+         'clauses': [{'field': '/user', 'operator': 'equals', 'value': 'acct:a@b.com'}],
+         'actions': {}},
+    ])
+    def test_routing_keys_match_everything_if_any_socket_cannot_be_routed(self, index, socket, filter_):
+        other_socket = FakeSocket()
+        index.update(socket, uri_filter(['http://example.com']))
+        index.update(other_socket, filter_)
+
+        assert index.routing_keys() == frozenset(['annotation.#'])
+
+    def test_routing_keys_are_empty_without_subscriptions(self, index):
+        assert index.routing_keys() == frozenset()
+
+    def test_routing_keys_are_cached_until_the_index_changes(self, index, socket):
+        index.update(socket, uri_filter(['http://example.com']))
+        keys = index.routing_keys()
+
+        assert index.routing_keys() is keys
+
+        index.remove(socket)
+
+        assert index.routing_keys() == frozenset()
+
+    @pytest.fixture
+    def index(self):
+        return SubscriptionIndex()
+
+    @pytest.fixture
+    def socket(self):
+        return FakeSocket()
+
+
+def uri_filter(uris):
+    return {
+        'match_policy': 'include_any',
+        'clauses': [{'field': '/uri', 'operator': 'one_of', 'value': uris}],
+        'actions': {},
+    }
+
+
+def target(uri='http://example.com/other', group='__world__', user='acct:luke@example.com'):
+    return {'uri': uri, 'group': group, 'user': user}
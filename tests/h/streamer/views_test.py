@@ -35,6 +35,18 @@ def test_websocket_view_adds_work_queue_to_environ(pyramid_request):
     assert env['h.ws.streamer_work_queue'] == streamer.WORK_QUEUE
 
 
+def test_websocket_view_adds_outbox_settings_to_environ(pyramid_request):
+    pyramid_request.registry.settings['h.streamer.outbox_size'] = '10'
+    pyramid_request.registry.settings['h.streamer.slow_client_policy'] = 'disconnect'
+    pyramid_request.get_response = lambda _: None
+
+    views.websocket_view(pyramid_request)
+    env = pyramid_request.environ
+
+    assert env['h.ws.outbox_size'] == 10
+    assert env['h.ws.slow_client_policy'] == 'disconnect'
+
+
 @pytest.fixture
 def pyramid_request(pyramid_request):
     return pyramid_request
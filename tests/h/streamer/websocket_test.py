@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from collections import namedtuple
+import socket
 
+import gevent
 import mock
 import pytest
 from gevent.queue import Queue
@@ -65,6 +67,32 @@ class TestMessage(object):
         return mock.Mock(spec_set=['send_json'])
 
 
+class TestJSONMessage(object):
+    def test_serializes_payload(self):
+        message = websocket.JSONMessage({'foo': 'bar'})
+
+        assert message.data == b'{"foo": "bar"}'
+
+    def test_reuses_unmasked_frame(self):
+        message = websocket.JSONMessage({'foo': 'bar'})
+
+        frame = message.single()
+
+        assert frame.endswith(b'{"foo": "bar"}')
+        assert message.single() is frame
+
+    def test_does_not_reuse_masked_frames(self):
+        message = websocket.JSONMessage({'foo': 'bar'})
+
+        assert message.single(mask=True) is not message.single(mask=True)
+
+    def test_encoded_uses_already_encoded_payload(self):
+        message = websocket.JSONMessage.encoded(b'{"foo": "bar"}')
+
+        assert message.data == b'{"foo": "bar"}'
+        assert message.single().endswith(b'{"foo": "bar"}')
+
+
 class TestWebSocket(object):
     def test_stores_instance_list(self, fake_environ):
         clients = [
@@ -88,6 +116,18 @@ class TestWebSocket(object):
         # A second closure (however unusual) should not raise
         client1.closed(1000)
 
+    def test_removes_self_from_subscriptions_when_closed(self, fake_environ):
+        client = websocket.WebSocket(mock.sentinel.sock1, environ=fake_environ)
+        websocket.WebSocket.subscriptions.update(client, {
+            'match_policy': 'include_any',
+            'clauses': [],
+            'actions': {},
+        })
+
+        client.closed(1000)
+
+        assert client not in websocket.WebSocket.subscriptions.sockets_for({})
+
     def test_enqueues_incoming_messages(self, client, queue):
         """Valid messages are pushed onto the queue."""
         message = FakeMessage('{"foo":"bar"}')
@@ -142,23 +182,103 @@ class TestWebSocket(object):
     def test_socket_sets_registry_from_environ(self, client):
         assert client.registry == mock.sentinel.registry
 
-    def test_socket_send_json(self, client, fake_socket_send):
+    def test_socket_send_json(self, opened_client, fake_socket_send):
         payload = {'foo': 'bar'}
 
-        client.send_json(payload)
+        opened_client.send_json(payload)
+        gevent.sleep(0)
+
+        (_, message), _ = fake_socket_send.call_args
+        assert message.data == b'{"foo": "bar"}'
+
+    def test_socket_send_json_sends_prepared_messages_as_is(self, opened_client, fake_socket_send):
+        message = websocket.JSONMessage({'foo': 'bar'})
 
-        fake_socket_send.assert_called_once_with(client, '{"foo": "bar"}')
+        opened_client.send_json(message)
+        gevent.sleep(0)
+
+        fake_socket_send.assert_called_once_with(opened_client, message)
+
+    def test_socket_send_json_sends_messages_in_order(self, opened_client, fake_socket_send):
+        messages = [websocket.JSONMessage({'n': n}) for n in range(3)]
+
+        for message in messages:
+            opened_client.send_json(message)
+        gevent.sleep(0)
+
+        assert [c[0][1] for c in fake_socket_send.call_args_list] == messages
+
+    def test_socket_send_json_does_not_wait_for_the_send(self, client, fake_socket_send):
+        client.send_json({'foo': 'bar'})
+
+        assert not fake_socket_send.called
+        assert client.outbox_size == 1
 
     def test_socket_send_json_skips_when_terminated(self,
-                                                    client,
+                                                    opened_client,
                                                     fake_socket_send,
                                                     fake_socket_terminated):
         fake_socket_terminated.return_value = True
 
+        opened_client.send_json({'foo': 'bar'})
+        gevent.sleep(0)
+
+        assert not fake_socket_send.called
+
+    def test_socket_send_json_drops_messages_when_outbox_full(self, fake_environ, fake_socket_send):
+        fake_environ['h.ws.outbox_size'] = 1
+        client = websocket.WebSocket(mock.Mock(), environ=fake_environ)
+        websocket.OUTBOX_STATS.clear()
+
+        client.send_json({'n': 1})
+        client.send_json({'n': 2})
+
+        assert client.outbox_size == 1
+        assert websocket.OUTBOX_STATS['dropped'] == 1
+
+    def test_socket_send_json_disconnects_when_outbox_full(self, fake_environ, fake_socket_send):
+        fake_environ['h.ws.outbox_size'] = 1
+        fake_environ['h.ws.slow_client_policy'] = 'disconnect'
+        sock = mock.Mock(spec_set=['sendall', 'shutdown'])
+        client = websocket.WebSocket(sock, environ=fake_environ)
+        websocket.OUTBOX_STATS.clear()
+
+        client.send_json({'n': 1})
+        client.send_json({'n': 2})
+        client.send_json({'n': 3})
+
+        sock.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+        assert websocket.OUTBOX_STATS['disconnected'] == 1
+
+    def test_outbox_lag(self, client, time):
+        time.time.return_value = 100
         client.send_json({'foo': 'bar'})
 
+        time.time.return_value = 102.5
+
+        assert client.outbox_lag == 2.5
+
+    def test_outbox_lag_is_zero_when_outbox_empty(self, client):
+        assert client.outbox_lag == 0
+
+    def test_closed_stops_sending(self, opened_client, fake_socket_send):
+        opened_client.closed(1000)
+
+        opened_client.send_json({'foo': 'bar'})
+        gevent.sleep(0)
+
         assert not fake_socket_send.called
 
+    @pytest.fixture
+    def opened_client(self, client):
+        client.opened()
+        yield client
+        client.closed(1000)
+
+    @pytest.fixture
+    def time(self, patch):
+        return patch('h.streamer.websocket.time')
+
     @pytest.fixture
     def client(self, fake_environ):
         sock = mock.Mock(spec_set=['sendall'])
@@ -291,11 +411,51 @@ class TestHandleFilterMessage(object):
 
         assert socket.filter is not None
 
-    @mock.patch('h.streamer.websocket.storage.expand_uri')
-    def test_expands_uris_in_uri_filter_with_session(self, expand_uri, socket):
-        expand_uri.return_value = ['http://example.com',
-                                   'http://example.com/alter',
-                                   'http://example.com/print']
+    def test_registers_socket_subscription(self, socket, subscriptions):
+        filter_ = {
+            'actions': {},
+            'match_policy': 'include_all',
+            'clauses': [{
+                'field': '/uri',
+                'operator': 'equals',
+                'value': 'http://example.com',
+            }],
+        }
+        message = websocket.Message(socket=socket, payload={'filter': filter_})
+
+        websocket.handle_filter_message(message)
+
+        subscriptions.update.assert_called_once_with(socket, filter_)
+
+    def test_records_history_seq_when_filter_set(self, socket, subscriptions):
+        message = websocket.Message(socket=socket, payload={'filter': {
+            'actions': {},
+            'match_policy': 'include_all',
+            'clauses': [],
+        }})
+
+        with mock.patch('h.streamer.history.RECENT_EVENTS') as recent_events:
+            recent_events.last_seq = 42
+            websocket.handle_filter_message(message)
+
+        assert socket.filter_seq == 42
+
+    def test_does_not_register_invalid_filter(self, socket, subscriptions):
+        message = websocket.Message(socket=socket, payload={
+            'type': 'filter',
+            'filter': {'wibble': 'giraffe'},
+        })
+
+        with mock.patch.object(websocket.Message, 'reply'):
+            websocket.handle_filter_message(message)
+
+        assert not subscriptions.update.called
+
+    @mock.patch('h.streamer.websocket.storage.expand_uris')
+    def test_expands_uris_in_uri_filter_with_session(self, expand_uris, socket):
+        expand_uris.return_value = {'http://example.com': ['http://example.com',
+                                                           'http://example.com/alter',
+                                                           'http://example.com/print']}
         session = mock.sentinel.db_session
         message = websocket.Message(socket=socket, payload={
             'filter': {
@@ -318,9 +478,10 @@ class TestHandleFilterMessage(object):
         assert 'http://example.com/alter' in uri_values
         assert 'http://example.com/print' in uri_values
 
-    @mock.patch('h.streamer.websocket.storage.expand_uri')
-    def test_expands_uris_using_passed_session(self, expand_uri, socket):
-        expand_uri.return_value = ['http://example.com', 'http://example.org/']
+    @mock.patch('h.streamer.websocket.storage.expand_uris')
+    def test_expands_uris_using_passed_session(self, expand_uris, socket):
+        expand_uris.return_value = {'http://example.com': ['http://example.com',
+                                                           'http://example.org/']}
         session = mock.sentinel.db_session
         message = websocket.Message(socket=socket, payload={
             'filter': {
@@ -336,7 +497,7 @@ class TestHandleFilterMessage(object):
 
         websocket.handle_filter_message(message, session=session)
 
-        expand_uri.assert_called_once_with(session, 'http://example.com')
+        expand_uris.assert_called_once_with(session, ['http://example.com'])
 
     def test_missing_filter_error(self, matchers, socket):
         message = websocket.Message(socket=socket, payload={
@@ -369,6 +530,10 @@ class TestHandleFilterMessage(object):
         socket.filter = None
         return socket
 
+    @pytest.fixture
+    def subscriptions(self, patch):
+        return patch('h.streamer.websocket.WebSocket.subscriptions')
+
 
 class TestHandlePingMessage(object):
     def test_pong(self):
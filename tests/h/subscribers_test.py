@@ -84,9 +84,66 @@ class TestPublishAnnotationEvent:
             'src_client_id': 'client_id'
         })
 
+    def test_it_does_not_embed_the_annotation_by_default(self, event, fetch_annotation):
+        subscribers.publish_annotation_event(event)
+
+        assert not fetch_annotation.called
+        payload = event.request.realtime.publish_annotation.call_args[0][0]
+        assert 'annotation' not in payload
+
+    def test_it_embeds_the_presented_annotation_if_enabled(self,
+                                                           event,
+                                                           fetch_annotation,
+                                                           presenters,
+                                                           pyramid_request):
+        pyramid_request.registry.settings['h.realtime.embed_annotations'] = 'true'
+
+        subscribers.publish_annotation_event(event)
+
+        fetch_annotation.assert_called_once_with(pyramid_request.db,
+                                                 'test_annotation_id')
+        payload = event.request.realtime.publish_annotation.call_args[0][0]
+        assert payload['annotation'] == presenters.AnnotationJSONPresenter.return_value.asdict.return_value
+
+    def test_it_does_not_embed_missing_annotations(self, event, fetch_annotation, pyramid_request):
+        pyramid_request.registry.settings['h.realtime.embed_annotations'] = 'true'
+        fetch_annotation.return_value = None
+
+        subscribers.publish_annotation_event(event)
+
+        payload = event.request.realtime.publish_annotation.call_args[0][0]
+        assert 'annotation' not in payload
+
+    def test_it_routes_by_group_and_uri_if_topic_exchange_enabled(self,
+                                                                  event,
+                                                                  fetch_annotation,
+                                                                  pyramid_request):
+        pyramid_request.registry.settings['h.realtime.topic_exchange'] = 'true'
+        annotation = fetch_annotation.return_value
+
+        subscribers.publish_annotation_event(event)
+
+        event.request.realtime.publish_annotation.assert_called_once_with(
+            mock.ANY,
+            groupid=annotation.groupid,
+            uri=annotation.target_uri)
+        payload = event.request.realtime.publish_annotation.call_args[0][0]
+        assert 'annotation' not in payload
+
     @pytest.fixture
-    def event(self, pyramid_request):
+    def fetch_annotation(self, patch):
+        return patch('h.subscribers.storage.fetch_annotation')
+
+    @pytest.fixture
+    def presenters(self, patch):
+        return patch('h.subscribers.presenters')
+
+    @pytest.fixture
+    def event(self, pyramid_request, pyramid_config):
+        pyramid_config.register_service(mock.Mock(), iface='h.interfaces.IGroupService')
+        pyramid_config.register_service(mock.Mock(), name='links')
         pyramid_request.realtime = mock.Mock()
+        pyramid_request.tm = mock.MagicMock()
         event = AnnotationEvent(pyramid_request,
                                 'test_annotation_id',
                                 'create')
@@ -3,16 +3,20 @@
 from __future__ import unicode_literals
 
 from datetime import (datetime, timedelta)
+import uuid
 
 import pytest
 
-from h.models import Annotation, AuthTicket, Token
+from h.db.types import _get_urlsafe_from_hex
+from h.models import Annotation, AuthTicket, ScheduledThreadRoot, Token
 from h.tasks.cleanup import (
     purge_deleted_annotations,
     purge_expired_auth_tickets,
     purge_expired_tokens,
     purge_removed_features,
+    purge_scheduled_thread_roots,
 )
+from h.tasks.indexer import THREAD_ROOT_DELAY
 
 
 @pytest.mark.usefixtures('celery')
@@ -99,6 +103,29 @@ class TestPurgeExpiredTokens(object):
         assert db_session.query(Token).count() == 2
 
 
+@pytest.mark.usefixtures('celery')
+class TestPurgeScheduledThreadRoots(object):
+    def test_it_removes_thread_roots_scheduled_before_the_delay(self, db_session):
+        now = datetime.utcnow()
+        for seconds_ago in (THREAD_ROOT_DELAY + 1, 3600):
+            db_session.add(ScheduledThreadRoot(annotation_id=_get_urlsafe_from_hex(uuid.uuid4().hex),
+                                               scheduled=now - timedelta(seconds=seconds_ago)))
+        db_session.flush()
+
+        purge_scheduled_thread_roots()
+
+        assert db_session.query(ScheduledThreadRoot).count() == 0
+
+    def test_it_leaves_recently_scheduled_thread_roots(self, db_session):
+        db_session.add(ScheduledThreadRoot(annotation_id=_get_urlsafe_from_hex(uuid.uuid4().hex),
+                                           scheduled=datetime.utcnow()))
+        db_session.flush()
+
+        purge_scheduled_thread_roots()
+
+        assert db_session.query(ScheduledThreadRoot).count() == 1
+
+
 @pytest.mark.usefixtures('celery')
 class TestPurgeRemovedFeatures(object):
     def test_calls_remove_old_flags(self, db_session, patch):
@@ -18,7 +18,8 @@ class FakeSettingsService(object):
         self._data[key] = value
 
 
-@pytest.mark.usefixtures('celery', 'index', 'settings_service')
+@pytest.mark.usefixtures('celery', 'index', 'settings_service',
+                         'scheduled_thread_roots', 'claim_thread_root')
 class TestAddAnnotation(object):
 
     def test_it_fetches_the_annotation(self, fetch_annotation, annotation, celery):
@@ -65,34 +66,88 @@ class TestAddAnnotation(object):
                               celery.request,
                               target_index='hypothesis-abcdef123')
 
-    def test_it_indexes_thread_root(self, fetch_annotation, reply, delay):
+    def test_it_schedules_thread_root_to_be_reindexed(self, fetch_annotation, reply, apply_async):
         fetch_annotation.return_value = reply
 
         indexer.add_annotation('test-annotation-id')
 
-        delay.assert_called_once_with('root-id')
+        apply_async.assert_called_once_with(('root-id',),
+                                            countdown=indexer.THREAD_ROOT_DELAY)
 
-    @pytest.fixture
-    def index(self, patch):
-        return patch('h.tasks.indexer.index')
+    def test_it_schedules_thread_root_once_for_many_replies(self,
+                                                            fetch_annotation,
+                                                            reply,
+                                                            apply_async,
+                                                            celery):
+        fetch_annotation.return_value = reply
 
-    @pytest.fixture
-    def fetch_annotation(self, patch):
-        return patch('h.tasks.indexer.storage.fetch_annotation')
+        for _ in range(3):
+            indexer.add_annotation('test-annotation-id')
+
+        assert apply_async.call_count == 1
+        assert celery.request.stats.incr.call_args_list == [
+            mock.call('indexer.thread_root.scheduled'),
+            mock.call('indexer.thread_root.skipped'),
+            mock.call('indexer.thread_root.skipped'),
+        ]
+
+    def test_it_schedules_thread_root_again_after_delay(self,
+                                                        fetch_annotation,
+                                                        reply,
+                                                        apply_async,
+                                                        scheduled_thread_roots):
+        fetch_annotation.return_value = reply
+        indexer.add_annotation('test-annotation-id')
+
+        scheduled_thread_roots._clock.return_value += indexer.THREAD_ROOT_DELAY
+        indexer.add_annotation('test-annotation-id')
+
+        assert apply_async.call_count == 2
+
+    def test_it_claims_thread_root_for_all_processes(self,
+                                                     fetch_annotation,
+                                                     reply,
+                                                     apply_async,
+                                                     celery,
+                                                     claim_thread_root):
+        fetch_annotation.return_value = reply
+
+        indexer.add_annotation('test-annotation-id')
+
+        claim_thread_root.assert_called_once_with(celery.request.db.bind,
+                                                  'root-id',
+                                                  indexer.THREAD_ROOT_DELAY)
+
+    def test_it_skips_thread_root_scheduled_by_another_process(self,
+                                                               fetch_annotation,
+                                                               reply,
+                                                               apply_async,
+                                                               celery,
+                                                               claim_thread_root):
+        fetch_annotation.return_value = reply
+        claim_thread_root.return_value = False
+
+        indexer.add_annotation('test-annotation-id')
+
+        assert not apply_async.called
+        celery.request.stats.incr.assert_called_once_with('indexer.thread_root.skipped')
 
     @pytest.fixture
-    def annotation(self):
-        return mock.Mock(spec_set=['is_reply'], is_reply=False)
+    def index(self, patch):
+        return patch('h.tasks.indexer.index')
 
     @pytest.fixture
     def reply(self):
-        return mock.Mock(spec_set=['is_reply', 'thread_root_id'],
+        return mock.Mock(spec_set=['is_reply', 'thread_root_id', 'target_uri',
+                                   'target_uri_normalized'],
                          is_reply=True,
-                         thread_root_id='root-id')
+                         thread_root_id='root-id',
+                         target_uri='http://example.com/',
+                         target_uri_normalized='httpx://example.com')
 
     @pytest.fixture
-    def delay(self, patch):
-        return patch('h.tasks.indexer.add_annotation.delay')
+    def apply_async(self, patch):
+        return patch('h.tasks.indexer.add_annotation.apply_async')
 
 
 @pytest.mark.usefixtures('celery', 'delete', 'settings_service')
@@ -126,6 +181,136 @@ class TestDeleteAnnotation(object):
         return patch('h.tasks.indexer.delete')
 
 
+@pytest.mark.usefixtures('celery', 'settings_service', 'nipsa_service', 'tm',
+                         'scheduled_thread_roots', 'claim_thread_root')
+class TestSyncAnnotation(object):
+
+    def test_it_fetches_the_annotations_in_one_query(self, fetch_annotations, celery):
+        indexer.sync_annotation([_request('id-1', 'create'),
+                                 _request('id-2', 'update'),
+                                 _request('id-1', 'update')])
+
+        fetch_annotations.assert_called_once_with(celery.request.db, ['id-1', 'id-2'])
+
+    def test_it_syncs_the_batch_in_one_bulk_request(self,
+                                                    fetch_annotations,
+                                                    batch_indexer,
+                                                    celery):
+        ann_1, ann_2 = _annotation('id-1'), _annotation('id-2')
+        fetch_annotations.return_value = [ann_1, ann_2]
+
+        indexer.sync_annotation([_request('id-1', 'create'), _request('id-2', 'update')])
+
+        batch_indexer.assert_called_once_with(celery.request.db,
+                                              celery.request.es,
+                                              celery.request,
+                                              target_index=None,
+                                              chunk_size=2)
+        batch_indexer.return_value.sync.assert_called_once_with([ann_1, ann_2], [])
+
+    def test_it_marks_deleted_annotations_as_deleted(self, fetch_annotations, batch_indexer):
+        fetch_annotations.return_value = [_annotation('id-1', deleted=True)]
+
+        indexer.sync_annotation([_request('id-1', 'delete'),
+                                 _request('id-2', 'delete'),
+                                 _request('id-3', 'create')])
+
+        batch_indexer.return_value.sync.assert_called_once_with([], ['id-1', 'id-2'])
+
+    def test_during_reindex_syncs_to_new_index(self,
+                                               fetch_annotations,
+                                               batch_indexer,
+                                               settings_service):
+        settings_service.put(SETTING_NEW_INDEX, 'hypothesis-abcdef123')
+
+        indexer.sync_annotation([_request('id-1', 'create')])
+
+        target_indexes = [kwargs['target_index'] for _, kwargs in batch_indexer.call_args_list]
+        assert target_indexes == [None, 'hypothesis-abcdef123']
+
+    def test_it_schedules_thread_roots_which_are_not_in_the_batch(self,
+                                                                  fetch_annotations,
+                                                                  batch_indexer,
+                                                                  apply_async):
+        fetch_annotations.return_value = [_annotation('id-1', thread_root_id='root-1'),
+                                          _annotation('id-2', thread_root_id='id-3'),
+                                          _annotation('id-3')]
+
+        indexer.sync_annotation([_request('id-1', 'create'),
+                                 _request('id-2', 'create'),
+                                 _request('id-3', 'update')])
+
+        apply_async.assert_called_once_with(('root-1',),
+                                            countdown=indexer.THREAD_ROOT_DELAY)
+
+    def test_it_requeues_errored_annotations(self, fetch_annotations, batch_indexer, delay):
+        batch_indexer.return_value.sync.return_value = set(['id-1', 'id-2'])
+
+        indexer.sync_annotation([_request('id-1', 'create'),
+                                 _request('id-2', 'delete', retries=2)])
+
+        assert sorted(delay.call_args_list) == [mock.call('id-1', 'update', retries=1),
+                                                mock.call('id-2', 'delete', retries=3)]
+
+    def test_it_gives_up_on_annotations_after_max_retries(self,
+                                                          fetch_annotations,
+                                                          batch_indexer,
+                                                          delay):
+        batch_indexer.return_value.sync.return_value = set(['id-1'])
+
+        indexer.sync_annotation([_request('id-1', 'create',
+                                          retries=indexer.BATCH_MAX_RETRIES)])
+
+        assert not delay.called
+
+    def test_it_requeues_the_batch_if_syncing_fails(self, fetch_annotations, delay):
+        fetch_annotations.side_effect = RuntimeError('database error')
+
+        with pytest.raises(RuntimeError):
+            indexer.sync_annotation([_request('id-1', 'create'),
+                                     _request('id-2', 'delete')])
+
+        assert delay.call_args_list == [mock.call('id-1', 'update', retries=1),
+                                        mock.call('id-2', 'delete', retries=1)]
+
+    def test_it_resets_the_request(self, fetch_annotations, batch_indexer, nipsa_service, tm):
+        indexer.sync_annotation([_request('id-1', 'create')])
+
+        nipsa_service.clear.assert_called_once_with()
+        tm.abort.assert_called_once_with()
+
+    @pytest.fixture
+    def fetch_annotations(self, patch):
+        fetch_annotations = patch('h.tasks.indexer.fetch_annotations')
+        fetch_annotations.return_value = []
+        return fetch_annotations
+
+    @pytest.fixture
+    def batch_indexer(self, patch):
+        batch_indexer = patch('h.tasks.indexer.BatchIndexer')
+        batch_indexer.return_value.sync.return_value = set()
+        return batch_indexer
+
+    @pytest.fixture
+    def delay(self, patch):
+        return patch('h.tasks.indexer.sync_annotation.delay')
+
+    @pytest.fixture
+    def apply_async(self, patch):
+        return patch('h.tasks.indexer.add_annotation.apply_async')
+
+    @pytest.fixture
+    def tm(self, celery):
+        celery.request.tm = mock.Mock(spec_set=['abort'])
+        return celery.request.tm
+
+    @pytest.fixture
+    def nipsa_service(self, pyramid_config):
+        service = mock.Mock(spec_set=['clear'])
+        pyramid_config.register_service(service, name='nipsa')
+        return service
+
+
 @pytest.mark.usefixtures('celery')
 class TestReindexUserAnnotations(object):
     def test_it_reindexes_users_annotations(self, batch_indexer, annotation_ids):
@@ -153,6 +338,52 @@ class TestReindexUserAnnotations(object):
         }
 
 
+def _request(id_, action, **kwargs):
+    return mock.Mock(spec_set=['args', 'kwargs'], args=(id_, action), kwargs=kwargs)
+
+
+def _annotation(id_, deleted=False, thread_root_id=None):
+    return mock.Mock(spec_set=['id', 'deleted', 'is_reply', 'thread_root_id',
+                               'target_uri', 'target_uri_normalized'],
+                     id=id_,
+                     deleted=deleted,
+                     is_reply=thread_root_id is not None,
+                     thread_root_id=thread_root_id,
+                     target_uri='http://example.com/',
+                     target_uri_normalized='httpx://example.com')
+
+
+@pytest.fixture
+def fetch_annotation(patch):
+    fetch_annotation = patch('h.tasks.indexer.storage.fetch_annotation')
+    fetch_annotation.return_value = None
+    return fetch_annotation
+
+
+@pytest.fixture
+def annotation():
+    return mock.Mock(spec_set=['is_reply', 'target_uri', 'target_uri_normalized'],
+                     is_reply=False,
+                     target_uri='http://example.com/',
+                     target_uri_normalized='httpx://example.com')
+
+
+@pytest.fixture
+def claim_thread_root(patch):
+    claim = patch('h.tasks.indexer.models.ScheduledThreadRoot.claim')
+    claim.return_value = True
+    return claim
+
+
+@pytest.fixture
+def scheduled_thread_roots(monkeypatch):
+    scheduled_thread_roots = indexer.ExpiringLRUCache(maxsize=100,
+                                                      ttl=indexer.THREAD_ROOT_DELAY,
+                                                      clock=mock.Mock(return_value=1000))
+    monkeypatch.setattr(indexer, 'SCHEDULED_THREAD_ROOTS', scheduled_thread_roots)
+    return scheduled_thread_roots
+
+
 @pytest.fixture
 def celery(patch, pyramid_request):
     cel = patch('h.tasks.indexer.celery')
@@ -163,6 +394,7 @@ def celery(patch, pyramid_request):
 @pytest.fixture
 def pyramid_request(pyramid_request):
     pyramid_request.es = mock.Mock()
+    pyramid_request.stats = mock.Mock(spec_set=['incr'])
     return pyramid_request
 
 
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import pytest
+
+from h.util.cache import ExpiringLRUCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestExpiringLRUCache(object):
+    def test_get_returns_default_for_missing_keys(self, cache):
+        assert cache.get('foo') is None
+        assert cache.get('foo', 'default') == 'default'
+
+    def test_get_returns_cached_values(self, cache):
+        cache.set('foo', 'bar')
+
+        assert cache.get('foo') == 'bar'
+
+    def test_set_replaces_cached_values(self, cache):
+        cache.set('foo', 'bar')
+        cache.set('foo', 'baz')
+
+        assert cache.get('foo') == 'baz'
+        assert len(cache) == 1
+
+    def test_entries_expire_after_ttl(self, cache, clock):
+        cache.set('foo', 'bar')
+
+        clock.now += 59
+        assert cache.get('foo') == 'bar'
+
+        clock.now += 1
+        assert cache.get('foo') is None
+
+    def test_evicts_least_recently_used_entries(self, clock):
+        cache = ExpiringLRUCache(maxsize=2, ttl=60, clock=clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+
+        cache.set('c', 3)
+
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+
+    def test_evicts_least_recently_used_entries_over_maxbytes(self, clock):
+        cache = ExpiringLRUCache(maxsize=10, ttl=60, clock=clock, maxbytes=100)
+        cache.set('a', 1, size=40)
+        cache.set('b', 2, size=40)
+        cache.get('a')
+
+        cache.set('c', 3, size=40)
+
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+
+    def test_counts_the_size_of_replaced_entries_once(self, clock):
+        cache = ExpiringLRUCache(maxsize=10, ttl=60, clock=clock, maxbytes=100)
+        cache.set('a', 1, size=40)
+        cache.set('b', 2, size=40)
+
+        cache.set('a', 3, size=40)
+
+        assert cache.get('a') == 3
+        assert cache.get('b') == 2
+
+    def test_frees_the_size_of_removed_entries(self, clock):
+        cache = ExpiringLRUCache(maxsize=10, ttl=60, clock=clock, maxbytes=100)
+        cache.set('a', 1, size=60)
+        cache.invalidate(['a'])
+        cache.set('b', 2, size=60)
+        clock.now += 60
+        cache.get('b')
+
+        cache.set('c', 3, size=100)
+
+        assert cache.get('c') == 3
+
+    def test_does_not_cache_values_larger_than_maxbytes(self, clock):
+        cache = ExpiringLRUCache(maxsize=10, ttl=60, clock=clock, maxbytes=100)
+        cache.set('a', 1, size=40)
+
+        cache.set('b', 2, size=101)
+
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+
+    def test_does_not_cache_if_maxsize_is_zero(self, clock):
+        cache = ExpiringLRUCache(maxsize=0, ttl=60, clock=clock)
+
+        cache.set('foo', 'bar')
+
+        assert cache.get('foo') is None
+
+    def test_invalidate(self, cache):
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        cache.invalidate(['a', 'unknown'])
+
+        assert cache.get('a') is None
+        assert cache.get('b') == 2
+
+    def test_clear(self, cache):
+        cache.set('a', 1)
+
+        cache.clear()
+
+        assert len(cache) == 0
+
+    def test_counts_hits_and_misses(self, cache, clock):
+        cache.set('a', 1)
+
+        cache.get('a')
+        cache.get('b')
+        clock.now += 60
+        cache.get('a')
+
+        assert cache.hits == 1
+        assert cache.misses == 2
+
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    @pytest.fixture
+    def cache(self, clock):
+        return ExpiringLRUCache(maxsize=10, ttl=60, clock=clock)
@@ -4,7 +4,7 @@ from __future__ import unicode_literals
 
 import datetime
 
-from h.util.datetime import utc_iso8601
+from h.util.datetime import parse_utc_iso8601, utc_iso8601
 
 
 class Berlin(datetime.tzinfo):
@@ -28,3 +28,13 @@ def test_utc_iso8601():
 def test_utc_iso8601_ignores_timezone():
     t = datetime.datetime(2016, 2, 24, 18, 3, 25, 7685, Berlin())
     assert utc_iso8601(t) == '2016-02-24T18:03:25.007685+00:00'
+
+
+def test_parse_utc_iso8601():
+    t = parse_utc_iso8601('2016-02-24T18:03:25.007685+00:00')
+    assert t == datetime.datetime(2016, 2, 24, 18, 3, 25, 7685)
+
+
+def test_parse_utc_iso8601_reverses_utc_iso8601():
+    t = datetime.datetime(2016, 2, 24, 18, 3, 25, 0)
+    assert parse_utc_iso8601(utc_iso8601(t)) == t
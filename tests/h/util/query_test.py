@@ -8,7 +8,7 @@ import pytest
 
 import sqlalchemy as sa
 
-from h.util.query import column_windows
+from h.util.query import keyset_windows
 
 
 meta = sa.MetaData()
@@ -23,7 +23,7 @@ test_cw = sa.Table(
 
 
 @pytest.mark.usefixtures('cw_table')
-class TestColumnWindows(object):
+class TestKeysetWindows(object):
 
     @pytest.mark.parametrize('windowsize,expected', [
         (100, ['abcdefghijklmnopqrstuvwxyz']),
@@ -39,8 +39,8 @@ class TestColumnWindows(object):
                     for l in string.lowercase]
         db_session.execute(test_cw.insert().values(testdata))
 
-        windows = column_windows(db_session,
-                                 test_cw.c.name,
+        windows = keyset_windows(db_session,
+                                 [test_cw.c.name, test_cw.c.id],
                                  windowsize=windowsize)
 
         assert window_query_results(db_session, windows) == expected
@@ -62,13 +62,42 @@ class TestColumnWindows(object):
         db_session.execute(test_cw.insert().values(testdata))
 
         filter_ = test_cw.c.enabled
-        windows = column_windows(db_session,
-                                 test_cw.c.name,
+        windows = keyset_windows(db_session,
+                                 [test_cw.c.name, test_cw.c.id],
                                  windowsize=windowsize,
                                  where=filter_)
 
         assert window_query_results(db_session, windows, filter_) == expected
 
+    def test_windowing_splits_rows_with_the_same_value(self, db_session):
+        """Check that rows with equal values are split by the other columns."""
+        testdata = [{'name': l, 'enabled': True} for l in 'aaaaabbbbb']
+        db_session.execute(test_cw.insert().values(testdata))
+
+        windows = keyset_windows(db_session,
+                                 [test_cw.c.name, test_cw.c.id],
+                                 windowsize=3)
+
+        assert window_query_results(db_session, windows) == ['aaa', 'aab', 'bbb', 'b']
+
+    def test_windowing_is_lazy(self, db_session):
+        """Check that rows added after the latest window are included."""
+        db_session.execute(test_cw.insert().values([{'name': l, 'enabled': True}
+                                                    for l in 'abcd']))
+
+        windows = keyset_windows(db_session,
+                                 [test_cw.c.name, test_cw.c.id],
+                                 windowsize=2)
+        first = next(windows)
+        db_session.execute(test_cw.insert().values([{'name': 'e', 'enabled': True}]))
+
+        assert window_query_results(db_session, [first] + list(windows)) == ['ab', 'cd', 'e']
+
+    def test_no_windows_without_rows(self, db_session):
+        windows = keyset_windows(db_session, [test_cw.c.name, test_cw.c.id])
+
+        assert list(windows) == []
+
 
 def window_query_results(session, windows, filter_=None):
     """
@@ -79,7 +108,9 @@ def window_query_results(session, windows, filter_=None):
     """
     results = []
     for window in windows:
-        part = session.query(test_cw.c.name).filter(window)
+        part = (session.query(test_cw.c.name)
+                .filter(window)
+                .order_by(test_cw.c.name, test_cw.c.id))
         if filter_ is not None:
             part = part.filter(filter_)
         results.append(''.join(row.name for row in part))
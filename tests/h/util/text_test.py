@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import pytest
+
+from h.util.text import uni_fold
+
+
+class TestUniFold(object):
+    @pytest.mark.parametrize('text,expected', [
+        ('Foo', 'foo'),
+        ('Ünïcödé', 'unicode'),
+        ('Ünïcödé'.encode('utf-8'), 'unicode'),
+    ])
+    def test_it_folds_case_and_accents(self, text, expected):
+        assert uni_fold(text) == expected
+
+    @pytest.mark.parametrize('value', [None, 42, ['Foo']])
+    def test_it_returns_other_values_unchanged(self, value):
+        assert uni_fold(value) == value
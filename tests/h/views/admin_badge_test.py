@@ -2,6 +2,7 @@
 
 import mock
 import pytest
+import transaction
 from pyramid import httpexceptions
 
 from h import models
@@ -20,7 +21,7 @@ class TestBadgeIndex(object):
         assert set(result["uris"]) == set(blocked_uris)
 
 
-@pytest.mark.usefixtures('blocked_uris', 'routes')
+@pytest.mark.usefixtures('blocked_uris', 'routes', 'tm')
 class TestBadgeAddRemove(object):
     def test_add_blocks_uri(self, pyramid_request):
         pyramid_request.params = {'add': 'test_uri'}
@@ -76,6 +77,51 @@ class TestBadgeAddRemove(object):
         assert isinstance(result, httpexceptions.HTTPSeeOther)
         assert result.location == '/adm/badge'
 
+    def test_add_invalidates_compiled_blocklist_after_commit(self,
+                                                             pyramid_request,
+                                                             tm,
+                                                             compiled_blocklist):
+        pyramid_request.params = {'add': 'test_uri'}
+
+        badge_add(pyramid_request)
+
+        assert not compiled_blocklist.invalidate.called
+        tm.commit()
+        compiled_blocklist.invalidate.assert_called_once_with()
+
+    def test_remove_invalidates_compiled_blocklist_after_commit(self,
+                                                                pyramid_request,
+                                                                tm,
+                                                                compiled_blocklist):
+        pyramid_request.params = {'remove': 'blocked1'}
+
+        badge_remove(pyramid_request)
+
+        assert not compiled_blocklist.invalidate.called
+        tm.commit()
+        compiled_blocklist.invalidate.assert_called_once_with()
+
+    def test_does_not_invalidate_compiled_blocklist_if_aborted(self,
+                                                               pyramid_request,
+                                                               tm,
+                                                               compiled_blocklist):
+        pyramid_request.params = {'remove': 'blocked1'}
+
+        badge_remove(pyramid_request)
+
+        tm.abort()
+        assert not compiled_blocklist.invalidate.called
+
+    @pytest.fixture
+    def compiled_blocklist(self, patch):
+        return patch('h.views.admin_badge.blocklist.COMPILED_BLOCKLIST')
+
+    @pytest.fixture
+    def tm(self, pyramid_request):
+        pyramid_request.tm = transaction.TransactionManager()
+        pyramid_request.tm.begin()
+        return pyramid_request.tm
+
 
 @pytest.fixture
 def blocked_uris(db_session):
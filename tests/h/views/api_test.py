@@ -161,15 +161,35 @@ class TestSearch(object):
         search = search_lib.Search.return_value
         search_lib.Search.assert_called_with(pyramid_request,
                                              separate_replies=False,
-                                             stats=pyramid_request.stats)
+                                             stats=pyramid_request.stats,
+                                             all_replies=False,
+                                             use_cache=True,
+                                             include_sources=False)
         search.run.assert_called_once_with(pyramid_request.params)
 
+    def test_it_includes_sources_when_presenting_from_source(self, pyramid_request, search_lib):
+        pyramid_request.registry.settings['h.search.present_from_source'] = 'true'
+
+        views.search(pyramid_request)
+
+        assert search_lib.Search.call_args[1]['include_sources'] is True
+
     def test_it_presents_search_results(self, pyramid_request, search_run, presentation_service):
         search_run.return_value = SearchResult(2, ['row-1', 'row-2'], [], {})
 
         views.search(pyramid_request)
 
-        presentation_service.present_all.assert_called_once_with(['row-1', 'row-2'])
+        presentation_service.present_all.assert_called_once_with(['row-1', 'row-2'],
+                                                                 sources=None)
+
+    def test_it_presents_search_results_from_sources(self, pyramid_request, search_run,
+                                                     presentation_service):
+        sources = {'row-1': {'text': 'foo'}}
+        search_run.return_value = SearchResult(1, ['row-1'], [], {}, None, sources)
+
+        views.search(pyramid_request)
+
+        presentation_service.present_all.assert_called_once_with(['row-1'], sources=sources)
 
     def test_it_returns_search_results(self, pyramid_request, search_run, presentation_service):
         search_run.return_value = SearchResult(2, ['row-1', 'row-2'], [], {})
@@ -181,13 +201,21 @@ class TestSearch(object):
 
         assert views.search(pyramid_request) == expected
 
+    def test_it_returns_cursor_for_next_page(self, pyramid_request, search_run, presentation_service):
+        search_run.return_value = SearchResult(2, ['row-1', 'row-2'], [], {}, 'the-cursor')
+
+        result = views.search(pyramid_request)
+
+        assert result['cursor'] == 'the-cursor'
+
     def test_it_presents_replies(self, pyramid_request, search_run, presentation_service):
         pyramid_request.params = {'_separate_replies': '1'}
         search_run.return_value = SearchResult(1, ['row-1'], ['reply-1', 'reply-2'], {})
 
         views.search(pyramid_request)
 
-        presentation_service.present_all.assert_called_with(['reply-1', 'reply-2'])
+        presentation_service.present_all.assert_called_with(['reply-1', 'reply-2'],
+                                                            sources=None)
 
     def test_it_returns_replies(self, pyramid_request, search_run, presentation_service):
         pyramid_request.params = {'_separate_replies': '1'}
@@ -201,6 +229,108 @@ class TestSearch(object):
 
         assert views.search(pyramid_request) == expected
 
+    def test_it_searches_all_replies_when_asked(self, pyramid_request, search_lib, presentation_service):
+        pyramid_request.params = {'_separate_replies': '1', '_all_replies': '1'}
+        search_lib.Search.return_value.run.return_value = SearchResult(0, [], [], {})
+        presentation_service.present_all.return_value = []
+        presentation_service.present_all_in_chunks.return_value = iter([])
+
+        views.search(pyramid_request)
+
+        assert search_lib.Search.call_args[1]['all_replies'] == '1'
+        search_lib.Search.return_value.run.assert_called_once_with({})
+
+    def test_it_returns_all_replies_in_chunks(self, pyramid_request, search_run, presentation_service):
+        pyramid_request.params = {'_separate_replies': '1', '_all_replies': '1'}
+        search_run.return_value = SearchResult(1, ['row-1'], ['reply-1', 'reply-2', 'reply-3'], {})
+        presentation_service.present_all.return_value = [{'id': 'row-1'}]
+        presentation_service.present_all_in_chunks.return_value = iter([
+            [{'id': 'reply-1'}, {'id': 'reply-2'}],
+            [{'id': 'reply-3'}],
+        ])
+
+        response = views.search(pyramid_request)
+
+        presentation_service.present_all_in_chunks.assert_called_once_with(
+            ['reply-1', 'reply-2', 'reply-3'])
+        assert response.content_type == 'application/json'
+        assert response.json_body == {
+            'total': 1,
+            'rows': [{'id': 'row-1'}],
+            'replies': [{'id': 'reply-1'}, {'id': 'reply-2'}, {'id': 'reply-3'}],
+        }
+
+    def test_it_returns_all_replies_when_there_are_none(self, pyramid_request, search_run, presentation_service):
+        pyramid_request.params = {'_separate_replies': '1', '_all_replies': '1'}
+        search_run.return_value = SearchResult(1, ['row-1'], [], {})
+        presentation_service.present_all.return_value = []
+        presentation_service.present_all_in_chunks.return_value = iter([])
+
+        response = views.search(pyramid_request)
+
+        assert response.json_body == {'total': 1, 'rows': [], 'replies': []}
+
+    def test_it_presents_all_replies_as_the_response_is_sent(self, pyramid_request, search_run, presentation_service):
+        pyramid_request.params = {'_separate_replies': '1', '_all_replies': '1'}
+        search_run.return_value = SearchResult(1, ['row-1'], ['reply-1', 'reply-2'], {})
+        presentation_service.present_all.return_value = []
+        presented = []
+
+        def present_all_in_chunks(reply_ids):
+            for id_ in reply_ids:
+                presented.append(id_)
+                yield [{'id': id_}]
+        presentation_service.present_all_in_chunks.side_effect = present_all_in_chunks
+
+        response = views.search(pyramid_request)
+        assert presented == []
+
+        body = iter(response.app_iter)
+        next(body)
+        next(body)
+        assert presented == ['reply-1']
+
+    def test_it_skips_empty_chunks_of_replies(self, pyramid_request, search_run, presentation_service):
+        pyramid_request.params = {'_separate_replies': '1', '_all_replies': '1'}
+        search_run.return_value = SearchResult(1, ['row-1'], ['reply-1', 'reply-2'], {})
+        presentation_service.present_all.return_value = []
+        presentation_service.present_all_in_chunks.return_value = iter([
+            [{'id': 'reply-1'}], [], [{'id': 'reply-2'}], [],
+        ])
+
+        response = views.search(pyramid_request)
+
+        assert response.json_body['replies'] == [{'id': 'reply-1'}, {'id': 'reply-2'}]
+
+    def test_it_ends_the_transaction_once_all_replies_are_sent(self, pyramid_request, search_run, presentation_service):
+        pyramid_request.params = {'_separate_replies': '1', '_all_replies': '1'}
+        search_run.return_value = SearchResult(1, ['row-1'], ['reply-1'], {})
+        presentation_service.present_all.return_value = []
+        presentation_service.present_all_in_chunks.return_value = iter([[{'id': 'reply-1'}]])
+
+        response = views.search(pyramid_request)
+        assert not pyramid_request.tm.abort.called
+        response.body
+
+        pyramid_request.tm.abort.assert_called_once_with()
+
+    def test_it_ends_the_transaction_if_sending_replies_is_cut_short(self, pyramid_request, search_run, presentation_service):
+        pyramid_request.params = {'_separate_replies': '1', '_all_replies': '1'}
+        search_run.return_value = SearchResult(1, ['row-1'], ['reply-1'], {})
+        presentation_service.present_all.return_value = []
+        presentation_service.present_all_in_chunks.return_value = iter([[{'id': 'reply-1'}]])
+
+        response = views.search(pyramid_request)
+        next(response.app_iter)
+        response.app_iter.close()
+
+        pyramid_request.tm.abort.assert_called_once_with()
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.tm = mock.Mock(spec_set=['abort'])
+        return pyramid_request
+
     @pytest.fixture
     def search_lib(self, patch):
         return patch('h.views.api.search_lib')
@@ -561,7 +691,7 @@ def links_service(pyramid_config):
 
 @pytest.fixture
 def presentation_service(pyramid_config):
-    svc = mock.Mock(spec_set=['present', 'present_all'])
+    svc = mock.Mock(spec_set=['present', 'present_all', 'present_all_in_chunks'])
     pyramid_config.register_service(svc, name='annotation_json_presentation')
     return svc
 
@@ -6,34 +6,36 @@ import pytest
 import mock
 
 from pyramid import httpexceptions
+from webob.multidict import MultiDict
 
-from h.views.badge import badge
+from h.views import badge as views
+from h.views.badge import badge, badges
 
 
-badge_fixtures = pytest.mark.usefixtures('models', 'search_lib')
+badge_fixtures = pytest.mark.usefixtures('models', 'search_lib', 'storage')
 
 
 @badge_fixtures
-def test_badge_returns_number_from_search(models, search_run):
-    request = mock.Mock(params={'uri': 'test_uri'})
+def test_badge_returns_number_from_search(models, search_count):
+    request = mock.Mock(authenticated_userid=None, params={'uri': 'test_uri'})
     models.Blocklist.is_blocked.return_value = False
-    search_run.return_value = mock.Mock(total=29)
+    search_count.return_value = [29]
 
     result = badge(request)
 
-    search_run.assert_called_once_with({'uri': 'test_uri', 'limit': 0})
+    search_count.assert_called_once_with([{'uri': 'test_uri'}])
     assert result == {'total': 29}
 
 
 @badge_fixtures
-def test_badge_returns_0_if_blocked(models, search_run):
-    request = mock.Mock(params={'uri': 'test_uri'})
+def test_badge_returns_0_if_blocked(models, search_count):
+    request = mock.Mock(authenticated_userid=None, params={'uri': 'test_uri'})
     models.Blocklist.is_blocked.return_value = True
-    search_run.return_value = {'total': 29}
+    search_count.return_value = [29]
 
     result = badge(request)
 
-    assert not search_run.called
+    assert not search_count.called
     assert result == {'total': 0}
 
 
@@ -43,6 +45,108 @@ def test_badge_raises_if_no_uri():
         badge(mock.Mock(params={}))
 
 
+@badge_fixtures
+def test_badge_caches_counts(models, search_count):
+    request = mock.Mock(authenticated_userid=None, params={'uri': 'test_uri'})
+    models.Blocklist.is_blocked.return_value = False
+    search_count.return_value = [29]
+
+    badge(request)
+    result = badge(request)
+
+    assert search_count.call_count == 1
+    assert result == {'total': 29}
+    assert request.stats.incr.call_args_list == [mock.call('badge.cache.miss'),
+                                                 mock.call('badge.cache.hit')]
+
+
+@badge_fixtures
+def test_badge_caches_counts_by_expanded_uris(models, search_count, storage):
+    storage.expand_uri.side_effect = lambda _, uri, stats: ['http://example.com/',
+                                                            'http://example.org/']
+    models.Blocklist.is_blocked.return_value = False
+    search_count.return_value = [29]
+
+    badge(mock.Mock(authenticated_userid=None, params={'uri': 'http://example.com/'}))
+    result = badge(mock.Mock(authenticated_userid=None, params={'uri': 'http://example.org/'}))
+
+    assert search_count.call_count == 1
+    assert result == {'total': 29}
+
+
+@badge_fixtures
+def test_badge_caches_counts_per_user(models, search_count):
+    models.Blocklist.is_blocked.return_value = False
+    search_count.return_value = [29]
+
+    badge(mock.Mock(params={'uri': 'test_uri'}, authenticated_userid=None))
+    badge(mock.Mock(params={'uri': 'test_uri'}, authenticated_userid='acct:luke@example.com'))
+
+    assert search_count.call_count == 2
+
+
+@badge_fixtures
+def test_badges_counts_all_the_uris_in_one_search(models, search_count):
+    request = mock.Mock(authenticated_userid=None,
+                        params=MultiDict([('uri', 'http://a.com/'),
+                                          ('uri', 'http://b.com/')]))
+    models.Blocklist.is_blocked.return_value = False
+    search_count.side_effect = lambda params_list: [len(p['uri']) for p in params_list]
+
+    result = badges(request)
+
+    assert search_count.call_count == 1
+    assert result == {'totals': {'http://a.com/': 13, 'http://b.com/': 13}}
+
+
+@badge_fixtures
+def test_badges_only_counts_uncached_uris(models, search_count):
+    models.Blocklist.is_blocked.return_value = False
+    search_count.return_value = [29]
+    badge(mock.Mock(authenticated_userid=None, params={'uri': 'http://a.com/'}))
+    search_count.return_value = [3]
+
+    result = badges(mock.Mock(authenticated_userid=None,
+                              params=MultiDict([('uri', 'http://a.com/'),
+                                                ('uri', 'http://b.com/')])))
+
+    search_count.assert_called_with([{'uri': 'http://b.com/'}])
+    assert result == {'totals': {'http://a.com/': 29, 'http://b.com/': 3}}
+
+
+@badge_fixtures
+def test_badges_returns_0_for_blocked_uris(models, search_count):
+    models.Blocklist.is_blocked.side_effect = lambda _, uri: uri == 'http://a.com/'
+    search_count.return_value = [3]
+
+    result = badges(mock.Mock(authenticated_userid=None,
+                              params=MultiDict([('uri', 'http://a.com/'),
+                                                ('uri', 'http://b.com/')])))
+
+    search_count.assert_called_once_with([{'uri': 'http://b.com/'}])
+    assert result == {'totals': {'http://a.com/': 0, 'http://b.com/': 3}}
+
+
+@badge_fixtures
+@pytest.mark.parametrize('uris', [
+    [],
+    [''],
+    ['http://example.com/{}'.format(i) for i in range(views.MAX_BATCH_SIZE + 1)],
+])
+def test_badges_raises_if_no_uris_or_too_many(uris):
+    params = MultiDict([('uri', uri) for uri in uris])
+
+    with pytest.raises(httpexceptions.HTTPBadRequest):
+        badges(mock.Mock(params=params))
+
+
+@pytest.fixture(autouse=True)
+def badge_counts(monkeypatch):
+    badge_counts = views.ExpiringLRUCache(maxsize=100, ttl=30)
+    monkeypatch.setattr(views, 'BADGE_COUNTS', badge_counts)
+    return badge_counts
+
+
 @pytest.fixture
 def models(patch):
     return patch('h.views.badge.models')
@@ -54,5 +158,12 @@ def search_lib(patch):
 
 
 @pytest.fixture
-def search_run(search_lib):
-    return search_lib.Search.return_value.run
+def search_count(search_lib):
+    return search_lib.Search.return_value.count
+
+
+@pytest.fixture
+def storage(patch):
+    storage = patch('h.views.badge.storage')
+    storage.expand_uri.side_effect = lambda _, uri, stats: [uri]
+    return storage